@@ -0,0 +1,175 @@
+"""Worker-local store for files that outlive a job: hero sources, masters and tails, normalized chunks.
+
+RunPod keeps workers warm across many jobs, but each job works in its own
+TemporaryDirectory. Stages that download or encode something another job may
+need again put the result here under a key and check the store first next time.
+
+Files are stored once per content (objects/ab/<sha256>), so two keys with the
+same bytes share a blob. index.json maps every key to its blob, size, metadata
+and last use. Blobs and the index are written to a temporary name and renamed,
+and index changes are serialized with a file lock, so a store on a network
+volume can be shared by several workers. When the blobs exceed the byte budget,
+the least recently used keys are dropped and unreferenced blobs deleted.
+
+Callers get a hard link (or copy) of the blob in their job directory, so an
+eviction by another job never removes a file that is still being read. Hits and
+misses are counted on the job's trace (`asset_store.hit` / `asset_store.miss`).
+"""
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from tracing import count
+
+ASSET_STORE_DIR = Path(os.environ.get('ASSET_STORE_DIR', os.environ.get('HERO_CACHE_DIR', '/tmp/asset-store')))
+ASSET_STORE_MAX_BYTES = int(os.environ.get('ASSET_STORE_MAX_BYTES', os.environ.get('HERO_CACHE_MAX_BYTES', 4 * 1024 * 1024 * 1024)))
+
+_COPY_BLOCK = 1024 * 1024
+
+
+def link_or_copy(src, dst):
+    """Hard-link src to dst (replacing dst), copying when linking is not possible"""
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class AssetStore:
+    """A content-addressed file store with a key index and LRU eviction"""
+
+    def __init__(self, root, max_bytes):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.index_path = self.root / 'index.json'
+        self.lock_path = self.root / 'index.lock'
+        self._thread_lock = threading.Lock()
+
+    @contextmanager
+    def _locked_index(self, write=False):
+        """Yield the index under a thread and file lock; written back atomically when write=True"""
+        self.root.mkdir(parents=True, exist_ok=True)
+        with self._thread_lock, open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                index = json.loads(self.index_path.read_text()) if self.index_path.exists() else {}
+                yield index
+                if write:
+                    tmp_path = self.index_path.with_suffix(f'.{os.getpid()}.part')
+                    tmp_path.write_text(json.dumps(index))
+                    os.replace(tmp_path, self.index_path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _blob_path(self, digest):
+        return self.root / 'objects' / digest[:2] / digest
+
+    def meta(self, key):
+        """Metadata stored with key, or None when the key is not in the store"""
+        with self._locked_index() as index:
+            entry = index.get(key)
+        return entry['meta'] if entry else None
+
+    def get(self, key, dst):
+        """Place the file stored under key at dst and return dst, or None on a miss"""
+        with self._locked_index(write=True) as index:
+            entry = index.get(key)
+            blob = self._blob_path(entry['sha256']) if entry else None
+            if blob is not None and blob.exists():
+                # Link while holding the lock so the blob cannot be evicted in between
+                link_or_copy(blob, dst)
+                entry['last_used'] = time.time()
+            else:
+                index.pop(key, None)
+                blob = None
+        count('asset_store.hit' if blob is not None else 'asset_store.miss')
+        return dst if blob is not None else None
+
+    def put(self, key, src, meta=None):
+        """Store a copy of the file src under key (with optional JSON-able metadata); returns its SHA-256"""
+        tmp_path = self.root / 'objects' / f"incoming-{os.getpid()}-{threading.get_ident()}"
+        tmp_path.parent.mkdir(parents=True, exist_ok=True)
+        digest = hashlib.sha256()
+        with open(src, 'rb') as source, open(tmp_path, 'wb') as target:
+            for block in iter(lambda: source.read(_COPY_BLOCK), b''):
+                digest.update(block)
+                target.write(block)
+        sha256 = digest.hexdigest()
+        blob = self._blob_path(sha256)
+        with self._locked_index(write=True) as index:
+            blob.parent.mkdir(parents=True, exist_ok=True)
+            if blob.exists():
+                # Same content already stored under another key
+                tmp_path.unlink()
+            else:
+                os.replace(tmp_path, blob)
+            index[key] = {
+                'sha256': sha256,
+                'size': blob.stat().st_size,
+                'meta': meta,
+                'last_used': time.time(),
+            }
+            self._evict(index, keep_key=key)
+        return sha256
+
+    def cached_file(self, key, dst, produce, meta=None):
+        """Place the file stored under key at dst; on a miss run produce(dst) first and store its result.
+
+        Returns True on a hit, False when the file was produced.
+        """
+        if self.get(key, dst) is not None:
+            return True
+        produce(dst)
+        self.put(key, dst, meta)
+        return False
+
+    def _evict(self, index, keep_key):
+        """Drop least recently used keys until the stored blobs fit the byte budget"""
+        blob_sizes = {entry['sha256']: entry['size'] for entry in index.values()}
+        total = sum(blob_sizes.values())
+        for key in sorted(index, key=lambda k: index[k]['last_used']):
+            if total <= self.max_bytes:
+                break
+            if key == keep_key:
+                continue
+            sha256 = index.pop(key)['sha256']
+            if any(entry['sha256'] == sha256 for entry in index.values()):
+                continue
+            print(f"Evicting {key} from asset store ({blob_sizes[sha256]} bytes)")
+            self._blob_path(sha256).unlink(missing_ok=True)
+            total -= blob_sizes[sha256]
+
+    def stats(self):
+        """Number of keys and bytes stored"""
+        with self._locked_index() as index:
+            blob_sizes = {entry['sha256']: entry['size'] for entry in index.values()}
+        return {'keys': len(index), 'bytes': sum(blob_sizes.values()), 'max_bytes': self.max_bytes}
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """Return the worker's asset store"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = AssetStore(ASSET_STORE_DIR, ASSET_STORE_MAX_BYTES)
+        return _store
+
+
+def configure_store(root, max_bytes=ASSET_STORE_MAX_BYTES):
+    """Point the worker's asset store somewhere else (e.g. a scratch directory for benchmarks)"""
+    global _store
+    with _store_lock:
+        _store = AssetStore(root, max_bytes)
+        return _store
@@ -0,0 +1,133 @@
+"""The job's final audio track: the source decoded once, loudness-normalized and encoded to AAC once.
+
+Every output carries the customer's original audio, so intermediate video
+steps drop audio (`-an`) and the compose/stitch steps mux this track with
+`-c:a copy`. The MP3 is decoded a single time per track.
+
+Normalization is two-pass EBU R128 (ffmpeg loudnorm): a first pass measures
+integrated loudness, true peak and loudness range, and the second applies a
+linear gain to reach LOUDNORM_I / LOUDNORM_TP / LOUDNORM_LRA, so every message
+plays at the same level. Both the measurement and the encoded track are kept in
+the asset store, keyed by the source's content (or R2 ETag), so a retried or
+repeated job skips both passes.
+"""
+import hashlib
+import json
+import math
+import os
+import tempfile
+from pathlib import Path
+
+from asset_store import get_store
+from encoder_profiles import audio_encode_args
+from media_probe import content_hash, probe
+from tracing import traced_run
+
+# EBU R128 targets: integrated loudness (LUFS), true peak (dBTP), loudness range (LU)
+LOUDNORM_TARGET = {
+    'I': float(os.environ.get('LOUDNORM_I', -16)),
+    'TP': float(os.environ.get('LOUDNORM_TP', -1.5)),
+    'LRA': float(os.environ.get('LOUDNORM_LRA', 11)),
+}
+
+
+def _settings_hash(settings):
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def _target_filter(target):
+    return f"loudnorm=I={target['I']}:TP={target['TP']}:LRA={target['LRA']}"
+
+
+def _measure(src, target):
+    """First loudnorm pass: measure the source (decode only, no output)"""
+    result = traced_run([
+        'ffmpeg', '-hide_banner', '-nostats',
+        '-i', str(src),
+        '-vn',
+        '-af', f"{_target_filter(target)}:print_format=json",
+        '-f', 'null', '-'
+    ], capture_output=True, text=True, check=True)
+    # The measurement is the JSON object at the end of stderr
+    stderr = result.stderr
+    start = stderr.rfind('{')
+    if start < 0:
+        raise ValueError(f"loudnorm printed no measurement for {src}")
+    return json.loads(stderr[start:stderr.rfind('}') + 1])
+
+
+def loudness_analysis(src, source_id, target=None):
+    """Loudness of src as measured by the first loudnorm pass, cached per source and target"""
+    target = target or LOUDNORM_TARGET
+    key = f"loudness/{source_id}/{_settings_hash(target)}"
+    with tempfile.TemporaryDirectory() as tmpdir:
+        analysis_path = Path(tmpdir) / 'loudness.json'
+
+        def measure(dst):
+            Path(dst).write_text(json.dumps(_measure(src, target)))
+
+        get_store().cached_file(key, analysis_path, measure)
+        return json.loads(analysis_path.read_text())
+
+
+def _normalize_filter(analysis, target):
+    """Second loudnorm pass with the measured values, or None when there is nothing to normalize (silence)"""
+    try:
+        measured_i = float(analysis['input_i'])
+    except (KeyError, ValueError):
+        return None
+    if not math.isfinite(measured_i):
+        return None
+    return (
+        f"{_target_filter(target)}"
+        f":measured_I={analysis['input_i']}:measured_TP={analysis['input_tp']}"
+        f":measured_LRA={analysis['input_lra']}:measured_thresh={analysis['input_thresh']}"
+        f":offset={analysis['target_offset']}:linear=true"
+    )
+
+
+def prepare_audio(src, dst, profile, normalize=True, source_id=None):
+    """Produce the track to mux into the output from src (local path or URL).
+
+    Writes an AAC track to dst unless src is already AAC and normalize is off,
+    in which case src is used as-is. source_id identifies the source's content
+    for the asset store (default: SHA-256 of the local file).
+    Returns (track path, {'audio': 'copy'|'aac'|'loudnorm', 'loudness', 'cached'}).
+    """
+    audio = probe(src)['audio']
+    if audio is None:
+        raise ValueError(f"No audio stream in {src}")
+    if not normalize and audio['codec_name'] == 'aac':
+        return src, {'audio': 'copy', 'loudness': None, 'cached': False}
+    source_id = source_id or content_hash(src)
+
+    analysis = loudness_analysis(src, source_id) if normalize else None
+    loudnorm = _normalize_filter(analysis, LOUDNORM_TARGET) if analysis else None
+    settings = [loudnorm, profile['audio_bitrate']]
+    key = f"audio/{source_id}/{_settings_hash(settings)}"
+
+    def encode(dst):
+        filter_args = ['-af', loudnorm] if loudnorm else []
+        traced_run([
+            'ffmpeg', '-i', str(src),
+            '-vn',
+            *filter_args,
+            # loudnorm works at 192 kHz internally; keep the source rate
+            '-ar', str(audio['sample_rate']),
+            *audio_encode_args(profile),
+            '-y', str(dst)
+        ], capture_output=True, text=True, check=True)
+
+    cached = get_store().cached_file(key, dst, encode)
+    mode = 'loudnorm' if loudnorm else 'aac'
+    print(f"Audio track: {mode}{' (cached)' if cached else ''}")
+    return dst, {
+        'audio': mode,
+        'loudness': {
+            'input_i': float(analysis['input_i']),
+            'input_tp': float(analysis['input_tp']),
+            'input_lra': float(analysis['input_lra']),
+            'target_i': LOUDNORM_TARGET['I'],
+        } if loudnorm else None,
+        'cached': cached,
+    }
@@ -0,0 +1,152 @@
+"""Encoder profile benchmark on synthetic media.
+
+Generates test media with ffmpeg's testsrc/sine sources, then runs the encode
+path of each pipeline mode for each encoder profile:
+
+- single_pass: generate_and_stitch compose in one filter graph
+- multi_step:  generate_and_stitch compose as separate concat + merge encodes
+- stitch:      stitch_video with one mismatching chunk re-encoded before copy-concat
+
+and reports encode fps, wall time, CPU seconds of the ffmpeg processes and output
+bytes. No R2 or Replicate access is needed.
+
+    python benchmark.py --duration 40 --profiles fast balanced archive --json results.json
+"""
+import argparse
+import json
+import resource
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+from asset_store import configure_store
+from audio_track import prepare_audio
+from encoder_profiles import ENCODER_PROFILES, get_profile
+from handler import compose_multi_step, compose_single_pass, stitch_local
+
+MODES = ('single_pass', 'multi_step', 'stitch')
+
+
+def _ffmpeg(*args):
+    subprocess.run(['ffmpeg', '-v', 'error', *args], capture_output=True, text=True, check=True)
+
+
+def make_video(path, duration, size, fps, pattern='testsrc2'):
+    """Write a synthetic H.264 clip"""
+    _ffmpeg(
+        '-f', 'lavfi', '-i', f"{pattern}=size={size}:rate={fps}",
+        '-t', str(duration),
+        '-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p',
+        '-y', str(path)
+    )
+    return path
+
+
+def make_audio(path, duration):
+    """Write a synthetic MP3 track"""
+    _ffmpeg(
+        '-f', 'lavfi', '-i', f"sine=frequency=440:duration={duration}",
+        '-c:a', 'libmp3lame', '-b:a', '128k',
+        '-y', str(path)
+    )
+    return path
+
+
+def count_frames(path):
+    result = subprocess.run([
+        'ffprobe', '-v', 'error', '-select_streams', 'v:0', '-count_packets',
+        '-show_entries', 'stream=nb_read_packets', '-of', 'csv=p=0', str(path)
+    ], capture_output=True, text=True, check=True)
+    return int(result.stdout.strip())
+
+
+def _children_cpu_s():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def prepare_media(media_dir, duration, chunk_duration, size, fps):
+    """Create the synthetic inputs every mode reads"""
+    width, height = size.split('x')
+    remaining = max(0, duration - chunk_duration)
+    media = {
+        'audio': make_audio(media_dir / 'audio.mp3', duration),
+        'replicate': make_video(media_dir / 'replicate.mp4', min(duration, chunk_duration), size, fps),
+        'hero': make_video(media_dir / 'hero.mp4', 8, size, fps, pattern='testsrc'),
+        'hero_tail': make_video(media_dir / 'hero_tail.mp4', remaining, size, fps, pattern='testsrc') if remaining else None,
+        'remaining': remaining,
+        'chunks': [],
+    }
+    # Chunks as the app uploads them for stitch_video, plus one at a different size and rate
+    chunk_count = max(1, int(duration // 10))
+    for i in range(chunk_count):
+        media['chunks'].append(make_video(media_dir / f"chunk_{i}.mp4", duration / (chunk_count + 1), size, fps))
+    odd_size = f"{int(width) // 2}x{int(height) // 2}"
+    media['chunks'].append(make_video(media_dir / 'chunk_odd.mp4', duration / (chunk_count + 1), odd_size, 30))
+    return media
+
+
+def run_mode(mode, profile, media, duration, work_dir):
+    """Run one mode with one profile and return its measurements"""
+    output = work_dir / 'final.mp4'
+    cpu_start = _children_cpu_s()
+    start = time.monotonic()
+    if mode in ('single_pass', 'multi_step'):
+        # The compose steps mux the final audio track as-is, so its one encode counts towards the mode
+        audio_track, _ = prepare_audio(media['audio'], work_dir / 'audio.m4a', profile)
+    if mode == 'single_pass':
+        compose_single_pass(media['replicate'], media['hero'], audio_track, duration, media['remaining'], output, profile)
+    elif mode == 'multi_step':
+        compose_multi_step(media['replicate'], media['hero_tail'], audio_track, duration, output, work_dir, profile)
+    else:
+        stitch_local(media['chunks'], media['audio'], output, work_dir, {}, profile)
+    wall_s = time.monotonic() - start
+    cpu_s = _children_cpu_s() - cpu_start
+    frames = count_frames(output)
+    return {
+        'mode': mode,
+        'profile': profile['name'],
+        'wall_s': round(wall_s, 3),
+        'cpu_s': round(cpu_s, 3),
+        'encode_fps': round(frames / wall_s, 1) if wall_s > 0 else None,
+        'frames': frames,
+        'output_bytes': output.stat().st_size,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--duration', type=float, default=40, help='audio (and output) length in seconds')
+    parser.add_argument('--chunk-duration', type=float, default=25, help='length of the lip-synced clip')
+    parser.add_argument('--size', default='720x1280', help='synthetic video size WxH')
+    parser.add_argument('--fps', type=int, default=25)
+    parser.add_argument('--profiles', nargs='+', default=list(ENCODER_PROFILES), choices=list(ENCODER_PROFILES))
+    parser.add_argument('--modes', nargs='+', default=list(MODES), choices=MODES)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        media_dir = Path(tmpdir) / 'media'
+        media_dir.mkdir()
+        # A fresh store, so re-encoded chunks from earlier runs are not reused
+        configure_store(Path(tmpdir) / 'assets')
+        print(f"Generating {args.duration}s of synthetic {args.size}@{args.fps} media...")
+        media = prepare_media(media_dir, args.duration, args.chunk_duration, args.size, args.fps)
+        for mode in args.modes:
+            for name in args.profiles:
+                work_dir = Path(tmpdir) / f"{mode}-{name}"
+                work_dir.mkdir()
+                results.append(run_mode(mode, get_profile(name), media, args.duration, work_dir))
+
+    print(f"\n{'mode':<12} {'profile':<10} {'wall s':>8} {'cpu s':>8} {'fps':>8} {'bytes':>12}")
+    for r in results:
+        print(f"{r['mode']:<12} {r['profile']:<10} {r['wall_s']:>8.2f} {r['cpu_s']:>8.2f} {r['encode_fps']:>8.1f} {r['output_bytes']:>12}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""Shared pytest fixtures: a moto S3 server standing in for R2 and the fake Replicate API."""
+import os
+import subprocess
+
+import pytest
+
+from r2 import get_r2_client
+
+# No 'test' in the names: the handler turns those away as dummy credentials
+BUCKET = 'r2-local'
+
+
+@pytest.fixture(scope='session')
+def r2_config():
+    """r2_config of a bucket on a local moto S3 server (skips when moto is not installed)"""
+    pytest.importorskip('moto.server')
+    from moto.server import ThreadedMotoServer
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    server = ThreadedMotoServer(port=0, verbose=False)
+    server.start()
+    host, port = server.get_host_and_port()
+    config = {
+        'account_id': 'local',
+        'access_key_id': 'local',
+        'secret_access_key': 'local',
+        'bucket_name': BUCKET,
+        'public_url': '',
+        'endpoint_url': f"http://{host}:{port}",
+    }
+    get_r2_client(config).create_bucket(Bucket=BUCKET)
+    yield config
+    server.stop()
+
+
+@pytest.fixture(scope='session')
+def lipsync_clip(tmp_path_factory):
+    """A short synthetic video the fake Replicate server hands out as every prediction's output"""
+    from benchmark import make_video
+    directory = tmp_path_factory.mktemp('replicate')
+    clip = make_video(directory / 'encoded.mp4', 6, '128x228', 15)
+    # moov first, so the compose streams it from a pipe rather than downloading it first
+    faststart = directory / 'lipsync.mp4'
+    subprocess.run(['ffmpeg', '-v', 'error', '-i', str(clip), '-c', 'copy', '-movflags', '+faststart', '-y', str(faststart)], check=True)
+    return faststart
+
+
+@pytest.fixture
+def fake_replicate(lipsync_clip):
+    """Start a FakeReplicateServer with the given options; stopped after the test"""
+    from fake_replicate import FakeReplicateServer
+    servers = []
+
+    def start(**kwargs):
+        servers.append(FakeReplicateServer(str(lipsync_clip), **kwargs).start())
+        return servers[-1]
+
+    yield start
+    for server in servers:
+        server.stop()
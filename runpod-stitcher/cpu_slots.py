@@ -0,0 +1,26 @@
+"""Worker-wide limit on concurrently running CPU-heavy ffmpeg encodes.
+
+One slot per core by default. When several jobs run in the same worker (batch
+mode, concurrent RunPod jobs) their encodes queue for a slot here instead of
+thrashing the CPU, while their downloads, uploads and Replicate waits overlap
+freely. With a single job the slot is always free. libx264 threads each encode
+across cores on its own; the profile's `threads` caps that per encode.
+"""
+import os
+import threading
+from contextlib import contextmanager
+
+CPU_COUNT = os.cpu_count() or 1
+FFMPEG_CONCURRENCY = int(os.environ.get('FFMPEG_CONCURRENCY', CPU_COUNT))
+
+_slots = threading.BoundedSemaphore(FFMPEG_CONCURRENCY)
+
+
+@contextmanager
+def cpu_slot():
+    """Hold one encode slot for the duration of the block (not re-entrant)"""
+    _slots.acquire()
+    try:
+        yield
+    finally:
+        _slots.release()
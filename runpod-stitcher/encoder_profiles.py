@@ -0,0 +1,78 @@
+"""Named encoder settings for the ffmpeg encodes that produce job output.
+
+Output is a short lip-sync clip watched once on a phone, so the default
+'balanced' profile keeps the long-standing libx264 medium / CRF 23 / AAC 128k
+settings and the others trade quality against encode cost in either direction.
+Pick one per job with `encoder_profile` (default ENCODER_PROFILE env or
+'balanced'); individual fields can be overridden with `encoder_overrides`.
+"""
+import os
+
+ENCODER_PROFILES = {
+    'fast': {
+        'preset': 'veryfast',
+        'tune': 'fastdecode',
+        'crf': 26,
+        # 0 lets x264 pick based on the core count
+        'threads': 0,
+        # Cap on output height, None keeps the source resolution
+        'max_height': 720,
+        'audio_bitrate': '96k',
+    },
+    'balanced': {
+        'preset': 'medium',
+        'tune': None,
+        'crf': 23,
+        'threads': 0,
+        'max_height': None,
+        'audio_bitrate': '128k',
+    },
+    'archive': {
+        'preset': 'slow',
+        'tune': 'film',
+        'crf': 18,
+        'threads': 0,
+        'max_height': None,
+        'audio_bitrate': '192k',
+    },
+}
+
+DEFAULT_ENCODER_PROFILE = os.environ.get('ENCODER_PROFILE', 'balanced')
+
+
+def get_profile(name=None, overrides=None):
+    """Return the settings of a named profile (default profile when name is None) with overrides applied"""
+    name = name or DEFAULT_ENCODER_PROFILE
+    if name not in ENCODER_PROFILES:
+        raise ValueError(f"Unknown encoder_profile: {name} (expected one of {', '.join(ENCODER_PROFILES)})")
+    unknown = set(overrides or {}) - set(ENCODER_PROFILES[name])
+    if unknown:
+        raise ValueError(f"Unknown encoder_overrides fields: {', '.join(sorted(unknown))}")
+    return {'name': name, **ENCODER_PROFILES[name], **(overrides or {})}
+
+
+def video_encode_args(profile):
+    """libx264 arguments for a profile"""
+    args = [
+        '-c:v', 'libx264',
+        '-preset', profile['preset'],
+        '-crf', str(profile['crf']),
+    ]
+    if profile['tune']:
+        args += ['-tune', profile['tune']]
+    if profile['threads']:
+        args += ['-threads', str(profile['threads'])]
+    return args
+
+
+def audio_encode_args(profile):
+    """AAC arguments for a profile"""
+    return ['-c:a', 'aac', '-b:a', profile['audio_bitrate']]
+
+
+def output_size(profile, width, height):
+    """Scale (width, height) down to the profile's max_height, keeping the aspect ratio and even dimensions"""
+    max_height = profile['max_height']
+    if not max_height or height <= max_height:
+        return width, height
+    return max(2, round(width * max_height / height / 2) * 2), max_height
@@ -0,0 +1,239 @@
+"""Local stand-in for the Replicate predictions API.
+
+Serves just enough of the API for the handler: model lookup, prediction
+create/get (including `Prefer: wait` and optional 429s), cancel and the output
+file (with Range support and optional dropped connections). Every prediction
+"runs" for a configurable delay, reports cog-style progress in its logs and
+then points at a pre-rendered clip. Request counts are kept per endpoint so
+runs can compare API calls per job.
+
+    python fake_replicate.py --clip clip.mp4 --delay 20 --port 8089
+
+then point the handler at it with REPLICATE_API_BASE=http://127.0.0.1:8089/v1
+(or `replicate_api_base` in the job input).
+"""
+import argparse
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeReplicateServer(ThreadingHTTPServer):
+    """Threaded HTTP server holding the fake predictions and request counters"""
+    daemon_threads = True
+
+    def __init__(self, clip_path, delay=10.0, fail_rate=0.0, port=0, drop_rate=0.0, rate_limits=0, retry_after='1'):
+        super().__init__(('127.0.0.1', port), _Handler)
+        self.clip_path = clip_path
+        # The first `rate_limits` creates get a 429 with this Retry-After header
+        self.rate_limits = rate_limits
+        self.retry_after = retry_after
+        # Prefer header of every create request
+        self.prefer = []
+        self.delay = delay
+        self.fail_rate = fail_rate
+        self.drop_rate = drop_rate
+        self._file_requests = 0
+        self.predictions = {}
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self._created = 0
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    @property
+    def api_base(self):
+        return f"{self.base_url}/v1"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name='fake-replicate', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def create(self, body):
+        with self.lock:
+            self._created += 1
+            # Deterministic failures: every 1/fail_rate-th prediction fails
+            fails = self.fail_rate > 0 and self._created % max(1, round(1 / self.fail_rate)) == 0
+        prediction_id = uuid.uuid4().hex[:20]
+        self.predictions[prediction_id] = {
+            'id': prediction_id,
+            'input': body.get('input', {}),
+            'created_at': time.monotonic(),
+            'fails': fails,
+        }
+        return self.view(prediction_id)
+
+    def should_drop(self):
+        """Deterministic faults: every 1/drop_rate-th file response is cut off halfway"""
+        with self.lock:
+            self._file_requests += 1
+            # Starting with the first, so a single download already sees a fault
+            return self.drop_rate > 0 and (self._file_requests - 1) % max(1, round(1 / self.drop_rate)) == 0
+
+    def view(self, prediction_id):
+        """Return the API representation of a prediction at the current time"""
+        record = self.predictions[prediction_id]
+        progress = min(1.0, (time.monotonic() - record['created_at']) / self.delay) if self.delay > 0 else 1.0
+        data = {
+            'id': prediction_id,
+            'input': record['input'],
+            'urls': {'get': f"{self.api_base}/predictions/{prediction_id}"},
+            'logs': f"{int(progress * 100)}%|{'#' * int(progress * 10)}| lip-syncing",
+            'output': None,
+            'error': None,
+        }
+        if record.get('canceled'):
+            data['status'] = 'canceled'
+        elif progress < 1.0:
+            data['status'] = 'processing'
+        elif record['fails']:
+            data['status'] = 'failed'
+            data['error'] = 'Injected failure'
+        else:
+            data['status'] = 'succeeded'
+            data['output'] = f"{self.base_url}/files/{prediction_id}.mp4"
+        return data
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        if self.path.startswith('/files/'):
+            server.calls['file'] += 1
+            return self._send_file(server.clip_path)
+        if self.path.startswith('/v1/models/'):
+            server.calls['model'] += 1
+            return self._send_json(200, {'latest_version': {'id': 'fake-version'}})
+        match = re.fullmatch(r'/v1/predictions/(\w+)', self.path)
+        if match and match.group(1) in server.predictions:
+            server.calls['get'] += 1
+            return self._send_json(200, server.view(match.group(1)))
+        self._send_json(404, {'detail': 'Not found'})
+
+    def do_HEAD(self):
+        if self.path.startswith('/files/'):
+            self.server.calls['file_head'] += 1
+            return self._send_file(self.server.clip_path, body=False)
+        self.send_response(404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        server = self.server
+        match = re.fullmatch(r'/v1/predictions/(\w+)/cancel', self.path)
+        if match and match.group(1) in server.predictions:
+            server.calls['cancel'] += 1
+            server.predictions[match.group(1)]['canceled'] = True
+            return self._send_json(200, server.view(match.group(1)))
+        if self.path != '/v1/predictions':
+            return self._send_json(404, {'detail': 'Not found'})
+        server.calls['create'] += 1
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length) or b'{}')
+        server.prefer.append(self.headers.get('Prefer'))
+        with server.lock:
+            rate_limited = server.rate_limits > 0
+            server.rate_limits -= rate_limited
+        if rate_limited:
+            server.calls['rate_limited'] += 1
+            payload = json.dumps({'detail': 'Request was throttled.'}).encode()
+            self.send_response(429)
+            self.send_header('Retry-After', server.retry_after)
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+        prediction = server.create(body)
+        # Honour "Prefer: wait=N" by holding the response until done or N seconds pass
+        match = re.search(r'wait=(\d+)', self.headers.get('Prefer', ''))
+        if match:
+            deadline = time.monotonic() + int(match.group(1))
+            while prediction['status'] == 'processing' and time.monotonic() < deadline:
+                time.sleep(0.05)
+                prediction = server.view(prediction['id'])
+        self._send_json(201, prediction)
+
+    def _send_file(self, path, body=True):
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        match = re.fullmatch(r'bytes=(\d*)-(\d*)', self.headers.get('Range', ''))
+        if match and (match.group(1) or match.group(2)):
+            if match.group(1):
+                start = int(match.group(1))
+                end = int(match.group(2)) if match.group(2) else end
+            else:
+                start = size - int(match.group(2))
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'video/mp4')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        if not body:
+            return
+        remaining = end - start + 1
+        # Injected fault: send half the body, then drop the connection
+        stop_at = remaining // 2 if self.server.should_drop() else 0
+        with open(path, 'rb') as f:
+            f.seek(start)
+            while remaining > stop_at:
+                block = f.read(min(remaining - stop_at, 1024 * 1024))
+                if not block:
+                    break
+                self.wfile.write(block)
+                remaining -= len(block)
+        if stop_at:
+            self.server.calls['file_dropped'] += 1
+            self.close_connection = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clip', required=True, help='pre-rendered MP4 returned as every prediction output')
+    parser.add_argument('--delay', type=float, default=10.0, help='seconds each prediction takes')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='fraction of predictions that fail')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='fraction of output downloads cut off halfway')
+    parser.add_argument('--rate-limits', type=int, default=0, help='create requests answered with 429 before the first one succeeds')
+    parser.add_argument('--port', type=int, default=8089)
+    args = parser.parse_args()
+    server = FakeReplicateServer(
+        args.clip, delay=args.delay, fail_rate=args.fail_rate, port=args.port, drop_rate=args.drop_rate,
+        rate_limits=args.rate_limits
+    )
+    print(f"Fake Replicate API listening on {server.api_base}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f"Calls: {dict(server.calls)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,332 +1,596 @@
+import asyncio
+import contextlib
+import contextvars
+import hashlib
+import importlib.util
 import json
 import subprocess
-import boto3
 import os
 import sys
 import tempfile
 import time
 import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
-# Try to import runpod SDK, fallback to stdin/stdout if not available
-try:
-    import runpod
-    USE_RUNPOD_SDK = True
-except ImportError:
-    USE_RUNPOD_SDK = False
+from asset_store import get_store
+from audio_track import LOUDNORM_TARGET, prepare_audio
+from cpu_slots import CPU_COUNT, cpu_slot
+from encoder_profiles import get_profile, output_size, video_encode_args
+from hero_cache import get_hero_source, get_hero_tail, hero_cache_key
+from hls_output import ffmpeg_to_hls
+from http_fetch import FetchPipe, fetch, head, moov_first, open_pipe
+from media_probe import content_hash, probe, probe_video
+from prewarm import job_completed, mark_ready, start_prewarm
+from renditions import describe_renditions, parse_renditions, rendition_filters, rendition_output_args, rendition_uploads
+from r2 import (
+    R2_BULK_WORKERS, download_from_r2, download_many, presigned_get_url, public_url_for,
+    upload_many, upload_stream, upload_to_r2
+)
+from result_cache import audio_fingerprint, job_cache_key, run_cached
+from replicate_client import (
+    MAX_CONCURRENT_PREDICTIONS, PREDICTION_TIMEOUT, get_model_version_sync, submit_lipsync,
+    submit_lipsync_many
+)
+from stage_graph import StageGraph
+from smart_cut import cut_audio, split_audio, split_durations
+from stitch_compat import normalize_chunk, plan_stitch, probe_video_params
+from tracing import FfmpegProcess, in_context, span, start_trace, traced_run
+
+# Use the runpod SDK when installed, fallback to stdin/stdout if not available.
+# It is only imported at start-up, after the prewarm tasks are running.
+USE_RUNPOD_SDK = importlib.util.find_spec('runpod') is not None
+if not USE_RUNPOD_SDK:
     print("Warning: runpod SDK not available, using stdin/stdout mode")
 
-def download_from_r2(key, local_path, r2_config):
-    """Download file from R2"""
-    from botocore.config import Config
+# Batch items in flight at once; most of an item's time is I/O or Replicate waits,
+# while encodes are separately limited by cpu_slots.FFMPEG_CONCURRENCY (one per core)
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', CPU_COUNT * 2))
+# RunPod jobs one worker accepts at once, for the same reason: jobs waiting on Replicate or
+# transfers cost no CPU, and their encodes still queue for a cpu_slots slot
+WORKER_CONCURRENCY = int(os.environ.get('WORKER_CONCURRENCY', CPU_COUNT * 2))
+
+# Set by runpod_handler so a job can publish partial results (e.g. a playable HLS playlist) before it finishes
+_job_progress = contextvars.ContextVar('job_progress', default=None)
+
+def report_progress(update):
+    """Send a progress update for the running job (a no-op outside the RunPod SDK)"""
+    print(f"Progress: {json.dumps(update)}")
+    callback = _job_progress.get()
+    if callback is not None:
+        callback(update)
+
+def _elapsed(start):
+    """Seconds since a time.monotonic() start, for job timing breakdowns"""
+    return round(time.monotonic() - start, 3)
+
+def compose_multi_step(replicate_video_path, trimmed_hero_path, audio_track, audio_duration, final_video, tmpdir_path, profile=None,
+                       renditions=None, rendition_dir=None):
+    """Build the final video with separate ffmpeg runs for concat and audio merge.
     
-    # Configure boto3 for R2 with proper SSL settings
-    config = Config(
-        signature_version='s3v4',
-        s3={
-            'addressing_style': 'path'
-        }
-    )
+    trimmed_hero_path is the looped hero tail to append, or None when the Replicate clip covers the audio.
+    audio_track is the final AAC track from prepare_audio and is muxed as-is. The renditions spec's
+    files are written to rendition_dir by the merge run.
+    """
+    profile = profile or get_profile()
+    if trimmed_hero_path is not None:
+        # Step 6: Concatenate Replicate video + looped hero video
+        print("Step 6: Concatenating Replicate video with looped hero video...")
+        concat_file = tmpdir_path / "concat.txt"
+        with open(concat_file, 'w') as f:
+            f.write(f"file '{replicate_video_path.resolve()}'\n")
+            f.write(f"file '{trimmed_hero_path.resolve()}'\n")
+        
+        temp_video = tmpdir_path / "temp_video.mp4"
+        # Re-encode when concatenating to ensure both videos play properly
+        traced_run([
+            'ffmpeg', '-f', 'concat', '-safe', '0',
+            '-i', str(concat_file),
+            *video_encode_args(profile),
+            # The clips' own audio is replaced by the original track below
+            '-an',
+            '-avoid_negative_ts', 'make_zero',
+            '-y', str(temp_video)
+        ], capture_output=True, text=True, check=True)
+    else:
+        # Audio is 25s or less, just use Replicate video
+        print("Audio is 25s or less, using Replicate video only")
+        temp_video = replicate_video_path
     
-    s3 = boto3.client(
-        's3',
-        endpoint_url=f"https://{r2_config['account_id']}.r2.cloudflarestorage.com",
-        aws_access_key_id=r2_config['access_key_id'],
-        aws_secret_access_key=r2_config['secret_access_key'],
-        config=config
-    )
-    s3.download_file(r2_config['bucket_name'], key, local_path)
-    print(f"Downloaded {key} to {local_path}")
+    # Step 7: Merge with original audio
+    print("Step 7: Merging with original audio...")
+    # Re-encode video to ensure it plays
+    info = probe_video(temp_video)
+    width, height = output_size(profile, info['width'], info['height'])
+    video_filter = ['-vf', f"scale={width}:{height}"]
+    video_map = '0:v:0'
+    rendition_outputs = []
+    if renditions:
+        # The scaled video also feeds every rendition, written as extra outputs of this run
+        video_filter = [
+            '-filter_complex',
+            f"[0:v]scale={width}:{height}[scaled];{rendition_filters(renditions, 'scaled', audio_duration, main_label='v')}"
+        ]
+        video_map = '[v]'
+        rendition_outputs = rendition_output_args(renditions, rendition_dir, profile, '1:a:0', audio_duration)
+    traced_run([
+        'ffmpeg', '-i', str(temp_video),
+        '-i', str(audio_track),
+        *video_filter,
+        *rendition_outputs,
+        *video_encode_args(profile),
+        '-c:a', 'copy',
+        '-map', video_map,
+        '-map', '1:a:0',
+        # Cut at the audio length explicitly; -shortest drops trailing audio when x264 buffers frames
+        '-t', f"{audio_duration:.3f}",
+        '-avoid_negative_ts', 'make_zero',
+        '-y', str(final_video)
+    ], capture_output=True, text=True, check=True)
 
-def upload_to_r2(local_path, key, r2_config, content_type='application/octet-stream'):
-    """Upload file to R2"""
-    from botocore.config import Config
+def single_pass_args(replicate_video, hero_video_path, audio, audio_duration, remaining_duration, profile=None,
+                     renditions=None, rendition_dir=None):
+    """Return ffmpeg arguments (without output) that loop, trim, concat and mux audio in one filter graph.
     
-    # Configure boto3 for R2 with proper SSL settings
-    config = Config(
-        signature_version='s3v4',
-        s3={
-            'addressing_style': 'path'
-        }
+    replicate_video may be a local path, a URL ffmpeg can read directly or a FetchPipe (the caller
+    passes its fd to ffmpeg). hero_video_path is the
+    original hero clip, looped for remaining_duration seconds, or None when nothing is left to cover.
+    audio is the final AAC track from prepare_audio and is muxed as-is. The renditions spec's files
+    are written to rendition_dir as extra outputs of the same run.
+    """
+    profile = profile or get_profile()
+    # Normalise everything to the Replicate clip's geometry (capped by the profile) and frame rate so concat accepts it
+    if isinstance(replicate_video, FetchPipe):
+        # ffmpeg reads the pipe once, so ffprobe reads the head of the URL instead
+        info = probe_video(replicate_video.url)
+        replicate_video = replicate_video.input
+    else:
+        info = probe_video(replicate_video)
+    width, height = output_size(profile, info['width'], info['height'])
+    fps = info['r_frame_rate']
+    normalise = (
+        f"scale={width}:{height}:force_original_aspect_ratio=decrease,"
+        f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar=1,fps={fps},format=yuv420p"
     )
     
-    s3 = boto3.client(
-        's3',
-        endpoint_url=f"https://{r2_config['account_id']}.r2.cloudflarestorage.com",
-        aws_access_key_id=r2_config['access_key_id'],
-        aws_secret_access_key=r2_config['secret_access_key'],
-        config=config
+    # With renditions the composed video is split between the main output [v] and every rendition
+    composed = 'composed' if renditions else 'v'
+    inputs = ['-i', str(replicate_video)]
+    if hero_video_path is not None and remaining_duration > 0:
+        inputs += ['-stream_loop', '-1', '-i', str(hero_video_path)]
+        audio_input = 2
+        filter_graph = (
+            f"[0:v]{normalise},setpts=PTS-STARTPTS[v0];"
+            f"[1:v]{normalise},trim=duration={remaining_duration:.3f},setpts=PTS-STARTPTS[v1];"
+            f"[v0][v1]concat=n=2:v=1:a=0[{composed}]"
+        )
+    else:
+        print("Audio is 25s or less, using Replicate video only")
+        audio_input = 1
+        filter_graph = f"[0:v]{normalise},setpts=PTS-STARTPTS[{composed}]"
+    inputs += ['-i', str(audio)]
+    rendition_outputs = []
+    if renditions:
+        filter_graph += ';' + rendition_filters(renditions, composed, audio_duration, main_label='v')
+        rendition_outputs = rendition_output_args(renditions, rendition_dir, profile, f'{audio_input}:a:0', audio_duration)
+    
+    return [
+        *inputs,
+        '-filter_complex', filter_graph,
+        # Rendition outputs come first; the caller appends the main output after these options
+        *rendition_outputs,
+        '-map', '[v]',
+        '-map', f'{audio_input}:a:0',
+        *video_encode_args(profile),
+        '-c:a', 'copy',
+        # Cut at the audio length explicitly; -shortest drops trailing audio when x264 buffers frames
+        '-t', f"{audio_duration:.3f}",
+        '-avoid_negative_ts', 'make_zero',
+    ]
+
+def compose_single_pass(replicate_video_path, hero_video_path, audio_track, audio_duration, remaining_duration, final_video, profile=None,
+                        renditions=None, rendition_dir=None):
+    """Build the final video with one ffmpeg run: loop, trim, concat and audio mux in a single filter graph"""
+    print(f"Steps 5-7: Composing final video in a single pass (hero loop for {remaining_duration:.2f} seconds)...")
+    args = single_pass_args(
+        replicate_video_path, hero_video_path, audio_track, audio_duration, remaining_duration, profile, renditions, rendition_dir
     )
-    s3.upload_file(local_path, r2_config['bucket_name'], key, ExtraArgs={'ContentType': content_type})
-    print(f"Uploaded {local_path} to {key}")
+    pass_fds = (replicate_video_path.fd,) if isinstance(replicate_video_path, FetchPipe) else ()
+    traced_run(['ffmpeg', *args, '-y', str(final_video)], capture_output=True, text=True, check=True, pass_fds=pass_fds)
+    if pass_fds:
+        # Raises if the download failed after ffmpeg had read what it got
+        replicate_video_path.close()
+
+def ffmpeg_to_r2(ffmpeg_args, output_key, r2_config, content_type='video/mp4'):
+    """Run ffmpeg writing fragmented MP4 to stdout and multipart-upload it to R2 while it encodes.
+    
+    Returns the number of bytes uploaded. The upload is aborted if ffmpeg fails.
+    """
+    command = [
+        'ffmpeg', *ffmpeg_args,
+        '-f', 'mp4',
+        # Fragmented MP4 needs no seek back to write the moov atom, so it can go to a pipe
+        '-movflags', 'frag_keyframe+empty_moov+default_base_moof',
+        'pipe:1'
+    ]
+    with cpu_slot(), span('ffmpeg', file=output_key) as record:
+        with FfmpegProcess(command, record, stdout=subprocess.PIPE) as ffmpeg:
+            # A failed encode aborts the multipart upload instead of completing it
+            record['bytes'] = upload_stream(ffmpeg.process.stdout, output_key, r2_config, content_type, before_complete=ffmpeg.wait)
+        return record['bytes']
 
 def generate_and_stitch_handler(input_data, r2_config):
+    """Handle generate_and_stitch mode, reusing the output of an identical earlier (or running) job"""
+    # HLS output and renditions are sets of objects the cache does not track, so they are never served from it
+    if not input_data.get('result_cache', True) or input_data.get('output_format', 'mp4') == 'hls' or parse_renditions(input_data):
+        return run_generate_and_stitch(input_data, r2_config)
+    video_url = input_data.get('video_url', 'https://blob.santagram.app/hero/hero.mp4')
+    # Changes when the hero file behind the URL changes
+    hero_version = hero_cache_key(video_url)
+    if hero_version is None:
+        print(f"No ETag/Last-Modified for {video_url}, skipping the result cache")
+        return run_generate_and_stitch(input_data, r2_config)
+    profile = get_profile(input_data.get('encoder_profile'), input_data.get('encoder_overrides'))
+    cache_key = job_cache_key({
+        'audio': audio_fingerprint(input_data['audio_key'], r2_config),
+        'video_url': video_url,
+        'hero_version': hero_version,
+        'chunk_duration': input_data.get('chunk_duration', 25),
+        # The compose path and I/O mode change the output file (streaming writes a fragmented MP4)
+        'pipeline': input_data.get('pipeline', 'single_pass'),
+        'io_mode': input_data.get('io_mode', 'tempdir'),
+        'encoder': profile,
+        'loudnorm': LOUDNORM_TARGET if input_data.get('normalize_audio', True) else None,
+    })
+    return run_cached(
+        cache_key, input_data['output_key'], r2_config,
+        lambda: run_generate_and_stitch(input_data, r2_config)
+    )
+
+def run_generate_and_stitch(input_data, r2_config):
     """Handle simplified pipeline: generate 1 Replicate video for first 25s, loop hero video for rest"""
     audio_key = input_data['audio_key']
     video_url = input_data.get('video_url', 'https://blob.santagram.app/hero/hero.mp4')
     chunk_duration = input_data.get('chunk_duration', 25)
     output_key = input_data['output_key']
     replicate_api_token = input_data.get('replicate_api_token')
+    # 'single_pass' builds one ffmpeg filter graph, 'multi_step' keeps the separate concat/merge runs
+    pipeline = input_data.get('pipeline', 'single_pass')
+    # 'streaming' reads inputs from URLs and uploads the output while ffmpeg writes it
+    io_mode = input_data.get('io_mode', 'tempdir')
+    # 'hls' publishes fMP4 segments and a playlist under hls_prefix while the video encodes
+    output_format = input_data.get('output_format', 'mp4')
+    hls_prefix = input_data.get('hls_prefix') or os.path.splitext(output_key)[0]
+    # Two-pass EBU R128 loudness normalization of the final audio track
+    normalize_audio = input_data.get('normalize_audio', True)
+    # Smaller MP4s, poster and preview written by the same ffmpeg run as the main output
+    renditions = parse_renditions(input_data)
+    profile = get_profile(input_data.get('encoder_profile'), input_data.get('encoder_overrides'))
     
     if not replicate_api_token:
         raise ValueError("Missing replicate_api_token in input")
+    if pipeline not in ('single_pass', 'multi_step'):
+        raise ValueError(f"Unknown pipeline: {pipeline}")
+    if io_mode not in ('tempdir', 'streaming'):
+        raise ValueError(f"Unknown io_mode: {io_mode}")
+    if output_format not in ('mp4', 'hls'):
+        raise ValueError(f"Unknown output_format: {output_format}")
+    if (io_mode == 'streaming' or output_format == 'hls') and pipeline != 'single_pass':
+        raise ValueError("io_mode 'streaming' and output_format 'hls' require the single_pass pipeline")
     
     print(f"Starting simplified pipeline: 1 Replicate prediction + looped hero video")
     print(f"Audio key: {audio_key}, Video URL: {video_url}, First chunk: {chunk_duration}s")
     
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir_path = Path(tmpdir)
+        rendition_dir = tmpdir_path / "renditions"
+        
+        # Stages run as soon as their inputs are ready, so hero preparation overlaps the Replicate wait
+        def fetch_audio(_):
+            # Step 1: Download audio (or let ffmpeg read it straight from R2 when streaming)
+            print("Step 1: Downloading audio and extracting first 25 seconds...")
+            if io_mode == 'streaming':
+                return presigned_get_url(audio_key, r2_config)
+            audio_path = tmpdir_path / "audio.mp3"
+            download_from_r2(audio_key, str(audio_path), r2_config)
+            return audio_path
+        
+        def probe_audio(deps):
+            # Get full audio duration (one memoized ffprobe per file)
+            full_duration = probe(deps['fetch_audio'])['duration']
+            print(f"Full audio duration: {full_duration:.2f} seconds")
+            return full_duration
+        
+        def prepare_audio_track(deps):
+            # Decode the original audio once into the final (loudness-normalized) AAC track
+            print("Preparing final audio track...")
+            # The audio object's ETag names its content in the asset store, without hashing the file
+            source_id = audio_fingerprint(audio_key, r2_config)
+            return prepare_audio(deps['fetch_audio'], tmpdir_path / "audio.m4a", profile, normalize_audio, source_id)
+        
+        def cut_first_chunk(deps):
+            # Extract first chunk (25 seconds), cut on the exact sample where the hero loop takes over
+            first_chunk_path = tmpdir_path / "first_chunk.mp3"
+            cut_audio(deps['fetch_audio'], first_chunk_path, chunk_duration)
+            print(f"Extracted first {chunk_duration} seconds of audio")
+            return first_chunk_path
+        
+        def upload_chunk(deps):
+            # Step 2: Upload first chunk to R2 for the Replicate prediction
+            print("Step 2: Uploading first chunk for the Replicate prediction...")
+            chunk_key = f"audio/chunks/{int(time.time() * 1000)}-first-25s.mp3"
+            upload_to_r2(str(deps['cut_first_chunk']), chunk_key, r2_config, content_type='audio/mpeg')
+            chunk_url = public_url_for(chunk_key, r2_config)
+            
+            # Verify chunk URL is accessible
+            print(f"Verifying chunk URL: {chunk_url}")
+            time.sleep(1)  # Small delay for R2 propagation
+            try:
+                head(chunk_url)
+            except requests.RequestException as e:
+                print(f"Warning: Chunk URL verification failed: {e}, continuing anyway...")
+            return chunk_url
+        
+        predictions = []
+        
+        def predict(deps):
+            # Step 3: Create the prediction and wait for it (cached model version, adaptive polling)
+            print("Step 3: Running Replicate prediction for first 25 seconds...")
+            with span('replicate.predict') as record:
+                prediction = submit_lipsync(
+                    replicate_api_token, video_url, deps['upload_chunk'],
+                    webhook=input_data.get('replicate_webhook_url'),
+                    api_base=input_data.get('replicate_api_base')
+                )
+                predictions.append(prediction)
+                if graph.aborted:
+                    # Another stage failed while this one was starting
+                    prediction.cancel()
+                output_url, stats = prediction.result()
+                record['api_calls'] = stats['api_calls']
+            return output_url, stats
+        
+        def cancel_predict():
+            for prediction in predictions:
+                prediction.cancel()
+        
+        def prepare_hero(deps):
+            # Step 5: Get the hero video for the remaining duration while the prediction runs
+            remaining_duration = max(0, deps['probe_audio'] - chunk_duration)
+            if remaining_duration <= 0:
+                return None
+            print(f"Step 5: Preparing looped hero video for remaining {remaining_duration:.2f} seconds...")
+            if pipeline == 'multi_step':
+                # Cut the tail from the cached, pre-encoded looped hero master
+                return get_hero_tail(video_url, remaining_duration, tmpdir_path / "trimmed_hero.mp4")
+            return get_hero_source(video_url, tmpdir_path / "hero_video.mp4")
+        
+        # Open pipes are closed when the job ends, also when compose never ran
+        replicate_pipes = []
+        
+        def fetch_replicate_video(deps):
+            replicate_video_url, _ = deps['predict']
+            if io_mode == 'streaming':
+                # ffmpeg reads the Replicate output from its URL
+                return replicate_video_url
+            if pipeline == 'single_pass' and output_format == 'mp4' and moov_first(replicate_video_url):
+                # Step 4: Stream the Replicate video into ffmpeg, which starts decoding on the first bytes
+                print("Step 4: Streaming Replicate video into the compose...")
+                pipe = open_pipe(replicate_video_url)
+                replicate_pipes.append(pipe)
+                return pipe
+            # Step 4: Download Replicate video
+            print("Step 4: Downloading Replicate video...")
+            replicate_video_path = fetch(replicate_video_url, tmpdir_path / "replicate_video.mp4")
+            print("Replicate video downloaded")
+            return replicate_video_path
+        
+        def compose(deps):
+            full_duration = deps['probe_audio']
+            remaining_duration = max(0, full_duration - chunk_duration)
+            replicate_video = deps['fetch_replicate_video']
+            hero_video = deps['prepare_hero']
+            audio_path, _ = deps['prepare_audio_track']
+            if output_format == 'hls':
+                # Steps 6-8: Encode in one pass and publish each segment as soon as it is written
+                print(f"Steps 6-8: Publishing HLS to R2: {hls_prefix}/")
+                args = single_pass_args(
+                    replicate_video, hero_video, audio_path, full_duration, remaining_duration, profile, renditions, rendition_dir
+                )
+                return ffmpeg_to_hls(
+                    args, hls_prefix, r2_config, tmpdir_path / "hls",
+                    on_first_segment=lambda playlist_url: report_progress({'playlist_url': playlist_url, 'status': 'first_segment_ready'})
+                )
+            if io_mode == 'streaming':
+                # Steps 6-8: Compose in one pass and upload the result as it is encoded
+                print(f"Steps 6-8: Streaming single-pass compose to R2: {output_key}")
+                args = single_pass_args(
+                    replicate_video, hero_video, audio_path, full_duration, remaining_duration, profile, renditions, rendition_dir
+                )
+                ffmpeg_to_r2(args, output_key, r2_config, content_type='video/mp4')
+                return None
+            # Steps 6-7: Append looped hero video for the remaining duration and merge with original audio
+            final_video = tmpdir_path / "final.mp4"
+            with cpu_slot():
+                if pipeline == 'multi_step':
+                    compose_multi_step(
+                        replicate_video, hero_video, audio_path, full_duration, final_video, tmpdir_path, profile, renditions, rendition_dir
+                    )
+                else:
+                    compose_single_pass(
+                        replicate_video, hero_video, audio_path, full_duration, remaining_duration, final_video, profile, renditions, rendition_dir
+                    )
+            return final_video
+        
+        def upload_output(deps):
+            uploads = rendition_uploads(renditions, rendition_dir, output_key) if renditions else []
+            if deps['compose'] is not None and output_format != 'hls':
+                uploads.insert(0, (str(deps['compose']), output_key, 'video/mp4'))
+            if not uploads:
+                return
+            # Step 8: Upload final video (and renditions) to R2 concurrently
+            print(f"Step 8: Uploading {len(uploads)} files to R2: {output_key}")
+            upload_many(uploads, r2_config)
+        
+        graph = StageGraph()
+        graph.add('fetch_audio', fetch_audio)
+        graph.add('probe_audio', probe_audio, deps=['fetch_audio'])
+        graph.add('prepare_audio_track', prepare_audio_track, deps=['fetch_audio'])
+        graph.add('cut_first_chunk', cut_first_chunk, deps=['fetch_audio'])
+        graph.add('upload_chunk', upload_chunk, deps=['cut_first_chunk'])
+        graph.add('predict', predict, deps=['upload_chunk'], cancel=cancel_predict)
+        graph.add('prepare_hero', prepare_hero, deps=['probe_audio'])
+        graph.add('fetch_replicate_video', fetch_replicate_video, deps=['predict'])
+        graph.add('compose', compose, deps=['fetch_replicate_video', 'prepare_hero', 'probe_audio', 'prepare_audio_track'])
+        graph.add('upload_output', upload_output, deps=['compose'])
+        try:
+            results = graph.run()
+        finally:
+            for pipe in replicate_pipes:
+                with contextlib.suppress(Exception):
+                    pipe.close()
+        _, replicate_stats = results['predict']
+        
+        if output_format == 'hls':
+            hls = results['compose']
+            output_key = hls['playlist_key']
+            hls['playlist_url'] = public_url_for(output_key, r2_config)
+        public_url = public_url_for(output_key, r2_config)
+        
+        print(f"Full pipeline completed successfully: {public_url}")
+        
+        output = {
+            'video_url': public_url,
+            'output_key': output_key,
+            'replicate': replicate_stats,
+            'audio': results['prepare_audio_track'][1],
+            'encoder_profile': profile['name'],
+            **graph.report()
+        }
+        if output_format == 'hls':
+            output['hls'] = hls
+        if renditions:
+            # Keyed off the requested output_key (the HLS playlist key replaces output_key above)
+            output['renditions'] = describe_renditions(renditions, rendition_dir, input_data['output_key'], r2_config)
+        return {
+            'status': 'COMPLETED',
+            'output': output
+        }
+
+def generate_all_chunks_handler(input_data, r2_config):
+    """Handle lip-syncing every audio chunk: all Replicate predictions run at once, hero loop for chunks that fail"""
+    audio_key = input_data['audio_key']
+    video_url = input_data.get('video_url', 'https://blob.santagram.app/hero/hero.mp4')
+    chunk_duration = input_data.get('chunk_duration', 25)
+    output_key = input_data['output_key']
+    replicate_api_token = input_data.get('replicate_api_token')
+    api_base = input_data.get('replicate_api_base')
+    max_concurrency = int(input_data.get('max_concurrent_predictions', MAX_CONCURRENT_PREDICTIONS))
+    prediction_timeout = float(input_data.get('prediction_timeout', PREDICTION_TIMEOUT))
+    io_parallelism = int(input_data.get('io_parallelism', R2_BULK_WORKERS))
+    normalize_audio = input_data.get('normalize_audio', True)
+    renditions = parse_renditions(input_data)
+    profile = get_profile(input_data.get('encoder_profile'), input_data.get('encoder_overrides'))
+    
+    if not replicate_api_token:
+        raise ValueError("Missing replicate_api_token in input")
+    
+    print(f"Starting full lip-sync pipeline: one Replicate prediction per {chunk_duration}s chunk")
+    print(f"Audio key: {audio_key}, Video URL: {video_url}, Max concurrent predictions: {max_concurrency}")
+    timings = {}
+    job_start = time.monotonic()
+    
     with tempfile.TemporaryDirectory() as tmpdir:
         tmpdir_path = Path(tmpdir)
         
-        # Step 1: Download audio and extract first chunk
-        print("Step 1: Downloading audio and extracting first 25 seconds...")
+        # Step 1: Download audio and split it on exact sample boundaries
+        print("Step 1: Downloading and splitting audio...")
+        stage_start = time.monotonic()
         audio_path = tmpdir_path / "audio.mp3"
         download_from_r2(audio_key, str(audio_path), r2_config)
+        chunk_files = split_audio(audio_path, chunk_duration, lambda i: tmpdir_path / f"audio_chunk_{i:03d}.mp3")
+        durations = split_durations(audio_path, chunk_duration)
+        timings['split_s'] = _elapsed(stage_start)
         
-        # Get full audio duration using ffprobe
-        duration_result = subprocess.run([
-            'ffprobe', '-v', 'error', '-show_entries', 'format=duration',
-            '-of', 'default=noprint_wrappers=1:nokey=1', str(audio_path)
-        ], capture_output=True, text=True, check=True)
-        full_duration = float(duration_result.stdout.strip())
-        print(f"Full audio duration: {full_duration:.2f} seconds")
-        
-        # Extract first chunk (25 seconds)
-        first_chunk_path = tmpdir_path / "first_chunk.mp3"
-        subprocess.run([
-            'ffmpeg', '-i', str(audio_path),
-            '-t', str(chunk_duration),
-            '-c', 'copy',
-            '-y', str(first_chunk_path)
-        ], capture_output=True, text=True, check=True)
-        print(f"Extracted first {chunk_duration} seconds of audio")
-        
-        # Step 2: Upload first chunk to R2 and create single Replicate prediction
-        print("Step 2: Uploading first chunk and creating single Replicate prediction...")
-        chunk_key = f"audio/chunks/{int(time.time() * 1000)}-first-25s.mp3"
-        upload_to_r2(str(first_chunk_path), chunk_key, r2_config, content_type='audio/mpeg')
-        
-        # Construct public URL
-        if r2_config['public_url']:
-            public_url = r2_config['public_url'].rstrip('/')
-            if not public_url.startswith('http://') and not public_url.startswith('https://'):
-                public_url = f"https://{public_url}"
-            chunk_url = f"{public_url}/{chunk_key.lstrip('/')}"
-        else:
-            chunk_url = f"https://pub-{r2_config['account_id']}.r2.dev/{r2_config['bucket_name']}/{chunk_key.lstrip('/')}"
-        
-        # Verify chunk URL is accessible
-        print(f"Verifying chunk URL: {chunk_url}")
-        time.sleep(1)  # Small delay for R2 propagation
-        verify_response = requests.head(chunk_url, timeout=10, allow_redirects=True)
-        if not verify_response.ok:
-            print(f"Warning: Chunk URL verification failed: {verify_response.status_code}, continuing anyway...")
-        
-        # Get model version
-        model_name = 'kwaivgi/kling-lip-sync'
-        model_response = requests.get(
-            f'https://api.replicate.com/v1/models/{model_name}',
-            headers={'Authorization': f'Token {replicate_api_token}'},
-            timeout=30
-        )
-        model_response.raise_for_status()
-        model_data = model_response.json()
-        version_id = model_data['latest_version']['id']
-        print(f"Using model version: {version_id}")
-        
-        # Create single Replicate prediction for first 25 seconds
-        print("Creating Replicate prediction for first 25 seconds...")
-        prediction_response = requests.post(
-            'https://api.replicate.com/v1/predictions',
-            headers={
-                'Authorization': f'Token {replicate_api_token}',
-                'Content-Type': 'application/json',
-            },
-            json={
-                'version': version_id,
-                'input': {
-                    'video_url': video_url,
-                    'audio_file': chunk_url,
-                }
-            },
-            timeout=30
+        # Step 2: Upload the chunks for the predictions
+        print(f"Step 2: Uploading {len(chunk_files)} audio chunks...")
+        stage_start = time.monotonic()
+        base_key = f"audio/chunks/{int(time.time() * 1000)}"
+        chunk_keys = upload_many(
+            [(str(chunk_file), f"{base_key}-chunk-{i + 1}.mp3", 'audio/mpeg') for i, chunk_file in enumerate(chunk_files)],
+            r2_config, max_workers=io_parallelism
         )
-        prediction_response.raise_for_status()
-        prediction_data = prediction_response.json()
-        prediction_id = prediction_data['id']
-        print(f"Replicate prediction created: {prediction_id}")
-        
-        # Step 3: Poll for Replicate prediction to complete
-        print("Step 3: Polling Replicate prediction for completion...")
-        max_polls = 300  # 25 minutes max (5 second intervals)
-        replicate_video_url = None
-        
-        polls = 0
-        while polls < max_polls:
-            status_response = requests.get(
-                f'https://api.replicate.com/v1/predictions/{prediction_id}',
-                headers={'Authorization': f'Token {replicate_api_token}'},
-                timeout=30
+        chunk_urls = [public_url_for(chunk_key, r2_config) for chunk_key in chunk_keys]
+        timings['upload_chunks_s'] = _elapsed(stage_start)
+        
+        # Step 3: Start every prediction at once (bounded by max_concurrency) and collect them as they finish
+        print(f"Step 3: Running {len(chunk_urls)} Replicate predictions...")
+        stage_start = time.monotonic()
+        # One model lookup up front instead of one per chunk
+        get_model_version_sync(replicate_api_token, api_base=api_base)
+        segments = [None] * len(chunk_urls)
+        chunks = [{'index': i, 'duration': round(duration, 6)} for i, duration in enumerate(durations)]
+        with span('replicate.predict', chunks=len(chunk_urls)) as record:
+            futures, all_stats = submit_lipsync_many(
+                replicate_api_token, video_url, chunk_urls,
+                max_concurrency=max_concurrency, timeout=prediction_timeout,
+                webhook=input_data.get('replicate_webhook_url'), api_base=api_base
             )
-            status_response.raise_for_status()
-            status_data = status_response.json()
-            
-            if status_data['status'] == 'succeeded':
-                output = status_data.get('output')
-                if isinstance(output, str):
-                    replicate_video_url = output
-                elif isinstance(output, list) and len(output) > 0:
-                    replicate_video_url = output[0]
-                else:
-                    raise ValueError(f"Unexpected output format from Replicate: {output}")
-                print(f"Replicate prediction completed: {prediction_id[:8]}...")
-                break
-            elif status_data['status'] == 'failed':
-                error = status_data.get('error', 'Unknown error')
-                raise ValueError(f"Replicate prediction failed: {error}")
-            elif status_data['status'] == 'canceled':
-                raise ValueError("Replicate prediction was canceled")
-            else:
-                polls += 1
-                if polls % 12 == 0:  # Log every minute
-                    print(f"Replicate prediction still processing (status: {status_data['status']})")
-                time.sleep(5)
-        
-        if not replicate_video_url:
-            raise ValueError(f"Replicate prediction timed out after {max_polls * 5} seconds")
-        
-        # Step 4: Download Replicate video
-        print("Step 4: Downloading Replicate video...")
-        replicate_video_path = tmpdir_path / "replicate_video.mp4"
-        response = requests.get(replicate_video_url, timeout=300, stream=True)
-        response.raise_for_status()
-        with open(replicate_video_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
-        print("Replicate video downloaded")
-        
-        # Step 5: Download hero video and loop it for remaining duration
-        remaining_duration = max(0, full_duration - chunk_duration)
-        print(f"Step 5: Creating looped hero video for remaining {remaining_duration:.2f} seconds...")
-        
-        if remaining_duration > 0:
-            # Download hero video
-            hero_video_path = tmpdir_path / "hero_video.mp4"
-            hero_response = requests.get(video_url, timeout=300, stream=True)
-            hero_response.raise_for_status()
-            with open(hero_video_path, 'wb') as f:
-                for chunk in hero_response.iter_content(chunk_size=8192):
-                    f.write(chunk)
-            
-            # Get hero video duration
-            hero_duration_result = subprocess.run([
-                'ffprobe', '-v', 'error', '-show_entries', 'format=duration',
-                '-of', 'default=noprint_wrappers=1:nokey=1', str(hero_video_path)
-            ], capture_output=True, text=True, check=True)
-            hero_duration = float(hero_duration_result.stdout.strip())
-            print(f"Hero video duration: {hero_duration:.2f} seconds")
-            
-            # Calculate how many loops needed
-            loops_needed = max(1, int(remaining_duration / hero_duration) + 1)
-            print(f"Looping hero video {loops_needed} times to cover {remaining_duration:.2f} seconds")
-            
-            # Create looped hero video with re-encoding to ensure compatibility
-            looped_hero_path = tmpdir_path / "looped_hero.mp4"
-            loop_list = tmpdir_path / "loop_list.txt"
-            with open(loop_list, 'w') as f:
-                for _ in range(loops_needed):
-                    abs_path = hero_video_path.resolve()
-                    f.write(f"file '{abs_path}'\n")
-            
-            # Re-encode when concatenating to ensure compatibility
-            subprocess.run([
-                'ffmpeg', '-f', 'concat', '-safe', '0',
-                '-i', str(loop_list),
-                '-c:v', 'libx264',
-                '-preset', 'medium',
-                '-crf', '23',
-                '-c:a', 'aac',
-                '-b:a', '128k',
-                '-y', str(looped_hero_path)
-            ], capture_output=True, text=True, check=True)
-            
-            # Trim to exact remaining duration
-            trimmed_hero_path = tmpdir_path / "trimmed_hero.mp4"
-            subprocess.run([
-                'ffmpeg', '-i', str(looped_hero_path),
-                '-t', str(remaining_duration),
-                '-c:v', 'libx264',
-                '-preset', 'medium',
-                '-crf', '23',
-                '-c:a', 'aac',
-                '-b:a', '128k',
-                '-avoid_negative_ts', 'make_zero',
-                '-y', str(trimmed_hero_path)
-            ], capture_output=True, text=True, check=True)
-            
-            # Step 6: Concatenate Replicate video + looped hero video
-            print("Step 6: Concatenating Replicate video with looped hero video...")
-            concat_file = tmpdir_path / "concat.txt"
-            with open(concat_file, 'w') as f:
-                f.write(f"file '{replicate_video_path.resolve()}'\n")
-                f.write(f"file '{trimmed_hero_path.resolve()}'\n")
-            
-            temp_video = tmpdir_path / "temp_video.mp4"
-            # Re-encode when concatenating to ensure both videos play properly
-            subprocess.run([
-                'ffmpeg', '-f', 'concat', '-safe', '0',
-                '-i', str(concat_file),
-                '-c:v', 'libx264',
-                '-preset', 'medium',
-                '-crf', '23',
-                '-c:a', 'aac',
-                '-b:a', '128k',
-                '-avoid_negative_ts', 'make_zero',
-                '-y', str(temp_video)
-            ], capture_output=True, text=True, check=True)
-        else:
-            # Audio is 25s or less, just use Replicate video
-            print("Audio is 25s or less, using Replicate video only")
-            temp_video = replicate_video_path
+            index_of = {future: i for i, future in enumerate(futures)}
+            for future in as_completed(futures):
+                i = index_of[future]
+                try:
+                    output_url, _ = future.result()
+                    # Step 4: Download each lip-synced chunk as soon as its prediction is done
+                    segments[i] = fetch(output_url, tmpdir_path / f"lipsync_{i:03d}.mp4")
+                    chunks[i]['source'] = 'lipsync'
+                except Exception as e:
+                    # Step 5: Fall back to the looped hero video for this chunk
+                    print(f"Chunk {i} lip-sync failed ({e}), using hero loop")
+                    segments[i] = get_hero_tail(video_url, durations[i], tmpdir_path / f"hero_{i:03d}.mp4")
+                    chunks[i]['source'] = 'hero'
+                    chunks[i]['error'] = str(e)
+                chunks[i].update({key: all_stats[i].get(key) for key in ('prediction_id', 'wait_s', 'api_calls')})
+            record['api_calls'] = sum(stats['api_calls'] for stats in all_stats)
+        timings['predict_s'] = _elapsed(stage_start)
         
-        # Step 7: Merge with original audio
-        print("Step 7: Merging with original audio...")
+        # Steps 6-7: Concat the segments in order, trimming or padding any that miss their chunk's length, and merge the full audio
         final_video = tmpdir_path / "final.mp4"
-        # Use -shortest to match audio length, but re-encode video to ensure it plays
-        subprocess.run([
-            'ffmpeg', '-i', str(temp_video),
-            '-i', str(audio_path),
-            '-c:v', 'libx264',
-            '-preset', 'medium',
-            '-crf', '23',
-            '-c:a', 'aac',
-            '-b:a', '128k',
-            '-map', '0:v:0',
-            '-map', '1:a:0',
-            '-shortest',  # Ensure video matches audio length
-            '-avoid_negative_ts', 'make_zero',
-            '-y', str(final_video)
-        ], capture_output=True, text=True, check=True)
+        rendition_dir = tmpdir_path / "renditions"
+        plan = stitch_local(
+            segments, audio_path, final_video, tmpdir_path, timings, profile, io_parallelism, durations, normalize_audio,
+            renditions=renditions, rendition_dir=rendition_dir
+        )
         
-        # Step 8: Upload final video to R2
+        # Step 8: Upload final video (and renditions) to R2
         print(f"Step 8: Uploading final video to R2: {output_key}")
-        upload_to_r2(str(final_video), output_key, r2_config, content_type='video/mp4')
-        
-        # Construct public URL
-        if r2_config['public_url']:
-            base_url = r2_config['public_url'].rstrip('/')
-            if not base_url.startswith('http://') and not base_url.startswith('https://'):
-                base_url = f"https://{base_url}"
-            public_url = f"{base_url}/{output_key.lstrip('/')}"
-        else:
-            public_url = f"https://pub-{r2_config['account_id']}.r2.dev/{r2_config['bucket_name']}/{output_key.lstrip('/')}"
+        stage_start = time.monotonic()
+        uploads = [(str(final_video), output_key, 'video/mp4')]
+        if renditions:
+            uploads += rendition_uploads(renditions, rendition_dir, output_key)
+        upload_many(uploads, r2_config, max_workers=io_parallelism)
+        timings['upload_s'] = _elapsed(stage_start)
+        timings['total_s'] = _elapsed(job_start)
         
-        print(f"Full pipeline completed successfully: {public_url}")
+        public_url = public_url_for(output_key, r2_config)
+        fallbacks = [chunk['index'] for chunk in chunks if chunk['source'] == 'hero']
+        print(f"Full lip-sync pipeline completed: {public_url} ({len(fallbacks)} of {len(chunks)} chunks on hero loop)")
         
         return {
             'status': 'COMPLETED',
             'output': {
                 'video_url': public_url,
-                'output_key': output_key
+                'output_key': output_key,
+                'chunks': chunks,
+                'hero_fallback_chunks': fallbacks,
+                'replicate': {
+                    'api_calls': sum(stats['api_calls'] for stats in all_stats),
+                    'rate_limited': sum(stats['rate_limited'] for stats in all_stats),
+                },
+                'stitch_plan': plan,
+                'encoder_profile': profile['name'],
+                **({'renditions': describe_renditions(renditions, rendition_dir, output_key, r2_config)} if renditions else {}),
+                'timings': timings
             }
         }
 
@@ -334,54 +598,41 @@ def split_audio_handler(input_data, r2_config):
     """Handle audio splitting mode"""
     audio_key = input_data['audio_key']
     chunk_duration = input_data.get('chunk_duration', 25)
+    io_parallelism = int(input_data.get('io_parallelism', R2_BULK_WORKERS))
     
     print(f"Starting audio splitting: {audio_key} into {chunk_duration}s chunks")
+    timings = {}
+    job_start = time.monotonic()
     
     with tempfile.TemporaryDirectory() as tmpdir:
         tmpdir_path = Path(tmpdir)
         
         # Download audio
         print("Downloading audio...")
+        stage_start = time.monotonic()
         audio_path = tmpdir_path / "audio.mp3"
         download_from_r2(audio_key, str(audio_path), r2_config)
+        timings['download_s'] = _elapsed(stage_start)
         
         # Split audio using ffmpeg
         print(f"Splitting audio into {chunk_duration}s chunks...")
-        chunk_paths = []
-        chunk_keys = []
-        
-        # Use ffmpeg segment muxer to split audio
-        output_pattern = tmpdir_path / "chunk_%03d.mp3"
-        result = subprocess.run([
-            'ffmpeg', '-i', str(audio_path),
-            '-f', 'segment',
-            '-segment_time', str(chunk_duration),
-            '-c', 'copy',
-            '-reset_timestamps', '1',
-            '-y', str(output_pattern)
-        ], capture_output=True, text=True, check=True)
+        stage_start = time.monotonic()
         
-        # Find all generated chunks
-        chunk_files = sorted(tmpdir_path.glob('chunk_*.mp3'))
+        # Cut on exact sample boundaries (one decode) so chunk durations add up to the source
+        chunk_files = split_audio(audio_path, chunk_duration, lambda i: tmpdir_path / f"chunk_{i:03d}.mp3")
         print(f"Generated {len(chunk_files)} audio chunks")
+        timings['split_s'] = _elapsed(stage_start)
         
-        # Upload each chunk to R2
+        # Upload all chunks to R2 concurrently, keys stay in chunk order
+        stage_start = time.monotonic()
         base_key = f"audio/chunks/{int(time.time() * 1000)}"
-        for i, chunk_file in enumerate(chunk_files):
-            chunk_key = f"{base_key}-chunk-{i + 1}.mp3"
-            upload_to_r2(str(chunk_file), chunk_key, r2_config)
-            chunk_keys.append(chunk_key)
-            
-            # Construct public URL - ensure it has https:// protocol
-            if r2_config['public_url']:
-                public_url = r2_config['public_url'].rstrip('/')
-                # Add https:// if missing
-                if not public_url.startswith('http://') and not public_url.startswith('https://'):
-                    public_url = f"https://{public_url}"
-                chunk_url = f"{public_url}/{chunk_key.lstrip('/')}"
-            else:
-                chunk_url = f"https://pub-{r2_config['account_id']}.r2.dev/{r2_config['bucket_name']}/{chunk_key.lstrip('/')}"
-            chunk_paths.append(chunk_url)
+        chunk_keys = upload_many(
+            [(str(chunk_file), f"{base_key}-chunk-{i + 1}.mp3", 'audio/mpeg') for i, chunk_file in enumerate(chunk_files)],
+            r2_config, max_workers=io_parallelism
+        )
+        chunk_paths = [public_url_for(chunk_key, r2_config) for chunk_key in chunk_keys]
+        timings['upload_s'] = _elapsed(stage_start)
+        timings['total_s'] = _elapsed(job_start)
         
         print(f"Audio splitting completed successfully: {len(chunk_paths)} chunks")
         
@@ -389,10 +640,323 @@ def split_audio_handler(input_data, r2_config):
             'status': 'COMPLETED',
             'output': {
                 'chunk_urls': chunk_paths,
-                'chunk_keys': chunk_keys
+                'chunk_keys': chunk_keys,
+                'timings': timings
             }
         }
 
+def analyse_chunks(chunk_sources, max_workers, durations=None):
+    """Probe every chunk (local paths or URLs) and plan the concat"""
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(chunk_sources)))) as pool:
+        chunk_params = list(pool.map(in_context(probe_video_params), chunk_sources))
+    plan = plan_stitch(chunk_params, durations)
+    print(f"Stitch plan: {plan['strategy']}, re-encoding chunks {plan['reencode_chunks']}")
+    return plan
+
+def stitch_audio_track(plan, audio_source, tmpdir_path, profile, normalize_audio, source_id=None):
+    """Prepare the final audio track for a stitch and record how it was made in the plan; returns the track"""
+    audio_track, audio_info = prepare_audio(audio_source, tmpdir_path / "audio.m4a", profile, normalize_audio, source_id)
+    plan['audio'] = audio_info['audio']
+    plan['loudness'] = audio_info['loudness']
+    return audio_track
+
+def normalize_chunks(plan, chunk_paths, tmpdir_path, profile=None, durations=None):
+    """Re-encode the chunks the plan marked as mismatching (to their target durations, if given); returns the chunk paths to concat"""
+    profile = profile or get_profile()
+    chunk_paths = list(chunk_paths)
+    for i in plan['reencode_chunks']:
+        normalized = tmpdir_path / f"chunk_{i}_normalized.mp4"
+        duration = durations[i] if durations else None
+        # Retried or repeated stitches find the re-encoded chunk in the asset store
+        settings = json.dumps([plan['reference'], profile, duration], sort_keys=True)
+        store_key = f"normalized/{content_hash(chunk_paths[i])}/{hashlib.sha256(settings.encode()).hexdigest()[:16]}"
+        
+        def encode(dst, src=chunk_paths[i], duration=duration):
+            with cpu_slot():
+                normalize_chunk(src, dst, plan['reference'], profile, duration)
+        
+        get_store().cached_file(store_key, normalized, encode)
+        chunk_paths[i] = normalized
+    return chunk_paths
+
+def stitch_rendition_args(renditions, rendition_dir, audio_track, profile):
+    """Arguments that decode the stitched video (input 0) once into every rendition (audio from input 1); [] without renditions"""
+    if not renditions:
+        return []
+    duration = probe(audio_track)['duration']
+    print(f"Writing renditions from the stitched video to {rendition_dir}")
+    return [
+        '-filter_complex', rendition_filters(renditions, '0:v', duration),
+        *rendition_output_args(renditions, rendition_dir, profile, '1:a:0'),
+    ]
+
+def stitch_video_streaming(video_chunks, audio_key, output_key, r2_config, profile, normalize_audio=True, renditions=None):
+    """Stitch mode without local copies: ffmpeg reads chunks from presigned URLs and its output is uploaded as it is written"""
+    timings = {}
+    job_start = time.monotonic()
+    
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir_path = Path(tmpdir)
+        chunk_urls = [presigned_get_url(chunk_key, r2_config) for chunk_key in video_chunks]
+        audio_url = presigned_get_url(audio_key, r2_config)
+        
+        # Probe the chunks over HTTP; only mismatching chunks are fetched and re-encoded locally
+        stage_start = time.monotonic()
+        plan = analyse_chunks(chunk_urls, R2_BULK_WORKERS)
+        timings['analyse_s'] = _elapsed(stage_start)
+        stage_start = time.monotonic()
+        audio_track = stitch_audio_track(
+            plan, audio_url, tmpdir_path, profile, normalize_audio, audio_fingerprint(audio_key, r2_config)
+        )
+        timings['audio_s'] = _elapsed(stage_start)
+        stage_start = time.monotonic()
+        chunk_sources = list(chunk_urls)
+        if plan['reencode_chunks']:
+            local_paths = download_many(
+                [(video_chunks[i], tmpdir_path / f"chunk_{i}.mp4") for i in plan['reencode_chunks']],
+                r2_config
+            )
+            for i, local_path in zip(plan['reencode_chunks'], local_paths):
+                chunk_sources[i] = local_path
+            chunk_sources = normalize_chunks(plan, chunk_sources, tmpdir_path, profile)
+        timings['reencode_s'] = _elapsed(stage_start)
+        
+        # Only the concat list and re-encoded chunks touch the disk
+        concat_file = tmpdir_path / "concat.txt"
+        with open(concat_file, 'w') as f:
+            for source in chunk_sources:
+                f.write(f"file '{source}'\n")
+        
+        print("Streaming video chunks and audio through ffmpeg to R2...")
+        stage_start = time.monotonic()
+        rendition_dir = tmpdir_path / "renditions"
+        output_bytes = ffmpeg_to_r2([
+            # The concat demuxer only opens network URLs when they are whitelisted
+            '-protocol_whitelist', 'file,http,https,tcp,tls,crypto',
+            '-f', 'concat', '-safe', '0',
+            '-i', str(concat_file),
+            '-i', str(audio_track),
+            *stitch_rendition_args(renditions, rendition_dir, audio_track, profile),
+            '-c:v', 'copy',
+            '-c:a', 'copy',
+            '-map', '0:v:0',
+            '-map', '1:a:0',
+        ], output_key, r2_config, content_type='video/mp4')
+        timings['stream_s'] = _elapsed(stage_start)
+        output = {}
+        if renditions:
+            stage_start = time.monotonic()
+            upload_many(rendition_uploads(renditions, rendition_dir, output_key), r2_config)
+            output['renditions'] = describe_renditions(renditions, rendition_dir, output_key, r2_config)
+            timings['upload_s'] = _elapsed(stage_start)
+        timings['total_s'] = _elapsed(job_start)
+    
+    public_url = public_url_for(output_key, r2_config)
+    print(f"Video stitching completed successfully: {public_url} ({output_bytes} bytes)")
+    
+    return {
+        'status': 'COMPLETED',
+        'output': {
+            'video_url': public_url,
+            'output_key': output_key,
+            'stitch_plan': plan,
+            'encoder_profile': profile['name'],
+            **output,
+            'timings': timings
+        }
+    }
+
+def stitch_local(chunk_paths, audio_path, final_video, tmpdir_path, timings, profile=None, max_workers=R2_BULK_WORKERS, durations=None,
+                 normalize_audio=True, renditions=None, rendition_dir=None):
+    """Concat local chunks (re-encoding only mismatching ones) and merge the full audio into final_video; returns the stitch plan.
+    
+    durations optionally gives the length every chunk must have to stay in sync with the audio.
+    The renditions spec's files are written to rendition_dir by the merge run.
+    """
+    profile = profile or get_profile()
+    # Stream copy only works when every chunk shares codec parameters;
+    # otherwise bring just the odd ones out in line with the rest
+    stage_start = time.monotonic()
+    plan = analyse_chunks(chunk_paths, max_workers, durations)
+    timings['analyse_s'] = _elapsed(stage_start)
+    stage_start = time.monotonic()
+    audio_track = stitch_audio_track(plan, audio_path, tmpdir_path, profile, normalize_audio)
+    timings['audio_s'] = _elapsed(stage_start)
+    stage_start = time.monotonic()
+    chunk_paths = normalize_chunks(plan, chunk_paths, tmpdir_path, profile, durations)
+    timings['reencode_s'] = _elapsed(stage_start)
+    
+    # Create concat file for ffmpeg, in the order the chunks were given
+    concat_file = tmpdir_path / "concat.txt"
+    with open(concat_file, 'w') as f:
+        for chunk_path in chunk_paths:
+            # Use absolute path and escape single quotes
+            abs_path = chunk_path.resolve()
+            f.write(f"file '{abs_path}'\n")
+    
+    # Step 1: Concatenate video chunks
+    print("Concatenating video chunks...")
+    stage_start = time.monotonic()
+    temp_video = tmpdir_path / "temp_video.mp4"
+    traced_run([
+        'ffmpeg', '-f', 'concat', '-safe', '0',
+        '-i', str(concat_file),
+        '-c', 'copy',
+        # Chunk audio is replaced by the full track below
+        '-an',
+        '-y', str(temp_video)
+    ], capture_output=True, text=True, check=True)
+    print("Video concatenation completed")
+    timings['concat_s'] = _elapsed(stage_start)
+    
+    # Step 2: Merge video with audio
+    print("Merging video with audio...")
+    stage_start = time.monotonic()
+    merge = [
+        'ffmpeg', '-i', str(temp_video),
+        '-i', str(audio_track),
+        *stitch_rendition_args(renditions, rendition_dir, audio_track, profile),
+        '-c:v', 'copy',
+        '-c:a', 'copy',
+        '-map', '0:v:0',
+        '-map', '1:a:0',
+        '-y', str(final_video)
+    ]
+    if renditions:
+        # The main output is still copied, but the renditions are encodes
+        with cpu_slot():
+            traced_run(merge, capture_output=True, text=True, check=True)
+    else:
+        traced_run(merge, capture_output=True, text=True, check=True)
+    print("Video and audio merge completed")
+    timings['merge_s'] = _elapsed(stage_start)
+    return plan
+
+def stitch_video_handler(input_data, r2_config):
+    """Handle video stitching mode: concat R2 video chunks and merge with the full audio"""
+    video_chunks = input_data['video_chunks']  # Array of R2 keys
+    audio_key = input_data['audio_key']
+    output_key = input_data['output_key']
+    io_parallelism = int(input_data.get('io_parallelism', R2_BULK_WORKERS))
+    io_mode = input_data.get('io_mode', 'tempdir')
+    normalize_audio = input_data.get('normalize_audio', True)
+    renditions = parse_renditions(input_data)
+    profile = get_profile(input_data.get('encoder_profile'), input_data.get('encoder_overrides'))
+    
+    print(f"Starting video stitching: {len(video_chunks)} chunks")
+    print(f"Audio key: {audio_key}")
+    print(f"Output key: {output_key}")
+    timings = {}
+    job_start = time.monotonic()
+    
+    if io_mode == 'streaming':
+        return stitch_video_streaming(video_chunks, audio_key, output_key, r2_config, profile, normalize_audio, renditions)
+    if io_mode != 'tempdir':
+        raise ValueError(f"Unknown io_mode: {io_mode}")
+    
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir_path = Path(tmpdir)
+        
+        # Download all video chunks and the audio concurrently
+        print(f"Downloading {len(video_chunks)} video chunks and audio ({io_parallelism} parallel)...")
+        stage_start = time.monotonic()
+        chunk_paths = [tmpdir_path / f"chunk_{i}.mp4" for i in range(len(video_chunks))]
+        audio_path = tmpdir_path / "audio.mp3"
+        download_many(
+            list(zip(video_chunks, chunk_paths)) + [(audio_key, audio_path)],
+            r2_config, max_workers=io_parallelism
+        )
+        timings['download_s'] = _elapsed(stage_start)
+        
+        final_video = tmpdir_path / "final.mp4"
+        rendition_dir = tmpdir_path / "renditions"
+        plan = stitch_local(
+            chunk_paths, audio_path, final_video, tmpdir_path, timings, profile, io_parallelism,
+            normalize_audio=normalize_audio, renditions=renditions, rendition_dir=rendition_dir
+        )
+        
+        # Upload final video (and renditions) to R2 concurrently
+        print(f"Uploading final video to R2: {output_key}")
+        stage_start = time.monotonic()
+        uploads = [(str(final_video), output_key, 'video/mp4')]
+        if renditions:
+            uploads += rendition_uploads(renditions, rendition_dir, output_key)
+        upload_many(uploads, r2_config, max_workers=io_parallelism)
+        timings['upload_s'] = _elapsed(stage_start)
+        timings['total_s'] = _elapsed(job_start)
+        
+        public_url = public_url_for(output_key, r2_config)
+        print(f"Video stitching completed successfully: {public_url}")
+        
+        output = {
+            'video_url': public_url,
+            'output_key': output_key,
+            'stitch_plan': plan,
+            'encoder_profile': profile['name'],
+            'timings': timings
+        }
+        if renditions:
+            output['renditions'] = describe_renditions(renditions, rendition_dir, output_key, r2_config)
+        
+        # Return success
+        return {
+            'status': 'COMPLETED',
+            'output': output
+        }
+
+def batch_handler(input_data):
+    """Handle batch mode: run many job inputs in this worker, sharing R2 clients, the Replicate model version and the hero cache"""
+    jobs = input_data.get('jobs')
+    if not isinstance(jobs, list) or not jobs:
+        raise ValueError("Batch mode needs a non-empty 'jobs' list")
+    # Top-level fields (R2 credentials, Replicate token, ...) are defaults for every item
+    shared = {key: value for key, value in input_data.items() if key not in ('mode', 'jobs', 'batch_concurrency')}
+    concurrency = max(1, min(int(input_data.get('batch_concurrency', BATCH_CONCURRENCY)), len(jobs)))
+    
+    print(f"Starting batch: {len(jobs)} jobs ({concurrency} concurrent)")
+    job_start = time.monotonic()
+    
+    # Resolve the model version once instead of racing a lookup from every item
+    generate_items = [
+        {**shared, **item} for item in jobs
+        if isinstance(item, dict) and item.get('mode') in ('generate_and_stitch', 'generate_all_chunks')
+    ]
+    if generate_items and generate_items[0].get('replicate_api_token'):
+        try:
+            get_model_version_sync(generate_items[0]['replicate_api_token'], api_base=generate_items[0].get('replicate_api_base'))
+        except Exception as e:
+            # Items will retry the lookup themselves and report their own errors
+            print(f"Warning: Could not resolve Replicate model version: {e}")
+    
+    def run_item(index):
+        item = jobs[index]
+        item_start = time.monotonic()
+        if not isinstance(item, dict):
+            result = {'status': 'FAILED', 'error': "Batch item must be an object"}
+        elif item.get('mode') == 'batch':
+            result = {'status': 'FAILED', 'error': "Batch items cannot be batches"}
+        else:
+            # handler() never raises; failures come back as FAILED results
+            result = handler({'input': {**shared, **item}})
+        return {'index': index, **result, 'duration_s': _elapsed(item_start)}
+    
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(run_item, range(len(jobs))))
+    
+    completed = sum(1 for result in results if result['status'] == 'COMPLETED')
+    total_s = _elapsed(job_start)
+    print(f"Batch completed: {completed}/{len(jobs)} succeeded in {total_s}s")
+    
+    return {
+        'status': 'COMPLETED',
+        'output': {
+            'results': results,
+            'completed': completed,
+            'failed': len(jobs) - completed,
+            'timings': {'total_s': total_s}
+        }
+    }
+
 def handler(event):
     """Main handler function"""
     try:
@@ -430,97 +994,39 @@ def handler(event):
             'access_key_id': r2_access_key_id,
             'secret_access_key': r2_secret_access_key,
             'bucket_name': r2_bucket_name,
-            'public_url': input_data.get('r2_public_url', '')
+            'public_url': input_data.get('r2_public_url', ''),
+            # Optional S3-compatible endpoint override (e.g. MinIO or moto for local runs)
+            'endpoint_url': input_data.get('r2_endpoint_url')
         }
         
-        # Handle different modes
-        if mode == 'generate_and_stitch':
-            return generate_and_stitch_handler(input_data, r2_config)
-        elif mode == 'split_audio':
-            return split_audio_handler(input_data, r2_config)
-        
-        # Default: video stitching mode
-        video_chunks = input_data['video_chunks']  # Array of R2 keys
-        audio_key = input_data['audio_key']
-        output_key = input_data['output_key']
-        
-        print(f"Starting video stitching: {len(video_chunks)} chunks")
-        print(f"Audio key: {audio_key}")
-        print(f"Output key: {output_key}")
+        progress_token = _job_progress.set(event.get('progress'))
+        try:
+            # Record every transfer, HTTP call and ffmpeg run of the job as a span
+            with start_trace(progress=input_data.get('ffmpeg_progress', False)) as trace:
+                # Handle different modes
+                if mode == 'generate_and_stitch':
+                    result = generate_and_stitch_handler(input_data, r2_config)
+                elif mode == 'generate_all_chunks':
+                    result = generate_all_chunks_handler(input_data, r2_config)
+                elif mode == 'split_audio':
+                    result = split_audio_handler(input_data, r2_config)
+                elif mode == 'batch':
+                    result = batch_handler(input_data)
+                else:
+                    # Default: video stitching mode
+                    result = stitch_video_handler(input_data, r2_config)
+        finally:
+            _job_progress.reset(progress_token)
         
-        with tempfile.TemporaryDirectory() as tmpdir:
-            tmpdir_path = Path(tmpdir)
-            
-            # Download all video chunks
-            print("Downloading video chunks...")
-            chunk_paths = []
-            for i, chunk_key in enumerate(video_chunks):
-                chunk_path = tmpdir_path / f"chunk_{i}.mp4"
-                download_from_r2(chunk_key, str(chunk_path), r2_config)
-                chunk_paths.append(chunk_path)
-            
-            # Download audio
-            print("Downloading audio...")
-            audio_path = tmpdir_path / "audio.mp3"
-            download_from_r2(audio_key, str(audio_path), r2_config)
-            
-            # Create concat file for ffmpeg
-            concat_file = tmpdir_path / "concat.txt"
-            with open(concat_file, 'w') as f:
-                for chunk_path in chunk_paths:
-                    # Use absolute path and escape single quotes
-                    abs_path = chunk_path.resolve()
-                    f.write(f"file '{abs_path}'\n")
-            
-            # Step 1: Concatenate video chunks
-            print("Concatenating video chunks...")
-            temp_video = tmpdir_path / "temp_video.mp4"
-            result = subprocess.run([
-                'ffmpeg', '-f', 'concat', '-safe', '0',
-                '-i', str(concat_file),
-                '-c', 'copy',
-                '-y', str(temp_video)
-            ], capture_output=True, text=True, check=True)
-            print("Video concatenation completed")
-            
-            # Step 2: Merge video with audio
-            print("Merging video with audio...")
-            final_video = tmpdir_path / "final.mp4"
-            result = subprocess.run([
-                'ffmpeg', '-i', str(temp_video),
-                '-i', str(audio_path),
-                '-c:v', 'copy',
-                '-c:a', 'aac',
-                '-map', '0:v:0',
-                '-map', '1:a:0',
-                '-y', str(final_video)
-            ], capture_output=True, text=True, check=True)
-            print("Video and audio merge completed")
-            
-            # Upload final video to R2
-            print(f"Uploading final video to R2: {output_key}")
-            upload_to_r2(str(final_video), output_key, r2_config)
-            
-            # Construct public URL - ensure it has https:// protocol
-            if r2_config['public_url']:
-                base_url = r2_config['public_url'].rstrip('/')
-                # Add https:// if missing
-                if not base_url.startswith('http://') and not base_url.startswith('https://'):
-                    base_url = f"https://{base_url}"
-                public_url = f"{base_url}/{output_key.lstrip('/')}"
-            else:
-                public_url = f"https://pub-{r2_config['account_id']}.r2.dev/{r2_config['bucket_name']}/{output_key.lstrip('/')}"
-            
-            print(f"Video stitching completed successfully: {public_url}")
-            
-            # Return success
-            return {
-                'status': 'COMPLETED',
-                'output': {
-                    'video_url': public_url,
-                    'output_key': output_key
-                }
+        if result.get('status') == 'COMPLETED':
+            metrics = trace.metrics()
+            result['output']['metrics'] = metrics
+            result['output']['asset_store'] = {
+                'hits': metrics['counters'].get('asset_store.hit', 0),
+                'misses': metrics['counters'].get('asset_store.miss', 0),
+                **get_store().stats()
             }
+        return result
     except subprocess.CalledProcessError as e:
         error_msg = f"ffmpeg error: {e.stderr}"
         print(f"ERROR: {error_msg}")
@@ -547,7 +1053,11 @@ def runpod_handler(job):
         # Process using our handler function
         # The handler expects event format: {'input': {...}}
         event = {'input': job_input}
-        result = handler(event)
+        if USE_RUNPOD_SDK:
+            import runpod
+            # Lets the job report partial results, e.g. the HLS playlist once its first segment is up
+            event['progress'] = lambda update: runpod.serverless.progress_update(job, update)
+        result = with_worker_timings(handler(event))
         
         # RunPod SDK expects the result to be returned directly
         # If result has 'output', return that, otherwise return the whole result
@@ -563,11 +1073,36 @@ def runpod_handler(job):
             'error': error_msg
         }
 
+def with_worker_timings(result):
+    """Add the worker's start-up timings (ready, prewarm, first job completion) to a completed job's output"""
+    if isinstance(result, dict) and result.get('status') == 'COMPLETED':
+        result['output']['worker'] = job_completed()
+    return result
+
+# Jobs run on their own threads; the SDK's event loop only hands them out and collects results
+_job_executor = ThreadPoolExecutor(max_workers=WORKER_CONCURRENCY, thread_name_prefix='job')
+
+async def async_runpod_handler(job):
+    """Async RunPod handler: runs the job on the worker's job pool so the SDK can take more jobs meanwhile"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_job_executor, runpod_handler, job)
+
+def concurrency_modifier(current_concurrency):
+    """Tell the RunPod SDK how many jobs this worker takes at once"""
+    return WORKER_CONCURRENCY
+
 if __name__ == '__main__':
+    # Warm clients, connections, the hero and the model version while the SDK starts and the first job arrives
+    start_prewarm()
     if USE_RUNPOD_SDK:
         # Use RunPod SDK (recommended for Serverless)
-        print("Starting RunPod serverless worker with SDK...")
-        runpod.serverless.start({"handler": runpod_handler})
+        import runpod
+        print(f"Starting RunPod serverless worker with SDK ({WORKER_CONCURRENCY} concurrent jobs)...")
+        mark_ready()
+        runpod.serverless.start({
+            "handler": async_runpod_handler,
+            "concurrency_modifier": concurrency_modifier
+        })
     else:
         # Fallback: stdin/stdout mode (for testing or non-SDK environments)
         try:
@@ -576,7 +1111,8 @@ if __name__ == '__main__':
             event = json.loads(input_json)
             
             # Process the event
-            result = handler(event)
+            mark_ready()
+            result = with_worker_timings(handler(event))
             
             # Output result to stdout (RunPod reads from stdout)
             print(json.dumps(result))
@@ -0,0 +1,187 @@
+"""Cached hero sources, looped masters and pre-cut tails, kept in the worker's asset store.
+
+The hero video is the same for almost every generate_and_stitch job, so instead
+of concat-looping and trimming it with two full re-encodes per job we encode a
+long looped "master" once per hero version and cut tails out of it with
+smart_cut: whole GOPs are stream-copied and only the last, partial GOP (at most
+HERO_GOP_SECONDS) is re-encoded, so tails are frame-accurate.
+
+Entries live in asset_store under hero/{key}/source, hero/{key}/master (with
+the master length and source probe as metadata) and
+hero/{key}/tail/{master seconds}s/{frames}f, where key comes from the hero URL
+and its ETag.
+"""
+import hashlib
+import math
+import os
+import threading
+import time
+from pathlib import Path
+
+import requests
+
+from asset_store import get_store
+from cpu_slots import cpu_slot
+from http_fetch import fetch, head
+from media_probe import probe_video
+from smart_cut import smart_cut_video
+from tracing import traced_run
+
+# Length of the pre-encoded looped master; longer tails trigger a rebuild
+HERO_MASTER_SECONDS = int(os.environ.get('HERO_MASTER_SECONDS', 180))
+# Keyframe interval of the master, which bounds how much of a tail is re-encoded
+HERO_GOP_SECONDS = 1
+# Encoder settings of the master; tails re-encode their last GOP with the same ones
+MASTER_VIDEO_ARGS = ['-c:v', 'libx264', '-preset', 'medium', '-crf', '23']
+
+_locks = {}
+_locks_guard = threading.Lock()
+
+
+def _lock_for(key):
+    with _locks_guard:
+        return _locks.setdefault(key, threading.Lock())
+
+
+def _sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hero_cache_key(video_url):
+    """Return the cache key for a hero URL, based on its ETag when available.
+
+    Returns None if the server exposes no validator, in which case the caller
+    falls back to hashing the downloaded content.
+    """
+    try:
+        response = head(video_url)
+    except requests.RequestException as e:
+        print(f"Warning: HEAD {video_url} failed ({e}), falling back to content hash")
+        return None
+    validator = response.headers.get('ETag')
+    if not validator and response.headers.get('Last-Modified'):
+        validator = f"{response.headers['Last-Modified']}|{response.headers.get('Content-Length', '')}"
+    if not validator:
+        return None
+    return hashlib.sha256(f"{video_url}\n{validator}".encode()).hexdigest()[:32]
+
+
+def _build_master(source_path, master_path, seconds, source_info):
+    """Encode a looped, keyframe-aligned master of at least `seconds` length"""
+    loops = max(1, math.ceil(seconds / source_info['duration']))
+    gop_frames = max(1, round(source_info['fps'] * HERO_GOP_SECONDS))
+    tmp_path = master_path.with_suffix('.part.mp4')
+    print(f"Encoding looped hero master: {seconds}s ({loops} loops, GOP {gop_frames} frames)")
+    with cpu_slot():
+        traced_run([
+            'ffmpeg', '-stream_loop', str(loops - 1),
+            '-i', str(source_path),
+            '-t', str(seconds),
+            '-an',
+            *MASTER_VIDEO_ARGS,
+            '-pix_fmt', 'yuv420p',
+            '-r', source_info['r_frame_rate'],
+            '-g', str(gop_frames),
+            '-keyint_min', str(gop_frames),
+            '-sc_threshold', '0',
+            '-force_key_frames', f"expr:gte(t,n_forced*{HERO_GOP_SECONDS})",
+            '-video_track_timescale', str(source_info['timescale']),
+            '-y', str(tmp_path)
+        ], capture_output=True, text=True, check=True)
+    os.replace(tmp_path, master_path)
+
+
+def _scratch_path(local_path, name):
+    """A job-local path next to local_path for intermediate hero files"""
+    local_path = Path(local_path)
+    return local_path.with_name(f"{local_path.stem}-{name}")
+
+
+def _ensure_source(video_url, local_path):
+    """Place the hero source at local_path, downloading it on a store miss; returns the hero's key"""
+    store = get_store()
+    key = hero_cache_key(video_url)
+    if key is None:
+        # No validator from the server: address the entry by content instead
+        fetch(video_url, local_path)
+        key = _sha256_file(local_path)[:32]
+        store.put(f"hero/{key}/source", local_path, {'video_url': video_url})
+        return key
+    with _lock_for(key):
+        if store.cached_file(f"hero/{key}/source", local_path, lambda dst: fetch(video_url, dst), {'video_url': video_url}):
+            print(f"Hero source ready: {key}")
+        else:
+            print(f"Hero cache miss, downloaded {video_url}")
+    return key
+
+
+def _master_seconds(min_seconds):
+    return max(HERO_MASTER_SECONDS, math.ceil(min_seconds / HERO_GOP_SECONDS) * HERO_GOP_SECONDS)
+
+
+def _ensure_master(video_url, local_path, min_seconds):
+    """Return (key, master path, master meta) with a master at least min_seconds long at a path next to local_path"""
+    store = get_store()
+    source_path = _scratch_path(local_path, 'hero-source.mp4')
+    master_path = _scratch_path(local_path, 'hero-master.mp4')
+    key = _ensure_source(video_url, source_path)
+    needed = _master_seconds(min_seconds)
+    master_key = f"hero/{key}/master"
+    with _lock_for(key):
+        meta = store.meta(master_key)
+        if meta is not None and meta['master_seconds'] >= needed and store.get(master_key, master_path) is not None:
+            print(f"Hero cache hit: {key}")
+        else:
+            source_info = probe_video(source_path)
+            _build_master(source_path, master_path, needed, source_info)
+            meta = {
+                'video_url': video_url,
+                'master_seconds': needed,
+                'source': source_info,
+                'created_at': time.time(),
+            }
+            store.put(master_key, master_path, meta)
+    return key, master_path, meta
+
+
+def get_hero_source(video_url, local_path):
+    """Place the (cached) original hero video at local_path"""
+    _ensure_source(video_url, local_path)
+    return local_path
+
+
+def get_hero_master(video_url, local_path):
+    """Make sure the hero source and its looped master are in the store (master linked at a path next to local_path); returns the master's metadata"""
+    _, _, meta = _ensure_master(video_url, local_path, HERO_MASTER_SECONDS)
+    return meta
+
+
+def get_hero_tail(video_url, duration, local_path):
+    """Place a looped hero clip of exactly `duration` seconds (to the frame) at local_path"""
+    store = get_store()
+    key = hero_cache_key(video_url)
+    meta = store.meta(f"hero/{key}/master") if key is not None else None
+    if meta is None or meta['master_seconds'] < _master_seconds(math.ceil(duration)):
+        key, master_path, meta = _ensure_master(video_url, local_path, math.ceil(duration))
+    else:
+        # A pre-cut tail does not need the master itself
+        master_path = None
+    frames = max(1, round(duration * meta['source']['fps']))
+    tail_key = f"hero/{key}/tail/{meta['master_seconds']}s/{frames}f"
+
+    def cut_tail(dst):
+        source = master_path
+        if source is None:
+            _, source, _ = _ensure_master(video_url, local_path, math.ceil(duration))
+        smart_cut_video(source, dst, duration, MASTER_VIDEO_ARGS)
+
+    with _lock_for(tail_key):
+        if store.cached_file(tail_key, local_path, cut_tail):
+            print(f"Using pre-cut {frames} frame hero tail")
+        else:
+            print(f"Cut {duration:.3f}s ({frames} frame) hero tail from cached master")
+    return local_path
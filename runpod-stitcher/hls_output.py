@@ -0,0 +1,136 @@
+"""Progressive HLS output: fMP4 segments published to R2 while ffmpeg is still encoding.
+
+ffmpeg's hls muxer writes init.mp4, numbered .m4s segments and an EVENT
+playlist into a local directory. With the `temp_file` flag every file only
+appears under its final name once it is complete, so a watcher can upload each
+new segment as it shows up and then the playlist that lists it: the playlist in
+R2 never references a segment that is not there yet. The composed video is
+encoded in order, so the lip-synced first chunk is playable while the hero tail
+is still being encoded. The final playlist carries #EXT-X-ENDLIST.
+
+Segments never change once written and are uploaded with a long-lived
+Cache-Control; the playlist is revalidated by players and CDNs until it is final.
+"""
+import os
+import time
+from pathlib import Path
+
+from cpu_slots import cpu_slot
+from r2 import public_url_for, upload_to_r2
+from tracing import FfmpegProcess, span
+
+# Target segment length; segments are cut on keyframes, so this also caps the GOP
+HLS_SEGMENT_SECONDS = float(os.environ.get('HLS_SEGMENT_SECONDS', 2))
+# How often the segment directory is checked for finished files while ffmpeg runs
+HLS_POLL_INTERVAL = 0.25
+
+PLAYLIST_NAME = 'index.m3u8'
+INIT_NAME = 'init.mp4'
+
+SEGMENT_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+LIVE_PLAYLIST_CACHE_CONTROL = 'no-cache'
+FINAL_PLAYLIST_CACHE_CONTROL = 'public, max-age=3600'
+
+
+def hls_muxer_args(segment_dir, segment_seconds=HLS_SEGMENT_SECONDS):
+    """ffmpeg output arguments writing fMP4 HLS into segment_dir"""
+    return [
+        # Keyframe every segment_seconds so segments come out at the target length
+        '-force_key_frames', f"expr:gte(t,n_forced*{segment_seconds})",
+        '-f', 'hls',
+        '-hls_time', str(segment_seconds),
+        '-hls_segment_type', 'fmp4',
+        '-hls_playlist_type', 'event',
+        '-hls_fmp4_init_filename', INIT_NAME,
+        '-hls_segment_filename', str(Path(segment_dir) / 'seg_%05d.m4s'),
+        '-hls_flags', 'independent_segments+temp_file',
+        '-y', str(Path(segment_dir) / PLAYLIST_NAME)
+    ]
+
+
+def _playlist_files(playlist):
+    """Files a playlist references, init segment first"""
+    files = []
+    for line in playlist.splitlines():
+        line = line.strip()
+        if line.startswith('#EXT-X-MAP:'):
+            files.append(line.split('URI="', 1)[1].split('"', 1)[0])
+        elif line and not line.startswith('#'):
+            files.append(line)
+    return files
+
+
+class _Publisher:
+    """Uploads the segments a local playlist lists, then the playlist itself"""
+
+    def __init__(self, segment_dir, prefix, r2_config, on_first_segment=None):
+        self.segment_dir = Path(segment_dir)
+        self.prefix = prefix.rstrip('/')
+        self.r2_config = r2_config
+        self.on_first_segment = on_first_segment
+        self.uploaded = set()
+        self.segments = 0
+        self.bytes = 0
+        self.started_at = time.monotonic()
+        self.first_segment_s = None
+
+    @property
+    def playlist_key(self):
+        return f"{self.prefix}/{PLAYLIST_NAME}"
+
+    def sync(self):
+        """Publish whatever ffmpeg has finished since the last call"""
+        playlist_path = self.segment_dir / PLAYLIST_NAME
+        if not playlist_path.exists():
+            return
+        # Read once: ffmpeg may replace the file while we upload
+        playlist = playlist_path.read_text()
+        new_files = [name for name in _playlist_files(playlist) if name not in self.uploaded]
+        if not new_files:
+            return
+        for name in new_files:
+            path = self.segment_dir / name
+            content_type = 'video/mp4' if name == INIT_NAME else 'video/iso.segment'
+            upload_to_r2(str(path), f"{self.prefix}/{name}", self.r2_config, content_type, SEGMENT_CACHE_CONTROL)
+            self.uploaded.add(name)
+            self.bytes += path.stat().st_size
+            if name != INIT_NAME:
+                self.segments += 1
+        final = '#EXT-X-ENDLIST' in playlist
+        snapshot = self.segment_dir / f"published_{PLAYLIST_NAME}"
+        snapshot.write_text(playlist)
+        upload_to_r2(
+            str(snapshot), self.playlist_key, self.r2_config, 'application/vnd.apple.mpegurl',
+            FINAL_PLAYLIST_CACHE_CONTROL if final else LIVE_PLAYLIST_CACHE_CONTROL
+        )
+        if self.first_segment_s is None and self.segments:
+            self.first_segment_s = round(time.monotonic() - self.started_at, 3)
+            print(f"First HLS segment published after {self.first_segment_s}s")
+            if self.on_first_segment is not None:
+                self.on_first_segment(public_url_for(self.playlist_key, self.r2_config))
+
+
+def ffmpeg_to_hls(ffmpeg_args, prefix, r2_config, segment_dir, on_first_segment=None):
+    """Run ffmpeg with HLS output and publish segments under prefix in R2 as they are written.
+
+    on_first_segment(playlist_url) is called once the playlist lists a segment.
+    Returns playlist key, segment count, bytes uploaded and seconds to the first segment.
+    """
+    Path(segment_dir).mkdir(parents=True, exist_ok=True)
+    publisher = _Publisher(segment_dir, prefix, r2_config, on_first_segment)
+    command = ['ffmpeg', *ffmpeg_args, *hls_muxer_args(segment_dir)]
+    with cpu_slot(), span('ffmpeg', file=publisher.playlist_key) as record:
+        with FfmpegProcess(command, record) as ffmpeg:
+            while ffmpeg.process.poll() is None:
+                publisher.sync()
+                time.sleep(HLS_POLL_INTERVAL)
+        # The last segments and the #EXT-X-ENDLIST playlist
+        publisher.sync()
+        record['bytes'] = publisher.bytes
+    print(f"Published HLS: {publisher.playlist_key} ({publisher.segments} segments, {publisher.bytes} bytes)")
+    return {
+        'playlist_key': publisher.playlist_key,
+        'segments': publisher.segments,
+        'bytes': publisher.bytes,
+        'first_segment_s': publisher.first_segment_s,
+    }
@@ -0,0 +1,242 @@
+"""Shared HTTP downloads (Replicate outputs, the hero video).
+
+All requests go through one pooled requests.Session, so a warm worker keeps
+its connections to the Replicate CDN and the hero host open between files and
+jobs. fetch() writes in 1 MiB blocks and checks the server's Content-Length.
+Files of at least HTTP_PARALLEL_THRESHOLD_MB from servers that accept Range
+requests are fetched as parallel segments. A connection that drops mid-body
+is resumed from the last byte received (Range) instead of starting over;
+servers without Range support send the file again from the start.
+
+open_pipe() streams a URL into an os.pipe() so ffmpeg can start reading
+(`-i pipe:N` with pass_fds) as soon as the first bytes arrive. That only suits
+inputs ffmpeg can read front to back: MP3, fragmented or faststart MP4
+(moov_first() checks the last).
+"""
+import os
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from tracing import in_context, span
+
+MB = 1024 * 1024
+
+# Size of each read/write; large blocks keep the Python loop out of the way
+HTTP_CHUNK_SIZE = int(os.environ.get('HTTP_CHUNK_SIZE_KB', 1024)) * 1024
+# Files at least this large are fetched as parallel Range segments
+HTTP_PARALLEL_THRESHOLD = int(os.environ.get('HTTP_PARALLEL_THRESHOLD_MB', 16)) * MB
+HTTP_SEGMENT_SIZE = int(os.environ.get('HTTP_SEGMENT_SIZE_MB', 8)) * MB
+HTTP_FETCH_WORKERS = int(os.environ.get('HTTP_FETCH_WORKERS', 4))
+# Attempts per segment; each one resumes where the last stopped
+HTTP_RETRY_ATTEMPTS = int(os.environ.get('HTTP_RETRY_ATTEMPTS', 5))
+HTTP_RETRY_BASE_DELAY = 0.5
+HTTP_TIMEOUT = (10, 60)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class IncompleteDownload(ValueError):
+    """The server sent fewer (or more) bytes than it announced"""
+
+
+def get_session():
+    """Return the worker's pooled requests.Session"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32)
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
+
+
+def _retryable(error):
+    if isinstance(error, requests.HTTPError):
+        return error.response is not None and (error.response.status_code >= 500 or error.response.status_code == 429)
+    return isinstance(error, (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError, IncompleteDownload))
+
+
+def head(url, timeout=10):
+    """HEAD a URL on the pooled session, following redirects"""
+    with span('http.head', url=url):
+        response = get_session().head(url, timeout=timeout, allow_redirects=True)
+        response.raise_for_status()
+    return response
+
+
+def _remote_size(url):
+    """(Content-Length or None, whether the server accepts Range requests)"""
+    try:
+        response = head(url)
+    except requests.RequestException as e:
+        print(f"Warning: HEAD {url} failed ({e}), downloading in one stream")
+        return None, False
+    length = response.headers.get('Content-Length')
+    size = int(length) if length and length.isdigit() else None
+    return size, response.headers.get('Accept-Ranges', '').lower() == 'bytes'
+
+
+def _write_range(url, f, start, end, record):
+    """Write bytes start..end (inclusive; end None = to EOF) of url at the same offsets of f, resuming after drops.
+
+    Returns the number of bytes written.
+    """
+    position = start
+    for attempt in range(HTTP_RETRY_ATTEMPTS):
+        headers = {}
+        if position > 0 or end is not None:
+            headers['Range'] = f"bytes={position}-{'' if end is None else end}"
+        try:
+            with get_session().get(url, headers=headers, stream=True, timeout=HTTP_TIMEOUT) as response:
+                response.raise_for_status()
+                if headers and response.status_code != 206:
+                    # The whole body instead of the requested range: start a whole-file download over
+                    if start != 0 or end is not None:
+                        raise ValueError(f"{url} ignored a Range request, cannot fetch segments")
+                    print(f"{url} does not support Range, restarting the download from byte 0")
+                    f.truncate(0)
+                    position = 0
+                length = response.headers.get('Content-Length')
+                expected_end = position + int(length) if length and length.isdigit() else None
+                f.seek(position)
+                for block in response.iter_content(chunk_size=HTTP_CHUNK_SIZE):
+                    f.write(block)
+                    position += len(block)
+                if expected_end is not None and position != expected_end:
+                    raise IncompleteDownload(f"{url}: got {position - start} bytes, expected {expected_end - start}")
+            return position - start
+        except Exception as e:
+            if not _retryable(e) or attempt == HTTP_RETRY_ATTEMPTS - 1:
+                raise
+            record['resumes'] = record.get('resumes', 0) + 1
+            delay = HTTP_RETRY_BASE_DELAY * (2 ** attempt)
+            print(f"Download of {url} interrupted at byte {position} ({type(e).__name__}), resuming in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def fetch(url, local_path, max_workers=HTTP_FETCH_WORKERS):
+    """Download url to local_path (atomically, via a .part file) and return local_path.
+
+    Large files from servers that accept Range are fetched in parallel
+    segments; the result is checked against the server's Content-Length.
+    """
+    tmp_path = f"{local_path}.part"
+    try:
+        with span('http.get', url=url) as record:
+            size, accepts_ranges = _remote_size(url)
+            with open(tmp_path, 'wb') as f:
+                if size is not None and accepts_ranges and size >= HTTP_PARALLEL_THRESHOLD:
+                    # Each segment writes its own byte range of the preallocated file
+                    f.truncate(size)
+                    segments = [(start, min(start + HTTP_SEGMENT_SIZE, size) - 1) for start in range(0, size, HTTP_SEGMENT_SIZE)]
+                    record['segments'] = len(segments)
+
+                    def fetch_segment(segment):
+                        # Separate handles so segments do not share a file position
+                        with open(tmp_path, 'r+b') as segment_file:
+                            return _write_range(url, segment_file, segment[0], segment[1], record)
+
+                    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(segments)))) as pool:
+                        written = sum(pool.map(in_context(fetch_segment), segments))
+                else:
+                    written = _write_range(url, f, 0, None, record)
+            if size is not None and written != size:
+                raise IncompleteDownload(f"{url}: downloaded {written} bytes, Content-Length was {size}")
+            record['bytes'] = written
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, local_path)
+    return local_path
+
+
+
+def moov_first(url, probe_bytes=64 * 1024):
+    """Whether the MP4 at url has its index (moov box) before the media data, so it can be read front to back"""
+    data = b''
+    try:
+        with get_session().get(url, headers={'Range': f"bytes=0-{probe_bytes - 1}"}, stream=True, timeout=HTTP_TIMEOUT) as response:
+            response.raise_for_status()
+            # A server that ignores Range sends the whole file; the first probe_bytes are enough
+            for block in response.iter_content(chunk_size=probe_bytes):
+                data += block
+                if len(data) >= probe_bytes:
+                    break
+    except requests.RequestException as e:
+        print(f"Warning: reading the head of {url} failed ({e})")
+        return False
+    position = 0
+    while position + 8 <= len(data):
+        size, box = struct.unpack('>I4s', data[position:position + 8])
+        if box == b'moov':
+            return True
+        if box == b'mdat':
+            return False
+        if size == 1 and position + 16 <= len(data):
+            # 64-bit box size
+            size = struct.unpack('>Q', data[position + 8:position + 16])[0]
+        if size < 8:
+            break
+        position += size
+    # No moov within probe_bytes: treat it as not streamable
+    return False
+
+
+class FetchPipe:
+    """A download streamed into a pipe; pass `fd` to ffmpeg as `input` (pass_fds=(fd,))"""
+
+    def __init__(self, url):
+        self.url = url
+        self.fd, self._write_fd = os.pipe()
+        self.input = f"pipe:{self.fd}"
+        self.error = None
+        self.bytes = 0
+        self._pipe = None
+        self._thread = threading.Thread(target=in_context(self._pump), daemon=True)
+        self._thread.start()
+
+    def _pump(self):
+        try:
+            with span('http.get', url=self.url, pipe=True) as record, os.fdopen(self._write_fd, 'wb') as self._pipe:
+                _write_range(self.url, self, 0, None, record)
+                record['bytes'] = self.bytes
+        except BrokenPipeError:
+            # The reader stopped early (e.g. ffmpeg only needed part of the input, or the job failed)
+            pass
+        except Exception as e:
+            self.error = e
+
+    # _write_range writes through seek()/truncate()/write(); a pipe can only continue where it stopped
+    def seek(self, position):
+        if position != self.bytes:
+            raise ValueError(f"Cannot rewind a pipe to byte {position}")
+
+    def truncate(self, size):
+        if size != self.bytes:
+            raise ValueError(f"Cannot restart {self.url} in a pipe after {self.bytes} bytes")
+
+    def write(self, block):
+        self._pipe.write(block)
+        self.bytes += len(block)
+
+    def close(self):
+        """Close our read end and wait for the download; raises if it failed"""
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self._thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def open_pipe(url):
+    """Start streaming url into a pipe and return the FetchPipe; call close() after ffmpeg exits"""
+    return FetchPipe(url)
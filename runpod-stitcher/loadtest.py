@@ -0,0 +1,360 @@
+"""Offline load test of handler() with a local S3 stand-in and the fake Replicate API.
+
+Starts moto's S3 server (stands in for R2), fake_replicate.py (returns a
+pre-rendered clip after --replicate-delay seconds) and a static HTTP server for
+the hero video, uploads synthetic audio of the given lengths plus matching video
+chunks, then pushes --jobs jobs per mode through handler() with --concurrency
+jobs in flight:
+
+- generate:  generate_and_stitch (result cache off, so every job does the work)
+- split:     split_audio
+- stitch:    stitch_video with 10 second chunks
+
+and reports p50/p95/p99 latency per mode, jobs per core-hour, CPU seconds and
+peak disk / RSS of the worker process and its ffmpeg children. Needs `moto`
+(pip install 'moto[server]'); nothing leaves the machine.
+
+    python loadtest.py --durations 20 45 90 --jobs 8 --concurrency 4 --json load.json
+
+--max-p95 makes the run exit non-zero when any mode's p95 latency exceeds it,
+for use as a CI gate. --cold-starts N also starts N fresh `handler.py`
+processes (stdin mode, empty asset store) with one generate job each and
+reports their ready and first-job-complete times since process start; run with
+PREWARM=0 to compare against a worker without start-up warming.
+"""
+import argparse
+import json
+import math
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+MODES = ('generate', 'split', 'stitch')
+STITCH_CHUNK_SECONDS = 10
+SAMPLE_INTERVAL = 0.2
+
+# Anything containing 'test' is rejected by handler() as dummy credentials
+R2_INPUT = {
+    'r2_account_id': 'local',
+    'r2_access_key_id': 'local',
+    'r2_secret_access_key': 'local',
+    'r2_bucket_name': 'loadrun',
+}
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+def _rss_kb(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def _child_pids(pid):
+    children = []
+    try:
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                children += [int(child) for child in f.read().split()]
+    except OSError:
+        pass
+    return children
+
+
+def _dir_bytes(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class ResourceSampler:
+    """Samples disk use of the scratch directory and RSS of this process plus its children"""
+
+    def __init__(self, scratch_dir):
+        self.scratch_dir = scratch_dir
+        self.peak_disk = 0
+        self.peak_rss_kb = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        pid = os.getpid()
+        while not self._stop.is_set():
+            rss = _rss_kb(pid) + sum(_rss_kb(child) for child in _child_pids(pid))
+            self.peak_rss_kb = max(self.peak_rss_kb, rss)
+            self.peak_disk = max(self.peak_disk, _dir_bytes(self.scratch_dir))
+            self._stop.wait(SAMPLE_INTERVAL)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def _cpu_s():
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage_self.ru_utime + usage_self.ru_stime + usage_children.ru_utime + usage_children.ru_stime
+
+
+def start_services(media_dir, clip, replicate_delay, s3_port):
+    """Start the S3 stand-in, the fake Replicate API and the hero file server"""
+    from moto.server import ThreadedMotoServer
+    from fake_replicate import FakeReplicateServer
+
+    s3 = ThreadedMotoServer(port=s3_port, verbose=False)
+    s3.start()
+    replicate = FakeReplicateServer(str(clip), delay=replicate_delay).start()
+    files = ThreadingHTTPServer(('127.0.0.1', 0), partial(_QuietFileHandler, directory=str(media_dir)))
+    threading.Thread(target=files.serve_forever, daemon=True).start()
+    return s3, replicate, files
+
+
+class _QuietFileHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def prepare_inputs(media_dir, durations, size, fps, r2_config):
+    """Create and upload synthetic audio per duration plus its 10 second video chunks; returns keys per duration"""
+    from benchmark import make_audio, make_video
+    from r2 import upload_many
+
+    chunk_file = make_video(media_dir / 'chunk.mp4', STITCH_CHUNK_SECONDS, size, fps)
+    uploads = [(str(chunk_file), 'load/chunk.mp4', 'video/mp4')]
+    inputs = {}
+    for duration in durations:
+        audio_key = f"load/audio-{duration:g}s.mp3"
+        uploads.append((str(make_audio(media_dir / f"audio-{duration:g}.mp3", duration)), audio_key, 'audio/mpeg'))
+        # The same full chunk repeated, plus a shorter last one so the video matches the audio
+        full_chunks, remainder = divmod(duration, STITCH_CHUNK_SECONDS)
+        video_chunks = ['load/chunk.mp4'] * int(full_chunks)
+        if remainder > 0.01:
+            last_key = f"load/chunk-{remainder:g}s.mp4"
+            uploads.append((str(make_video(media_dir / f"chunk-{remainder:g}.mp4", remainder, size, fps)), last_key, 'video/mp4'))
+            video_chunks.append(last_key)
+        inputs[duration] = {'audio_key': audio_key, 'video_chunks': video_chunks}
+    upload_many(uploads, r2_config)
+    return inputs
+
+
+def job_input(mode, index, duration, keys, base):
+    """The handler input for one job"""
+    output_key = f"load/out/{mode}-{index}.mp4"
+    if mode == 'generate':
+        return {**base, 'mode': 'generate_and_stitch', 'audio_key': keys['audio_key'],
+                'output_key': output_key, 'result_cache': False}
+    if mode == 'split':
+        return {**base, 'mode': 'split_audio', 'audio_key': keys['audio_key'], 'chunk_duration': 25}
+    return {**base, 'mode': 'stitch_video', 'video_chunks': keys['video_chunks'],
+            'audio_key': keys['audio_key'], 'output_key': output_key}
+
+
+def run_cold_starts(count, event, scratch_dir, env):
+    """Run one job in each of `count` fresh handler.py processes; returns their worker timings"""
+    timings = []
+    for i in range(count):
+        store_dir = scratch_dir / f"cold-{i}"
+        process = subprocess.run(
+            [sys.executable, str(Path(__file__).with_name('handler.py'))],
+            input=json.dumps(event), capture_output=True, text=True,
+            env={**os.environ, **env, 'ASSET_STORE_DIR': str(store_dir), 'TMPDIR': str(scratch_dir)}
+        )
+        # The result is the last line of stdout, after the job's logs
+        lines = process.stdout.strip().splitlines()
+        result = json.loads(lines[-1]) if lines else {'status': 'FAILED', 'error': process.stderr[-300:]}
+        if result.get('status') != 'COMPLETED':
+            print(f"Cold start {i} failed: {str(result.get('error', ''))[:300]}", file=sys.stderr)
+            timings.append(None)
+            continue
+        timings.append(result['output']['worker'])
+    return timings
+
+
+def summarize(mode, results):
+    latencies = [r['latency_s'] for r in results if r['status'] == 'COMPLETED']
+    return {
+        'mode': mode,
+        'jobs': len(results),
+        'failed': sum(1 for r in results if r['status'] != 'COMPLETED'),
+        'p50_s': percentile(latencies, 50),
+        'p95_s': percentile(latencies, 95),
+        'p99_s': percentile(latencies, 99),
+        'mean_s': round(sum(latencies) / len(latencies), 3) if latencies else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--durations', type=float, nargs='+', default=[20, 45, 90], help='audio lengths in seconds, cycled over the jobs')
+    parser.add_argument('--jobs', type=int, default=6, help='jobs per mode')
+    parser.add_argument('--concurrency', type=int, default=2, help='jobs in flight at once')
+    parser.add_argument('--modes', nargs='+', default=list(MODES), choices=MODES)
+    parser.add_argument('--replicate-delay', type=float, default=5.0, help='seconds each fake prediction takes')
+    parser.add_argument('--size', default='480x854', help='synthetic video size WxH')
+    parser.add_argument('--fps', type=int, default=25)
+    parser.add_argument('--encoder-profile', default=None, help='encoder profile for every job')
+    parser.add_argument('--s3-port', type=int, default=5077)
+    parser.add_argument('--json', help='also write the report to this file')
+    parser.add_argument('--max-p95', type=float, help='exit with status 1 if any mode has a higher p95 latency (seconds)')
+    parser.add_argument('--cold-starts', type=int, default=0, help='fresh worker processes to time from start to first completed job')
+    args = parser.parse_args()
+
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir_path = Path(tmpdir)
+        media_dir = tmpdir_path / 'media'
+        scratch_dir = tmpdir_path / 'scratch'
+        media_dir.mkdir()
+        scratch_dir.mkdir()
+        # Job temp directories and the asset store land in scratch_dir, which is what peak disk measures
+        tempfile.tempdir = str(scratch_dir)
+        from asset_store import configure_store
+        from benchmark import make_video
+        from cpu_slots import CPU_COUNT
+        import handler
+        from r2 import get_r2_client
+        configure_store(scratch_dir / 'assets')
+
+        print(f"Generating synthetic media ({args.size}@{args.fps}, audio {args.durations})...")
+        clip = make_video(media_dir / 'lipsync.mp4', 25, args.size, args.fps)
+        make_video(media_dir / 'hero.mp4', 8, args.size, args.fps, pattern='testsrc')
+        s3, replicate, files = start_services(media_dir, clip, args.replicate_delay, args.s3_port)
+        endpoint = f"http://127.0.0.1:{args.s3_port}"
+        r2_config = {
+            'account_id': R2_INPUT['r2_account_id'],
+            'access_key_id': R2_INPUT['r2_access_key_id'],
+            'secret_access_key': R2_INPUT['r2_secret_access_key'],
+            'bucket_name': R2_INPUT['r2_bucket_name'],
+            'endpoint_url': endpoint,
+        }
+        try:
+            get_r2_client(r2_config).create_bucket(Bucket=r2_config['bucket_name'])
+            inputs = prepare_inputs(media_dir, args.durations, args.size, args.fps, r2_config)
+            base = {
+                **R2_INPUT,
+                'r2_endpoint_url': endpoint,
+                'r2_public_url': f"{endpoint}/{r2_config['bucket_name']}",
+                'video_url': f"http://127.0.0.1:{files.server_address[1]}/hero.mp4",
+                'replicate_api_token': 'local',
+                'replicate_api_base': replicate.api_base,
+            }
+            if args.encoder_profile:
+                base['encoder_profile'] = args.encoder_profile
+            jobs = [
+                (mode, i, args.durations[i % len(args.durations)])
+                for mode in args.modes for i in range(args.jobs)
+            ]
+
+            def run_job(job):
+                mode, index, duration = job
+                start = time.monotonic()
+                result = handler.handler({'input': job_input(mode, index, duration, inputs[duration], base)})
+                latency = round(time.monotonic() - start, 3)
+                if result['status'] != 'COMPLETED':
+                    print(f"{mode} job {index} failed: {result.get('error', '')[:300]}", file=sys.stderr)
+                return {'mode': mode, 'index': index, 'duration': duration, 'status': result['status'], 'latency_s': latency}
+
+            print(f"Running {len(jobs)} jobs ({args.concurrency} concurrent)...")
+            cpu_start = _cpu_s()
+            start = time.monotonic()
+            with ResourceSampler(scratch_dir) as sampler, ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+                results = list(pool.map(run_job, jobs))
+            wall_s = time.monotonic() - start
+            cpu_s = _cpu_s() - cpu_start
+            
+            cold_starts = []
+            if args.cold_starts:
+                print(f"Running {args.cold_starts} cold starts...")
+                duration = args.durations[0]
+                cold_starts = run_cold_starts(
+                    args.cold_starts,
+                    {'input': job_input('generate', 'cold', duration, inputs[duration], base)},
+                    scratch_dir,
+                    {'PREWARM_HERO_URL': base['video_url'], 'REPLICATE_API_TOKEN': base['replicate_api_token'],
+                     'REPLICATE_API_BASE': replicate.api_base}
+                )
+        finally:
+            files.shutdown()
+            replicate.stop()
+            s3.stop()
+
+    completed = sum(1 for r in results if r['status'] == 'COMPLETED')
+    report = {
+        'modes': [summarize(mode, [r for r in results if r['mode'] == mode]) for mode in args.modes],
+        'jobs': len(results),
+        'completed': completed,
+        'concurrency': args.concurrency,
+        'cores': CPU_COUNT,
+        'wall_s': round(wall_s, 3),
+        'cpu_s': round(cpu_s, 3),
+        # Completed jobs per hour of all the worker's cores
+        'jobs_per_core_hour': round(completed / (wall_s * CPU_COUNT / 3600), 1) if wall_s > 0 else None,
+        'peak_disk_mb': round(sampler.peak_disk / 1024 / 1024, 1),
+        'peak_rss_mb': round(sampler.peak_rss_kb / 1024, 1),
+        'replicate_calls': dict(replicate.calls),
+        'results': results,
+    }
+    if args.cold_starts:
+        finished = [timing for timing in cold_starts if timing is not None]
+        report['cold_start'] = {
+            'runs': len(cold_starts),
+            'failed': len(cold_starts) - len(finished),
+            'ready_p50_s': percentile([timing['ready_s'] for timing in finished], 50),
+            'warm_p50_s': percentile([timing['warm_s'] for timing in finished if timing['warm_s'] is not None], 50),
+            'first_job_complete_p50_s': percentile([timing['first_job_complete_s'] for timing in finished], 50),
+            'first_job_complete_max_s': max((timing['first_job_complete_s'] for timing in finished), default=None),
+            'timings': cold_starts,
+        }
+
+    print(f"\n{'mode':<10} {'jobs':>5} {'failed':>7} {'p50 s':>8} {'p95 s':>8} {'p99 s':>8}")
+    for m in report['modes']:
+        row = [f"{m[k]:>8.2f}" if m[k] is not None else f"{'-':>8}" for k in ('p50_s', 'p95_s', 'p99_s')]
+        print(f"{m['mode']:<10} {m['jobs']:>5} {m['failed']:>7} {' '.join(row)}")
+    print(f"\n{completed}/{len(results)} jobs in {report['wall_s']}s on {CPU_COUNT} cores: "
+          f"{report['jobs_per_core_hour']} jobs/core-hour, {report['cpu_s']} CPU s, "
+          f"peak disk {report['peak_disk_mb']} MB, peak RSS {report['peak_rss_mb']} MB")
+    if args.cold_starts:
+        cold = report['cold_start']
+        print(f"Cold start: ready after {cold['ready_p50_s']}s, warm after {cold['warm_p50_s']}s, first job complete after "
+              f"{cold['first_job_complete_p50_s']}s (p50 of {cold['runs'] - cold['failed']} runs)")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    slow = [m['mode'] for m in report['modes'] if args.max_p95 is not None and (m['p95_s'] is None or m['p95_s'] > args.max_p95)]
+    failed = len(results) - completed + (report['cold_start']['failed'] if args.cold_starts else 0)
+    if failed or slow:
+        print(f"FAILED: {failed} failed jobs, p95 over budget in {slow or 'no mode'}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+"""One ffprobe per media file, memoized by content.
+
+probe() runs `ffprobe -show_streams -show_format -of json` once and derives
+everything later steps need (duration, frame rate, time base, geometry, codec
+parameters of the first video and audio streams). Results for local files are
+cached in memory keyed by a content fingerprint (size plus SHA-256 of the first
+and last MiB), so a file that shows up again - the hero source linked into
+every job, an audio track reused across batch items - is probed once per warm
+worker. URLs (presigned R2 links, Replicate outputs) are probed every time.
+
+keyframe_times() lists keyframe timestamps from packet flags (no decoding) and
+is cached the same way. content_hash() is the full-file SHA-256 for keys that
+outlive a job (the asset store), where a partial fingerprint could collide.
+"""
+import copy
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from tracing import traced_run
+
+# Probed files remembered per worker
+PROBE_CACHE_SIZE = int(os.environ.get('PROBE_CACHE_SIZE', 256))
+_FINGERPRINT_BLOCK = 1024 * 1024
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _is_url(source):
+    return '://' in str(source)
+
+
+def content_fingerprint(path):
+    """Cheap content hash of a local file: its size plus its first and last MiB"""
+    size = os.path.getsize(path)
+    digest = hashlib.sha256(str(size).encode())
+    with open(path, 'rb') as f:
+        digest.update(f.read(_FINGERPRINT_BLOCK))
+        if size > _FINGERPRINT_BLOCK:
+            f.seek(max(_FINGERPRINT_BLOCK, size - _FINGERPRINT_BLOCK))
+            digest.update(f.read(_FINGERPRINT_BLOCK))
+    return digest.hexdigest()
+
+
+def content_hash(path):
+    """SHA-256 of a local file's full content"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(_FINGERPRINT_BLOCK), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _memoized(kind, source, compute):
+    if _is_url(source):
+        return compute()
+    key = (kind, content_fingerprint(source))
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return copy.deepcopy(_cache[key])
+    value = compute()
+    with _cache_lock:
+        _cache[key] = value
+        while len(_cache) > PROBE_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return copy.deepcopy(value)
+
+
+def _rate(value):
+    num, _, den = (value or '0/1').partition('/')
+    return float(num) / float(den or 1) if float(den or 1) else 0.0
+
+
+def _video_stream(stream, format_duration):
+    # Unset SAR means square pixels
+    sar = stream.get('sample_aspect_ratio')
+    if sar in (None, 'N/A', '0:1'):
+        sar = '1:1'
+    time_base = stream.get('time_base', '1/1')
+    return {
+        'codec_name': stream.get('codec_name'),
+        'profile': stream.get('profile'),
+        'width': stream.get('width'),
+        'height': stream.get('height'),
+        'pix_fmt': stream.get('pix_fmt'),
+        'sample_aspect_ratio': sar,
+        'r_frame_rate': stream.get('r_frame_rate'),
+        'fps': _rate(stream.get('r_frame_rate')),
+        'time_base': time_base,
+        'timescale': int(time_base.split('/')[1]),
+        'start_time': float(stream.get('start_time') or 0),
+        'duration': float(stream.get('duration') or format_duration or 0),
+    }
+
+
+def _audio_stream(stream, format_duration):
+    return {
+        'codec_name': stream.get('codec_name'),
+        'sample_rate': int(stream.get('sample_rate') or 0),
+        'channels': stream.get('channels'),
+        'bit_rate': int(stream['bit_rate']) if str(stream.get('bit_rate', '')).isdigit() else None,
+        'time_base': stream.get('time_base'),
+        'duration': float(stream.get('duration') or format_duration or 0),
+    }
+
+
+def _probe(source):
+    result = traced_run([
+        'ffprobe', '-v', 'error',
+        '-show_streams', '-show_format',
+        '-of', 'json', str(source)
+    ], capture_output=True, text=True, check=True)
+    data = json.loads(result.stdout)
+    fmt = data.get('format', {})
+    format_duration = fmt.get('duration')
+    streams = data.get('streams', [])
+    video = next((s for s in streams if s.get('codec_type') == 'video'), None)
+    audio = next((s for s in streams if s.get('codec_type') == 'audio'), None)
+    return {
+        'duration': float(format_duration) if format_duration else None,
+        'format_name': fmt.get('format_name'),
+        'size': int(fmt['size']) if fmt.get('size') else None,
+        'video': _video_stream(video, format_duration) if video else None,
+        'audio': _audio_stream(audio, format_duration) if audio else None,
+    }
+
+
+def probe(source):
+    """Return format and first video/audio stream metadata of a local file or URL"""
+    return _memoized('probe', source, lambda: _probe(source))
+
+
+def probe_video(source):
+    """Return the first video stream's metadata (duration, fps, time base, size, codec parameters)"""
+    video = probe(source)['video']
+    if video is None:
+        raise ValueError(f"No video stream in {source}")
+    return video
+
+
+def _keyframe_times(source):
+    result = traced_run([
+        'ffprobe', '-v', 'error', '-select_streams', 'v:0',
+        '-show_entries', 'packet=pts_time,flags',
+        '-of', 'csv=p=0', str(source)
+    ], capture_output=True, text=True, check=True)
+    times = []
+    for line in result.stdout.splitlines():
+        pts_time, _, flags = line.partition(',')
+        if 'K' in flags and pts_time not in ('', 'N/A'):
+            times.append(float(pts_time))
+    return sorted(times)
+
+
+def keyframe_times(source):
+    """Return the presentation times (seconds) of all video keyframes"""
+    return _memoized('keyframes', source, lambda: _keyframe_times(source))
@@ -0,0 +1,186 @@
+"""Worker start-up: warm what the first job would otherwise pay for.
+
+A cold worker's first job used to construct the S3 client, open TLS
+connections to R2, the hero host and Replicate, resolve the model's latest
+version and download the hero video, all while the customer waited.
+start_prewarm() runs these as background tasks before the RunPod SDK is
+imported and started, so they overlap the SDK start-up and the wait for the
+first job:
+
+- r2: build the pooled S3 client and open a connection (HeadBucket) when R2_*
+  credentials are in the environment; otherwise just load botocore's S3 model
+- hero: download the default hero into the asset store and probe it; with
+  PREWARM_HERO_MASTER=1 also build the looped master. That encode competes with
+  the first job for CPU, so it is off by default and worth it only for
+  workloads that use the master (multi_step, hero fallbacks)
+- replicate: resolve the lip-sync model version on the shared async client
+  (needs REPLICATE_API_TOKEN)
+- ffmpeg: page in the ffmpeg/ffprobe binaries
+
+A job that needs something still being warmed waits for it instead of doing
+it twice (the hero cache locks per key), so the worker takes jobs before the
+warm-up is done. Both moments are printed as `{"metric": ...}` lines and
+returned with every job (`worker`): `ready_s` when the worker starts taking
+jobs and `warm_s` when the last warm-up task has finished, plus the first
+job's cold-start-to-complete latency.
+"""
+import json
+import os
+import subprocess
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from tracing import span
+
+PREWARM = os.environ.get('PREWARM', '1') != '0'
+# Hero fetched at start-up; empty disables it
+PREWARM_HERO_URL = os.environ.get('PREWARM_HERO_URL', 'https://blob.santagram.app/hero/hero.mp4')
+# Also encode the looped master used by multi_step and hero fallbacks
+PREWARM_HERO_MASTER = os.environ.get('PREWARM_HERO_MASTER', '0') == '1'
+
+_IMPORTED_AT = time.monotonic()
+
+_state = {
+    'ready_s': None,
+    'warm_s': None,
+    'tasks': {},
+    'pending': 0,
+    'first_job_complete_s': None,
+}
+_state_lock = threading.Lock()
+
+
+def process_uptime():
+    """Seconds since this process started (from /proc; falls back to time since this module was imported)"""
+    try:
+        with open('/proc/self/stat') as f:
+            # Field 22 (starttime), counted after the parenthesised command name
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return time.monotonic() - _IMPORTED_AT
+
+
+def _r2_config_from_env():
+    if not all(os.environ.get(name) for name in ('R2_ACCOUNT_ID', 'R2_ACCESS_KEY_ID', 'R2_SECRET_ACCESS_KEY', 'R2_BUCKET_NAME')):
+        return None
+    return {
+        'account_id': os.environ['R2_ACCOUNT_ID'],
+        'access_key_id': os.environ['R2_ACCESS_KEY_ID'],
+        'secret_access_key': os.environ['R2_SECRET_ACCESS_KEY'],
+        'bucket_name': os.environ['R2_BUCKET_NAME'],
+        'public_url': os.environ.get('R2_PUBLIC_URL', ''),
+        'endpoint_url': os.environ.get('R2_ENDPOINT_URL'),
+    }
+
+
+def warm_r2():
+    """Create the pooled S3 client and open a connection, or at least load botocore's S3 model"""
+    from r2 import get_r2_client
+    r2_config = _r2_config_from_env()
+    if r2_config is None:
+        # Jobs bring their own credentials; a throwaway client still loads the service model once per process
+        get_r2_client({'account_id': 'prewarm', 'access_key_id': 'prewarm', 'secret_access_key': 'prewarm',
+                       'endpoint_url': 'http://127.0.0.1:9'})
+        return 'model'
+    with span('r2.head_bucket', bucket=r2_config['bucket_name']):
+        get_r2_client(r2_config).head_bucket(Bucket=r2_config['bucket_name'])
+    return 'connected'
+
+
+def warm_hero():
+    """Put the default hero (and its looped master) in the asset store"""
+    from hero_cache import get_hero_master, get_hero_source
+    from media_probe import probe_video
+    if not PREWARM_HERO_URL:
+        return 'disabled'
+    with tempfile.TemporaryDirectory() as tmpdir:
+        hero_path = get_hero_source(PREWARM_HERO_URL, Path(tmpdir) / 'hero.mp4')
+        probe_video(hero_path)
+        if PREWARM_HERO_MASTER:
+            get_hero_master(PREWARM_HERO_URL, Path(tmpdir) / 'hero.mp4')
+    return 'cached'
+
+
+def warm_replicate():
+    """Resolve the model version, which also opens the shared client's connection"""
+    from replicate_client import get_model_version_sync
+    token = os.environ.get('REPLICATE_API_TOKEN')
+    if not token:
+        return 'no token'
+    get_model_version_sync(token)
+    return 'resolved'
+
+
+def warm_ffmpeg():
+    """Load the ffmpeg and ffprobe binaries and their libraries into the page cache"""
+    for tool in ('ffmpeg', 'ffprobe'):
+        subprocess.run([tool, '-hide_banner', '-version'], capture_output=True, check=True)
+    return 'loaded'
+
+
+TASKS = {
+    'r2': warm_r2,
+    'hero': warm_hero,
+    'replicate': warm_replicate,
+    'ffmpeg': warm_ffmpeg,
+}
+
+
+def _run_task(name, task):
+    started = time.monotonic()
+    try:
+        result = {'status': task()}
+    except Exception as e:
+        print(f"Warning: prewarm {name} failed: {e}")
+        result = {'status': 'failed', 'error': str(e)}
+    result['wall_s'] = round(time.monotonic() - started, 3)
+    result['done_at_s'] = round(process_uptime(), 3)
+    with _state_lock:
+        _state['tasks'][name] = result
+        _state['pending'] -= 1
+        warm = _state['pending'] == 0
+        if warm:
+            _state['warm_s'] = round(process_uptime(), 3)
+    print(f"Prewarm {name}: {result['status']} in {result['wall_s']}s")
+    if warm:
+        print(json.dumps({'metric': {'name': 'worker_warm', 'warm_s': _state['warm_s']}}))
+
+
+def start_prewarm(tasks=None):
+    """Start the warm-up tasks in the background; returns immediately"""
+    if not PREWARM:
+        return
+    tasks = tasks or TASKS
+    with _state_lock:
+        _state['pending'] += len(tasks)
+    for name, task in tasks.items():
+        threading.Thread(target=_run_task, args=(name, task), name=f"prewarm-{name}", daemon=True).start()
+
+
+def mark_ready():
+    """Record that the worker is about to take jobs (warm-up may still be running) and print the ready metric"""
+    with _state_lock:
+        _state['ready_s'] = round(process_uptime(), 3)
+    print(json.dumps({'metric': {'name': 'worker_ready', 'ready_s': _state['ready_s']}}))
+
+
+def job_completed():
+    """Note a finished job; returns the worker's timings for the job output"""
+    with _state_lock:
+        cold_start = _state['first_job_complete_s'] is None
+        if cold_start:
+            _state['first_job_complete_s'] = round(process_uptime(), 3)
+            print(json.dumps({'metric': {'name': 'first_job_complete', 'uptime_s': _state['first_job_complete_s']}}))
+        return {
+            'cold_start': cold_start,
+            'ready_s': _state['ready_s'],
+            # None while warm-up tasks are still running (or with PREWARM=0)
+            'warm_s': _state['warm_s'],
+            'first_job_complete_s': _state['first_job_complete_s'],
+            'prewarm': dict(_state['tasks']),
+        }
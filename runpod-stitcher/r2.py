@@ -0,0 +1,283 @@
+"""Cloudflare R2 access with pooled boto3 clients and bulk transfers.
+
+Clients are cached per (account_id, access_key_id, endpoint) so a warm worker
+reuses its connection pool and credential setup across files and jobs.
+"""
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import (
+    ClientError, ConnectionClosedError, ConnectTimeoutError, EndpointConnectionError, IncompleteReadError, ReadTimeoutError
+)
+
+from tracing import file_size, in_context, span
+
+MB = 1024 * 1024
+
+# Parallelism of download_many/upload_many
+R2_BULK_WORKERS = int(os.environ.get('R2_BULK_WORKERS', 8))
+# Per-object attempts in bulk transfers, with exponential backoff between them
+R2_RETRY_ATTEMPTS = int(os.environ.get('R2_RETRY_ATTEMPTS', 4))
+R2_RETRY_BASE_DELAY = float(os.environ.get('R2_RETRY_BASE_DELAY', 0.5))
+
+# Part size for streamed uploads; R2 needs equal-sized parts (except the last) of at least 5 MiB
+R2_STREAM_PART_SIZE = int(os.environ.get('R2_STREAM_PART_SIZE_MB', 8)) * MB
+# Streamed parts uploaded in parallel, which also bounds buffered memory
+R2_STREAM_UPLOAD_CONCURRENCY = int(os.environ.get('R2_STREAM_UPLOAD_CONCURRENCY', 4))
+
+# Multipart settings for single-object transfers; parts of one object move in parallel
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=int(os.environ.get('R2_MULTIPART_THRESHOLD_MB', 16)) * MB,
+    multipart_chunksize=int(os.environ.get('R2_MULTIPART_CHUNKSIZE_MB', 8)) * MB,
+    max_concurrency=int(os.environ.get('R2_TRANSFER_CONCURRENCY', 8)),
+    use_threads=True,
+)
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def r2_endpoint(r2_config):
+    """Return the S3 endpoint for r2_config (overridable for local S3 stand-ins)"""
+    return r2_config.get('endpoint_url') or f"https://{r2_config['account_id']}.r2.cloudflarestorage.com"
+
+
+def public_url_for(key, r2_config):
+    """Return the public URL of an R2 object, ensuring it has an http(s):// protocol"""
+    if r2_config['public_url']:
+        base_url = r2_config['public_url'].rstrip('/')
+        if not base_url.startswith('http://') and not base_url.startswith('https://'):
+            base_url = f"https://{base_url}"
+        return f"{base_url}/{key.lstrip('/')}"
+    return f"https://pub-{r2_config['account_id']}.r2.dev/{r2_config['bucket_name']}/{key.lstrip('/')}"
+
+
+def get_r2_client(r2_config):
+    """Return a shared S3 client for these credentials, creating it on first use"""
+    endpoint = r2_endpoint(r2_config)
+    cache_key = (r2_config['account_id'], r2_config['access_key_id'], endpoint)
+    # boto3.client() goes through the default session, which is not thread-safe
+    with _clients_lock:
+        client = _clients.get(cache_key)
+        if client is None:
+            config = Config(
+                signature_version='s3v4',
+                s3={
+                    'addressing_style': 'path'
+                },
+                # Enough sockets for bulk transfers times multipart concurrency
+                max_pool_connections=R2_BULK_WORKERS * TRANSFER_CONFIG.max_concurrency,
+                retries={'max_attempts': 5, 'mode': 'standard'},
+                tcp_keepalive=True,
+            )
+            client = boto3.client(
+                's3',
+                endpoint_url=endpoint,
+                aws_access_key_id=r2_config['access_key_id'],
+                aws_secret_access_key=r2_config['secret_access_key'],
+                config=config
+            )
+            _clients[cache_key] = client
+        return client
+
+
+def download_from_r2(key, local_path, r2_config):
+    """Download file from R2"""
+    s3 = get_r2_client(r2_config)
+    with span('r2.download', key=key) as record:
+        s3.download_file(r2_config['bucket_name'], key, str(local_path), Config=TRANSFER_CONFIG)
+        record['bytes'] = file_size(local_path)
+    print(f"Downloaded {key} to {local_path}")
+    return local_path
+
+
+def upload_to_r2(local_path, key, r2_config, content_type='application/octet-stream', cache_control=None):
+    """Upload file to R2"""
+    s3 = get_r2_client(r2_config)
+    extra_args = {'ContentType': content_type}
+    if cache_control:
+        extra_args['CacheControl'] = cache_control
+    with span('r2.upload', key=key, bytes=file_size(local_path)):
+        s3.upload_file(
+            str(local_path), r2_config['bucket_name'], key,
+            ExtraArgs=extra_args,
+            Config=TRANSFER_CONFIG
+        )
+    print(f"Uploaded {local_path} to {key}")
+    return key
+
+
+def object_etag(key, r2_config):
+    """Return the ETag of an R2 object, or None if it does not exist"""
+    s3 = get_r2_client(r2_config)
+    try:
+        with span('r2.head', key=key):
+            response = s3.head_object(Bucket=r2_config['bucket_name'], Key=key)
+    except ClientError as e:
+        if e.response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 404:
+            return None
+        raise
+    return response['ETag'].strip('"')
+
+
+def get_json(key, r2_config):
+    """Read a small JSON object from R2, or None if it does not exist"""
+    s3 = get_r2_client(r2_config)
+    try:
+        with span('r2.get', key=key) as record:
+            body = s3.get_object(Bucket=r2_config['bucket_name'], Key=key)['Body'].read()
+            record['bytes'] = len(body)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+            return None
+        raise
+    return json.loads(body)
+
+
+def put_json(key, data, r2_config):
+    """Write a small JSON object to R2"""
+    s3 = get_r2_client(r2_config)
+    body = json.dumps(data).encode()
+    with span('r2.put', key=key, bytes=len(body)):
+        s3.put_object(Bucket=r2_config['bucket_name'], Key=key, Body=body, ContentType='application/json')
+    return key
+
+
+def copy_object(source_key, key, r2_config):
+    """Server-side copy of an R2 object within the bucket"""
+    s3 = get_r2_client(r2_config)
+    with span('r2.copy', key=key, source_key=source_key):
+        s3.copy(
+            {'Bucket': r2_config['bucket_name'], 'Key': source_key},
+            r2_config['bucket_name'], key,
+            Config=TRANSFER_CONFIG
+        )
+    print(f"Copied {source_key} to {key}")
+    return key
+
+
+def presigned_get_url(key, r2_config, expires_in=3600):
+    """Return a presigned GET URL so tools like ffmpeg can read an object directly"""
+    s3 = get_r2_client(r2_config)
+    return s3.generate_presigned_url(
+        'get_object',
+        Params={'Bucket': r2_config['bucket_name'], 'Key': key},
+        ExpiresIn=expires_in
+    )
+
+
+def upload_stream(stream, key, r2_config, content_type='application/octet-stream', before_complete=None):
+    """Multipart-upload everything read from a binary stream until EOF, as it is produced.
+
+    Parts are uploaded in the background while the producer keeps writing; at most
+    R2_STREAM_UPLOAD_CONCURRENCY parts are buffered at a time. before_complete is
+    called once all parts are uploaded and may raise to abort the upload instead
+    of completing it. Returns bytes uploaded.
+    """
+    s3 = get_r2_client(r2_config)
+    bucket = r2_config['bucket_name']
+    upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key, ContentType=content_type)['UploadId']
+    in_flight = threading.BoundedSemaphore(R2_STREAM_UPLOAD_CONCURRENCY)
+
+    def upload_part(part_number, body):
+        try:
+            response = with_retry(lambda: s3.upload_part(
+                Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=part_number, Body=body
+            ))
+            return {'PartNumber': part_number, 'ETag': response['ETag']}
+        finally:
+            in_flight.release()
+
+    total_bytes = 0
+    futures = []
+    try:
+        with span('r2.stream_upload', key=key) as record, ThreadPoolExecutor(max_workers=R2_STREAM_UPLOAD_CONCURRENCY) as pool:
+            part_number = 1
+            while True:
+                body = stream.read(R2_STREAM_PART_SIZE)
+                # Always send at least one (possibly empty) part
+                if not body and part_number > 1:
+                    break
+                in_flight.acquire()
+                futures.append(pool.submit(upload_part, part_number, body))
+                total_bytes += len(body)
+                part_number += 1
+                if len(body) < R2_STREAM_PART_SIZE:
+                    break
+            parts = [future.result() for future in futures]
+            record['bytes'] = total_bytes
+        if before_complete is not None:
+            before_complete()
+        s3.complete_multipart_upload(
+            Bucket=bucket, Key=key, UploadId=upload_id,
+            MultipartUpload={'Parts': parts}
+        )
+    except BaseException:
+        s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+    print(f"Streamed {total_bytes} bytes to {key} in {len(futures)} parts")
+    return total_bytes
+
+
+# Network failures worth another attempt; anything else that is not a ClientError is a local error
+_TRANSPORT_ERRORS = (
+    EndpointConnectionError, ConnectionClosedError, ReadTimeoutError, ConnectTimeoutError, IncompleteReadError
+)
+
+
+def _is_retryable(error):
+    """Retry throttling, server errors and network failures, but not missing keys, auth or local errors"""
+    if isinstance(error, ClientError):
+        status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+        code = error.response.get('Error', {}).get('Code', '')
+        return status >= 500 or status == 429 or code in ('SlowDown', 'RequestTimeout', 'Throttling')
+    return isinstance(error, _TRANSPORT_ERRORS)
+
+
+def with_retry(fn, *args, attempts=None, base_delay=None):
+    """Call fn(*args), retrying transient failures with jittered exponential backoff"""
+    attempts = attempts or R2_RETRY_ATTEMPTS
+    base_delay = R2_RETRY_BASE_DELAY if base_delay is None else base_delay
+    for attempt in range(1, attempts + 1):
+        try:
+            return fn(*args)
+        except Exception as e:
+            if attempt == attempts or not _is_retryable(e):
+                raise
+            delay = base_delay * (2 ** (attempt - 1)) * (1 + random.random())
+            print(f"Warning: R2 transfer failed ({e}), retry {attempt}/{attempts - 1} in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def _run_bulk(fn, items, max_workers):
+    """Run fn(*item) with retries for every item on a bounded pool, returning results in input order"""
+    if not items:
+        return []
+    workers = max(1, min(max_workers or R2_BULK_WORKERS, len(items)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(in_context(with_retry), fn, *item) for item in items]
+        # result() re-raises the first failure in input order
+        return [future.result() for future in futures]
+
+
+def download_many(items, r2_config, max_workers=None):
+    """Download [(key, local_path), ...] concurrently; returns local paths in input order"""
+    return _run_bulk(
+        lambda key, local_path: download_from_r2(key, local_path, r2_config),
+        items, max_workers
+    )
+
+
+def upload_many(items, r2_config, max_workers=None):
+    """Upload [(local_path, key, content_type), ...] concurrently; returns keys in input order"""
+    return _run_bulk(
+        lambda local_path, key, content_type='application/octet-stream': upload_to_r2(local_path, key, r2_config, content_type),
+        items, max_workers
+    )
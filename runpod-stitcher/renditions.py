@@ -0,0 +1,158 @@
+"""Extra renditions of the final video, made from the same decode.
+
+A job can ask for a ladder of smaller MP4s, a poster JPEG and a short animated
+GIF preview next to its main output:
+
+    "renditions": [{"name": "mobile", "height": 480}, {"name": "desktop", "height": 1080, "crf": 21}],
+    "poster": {"time": 1.0},
+    "preview": {"start": 0, "seconds": 3, "fps": 10, "width": 320}
+
+(`"poster": true` / `"preview": true` use the defaults.) The renditions are
+extra outputs of the ffmpeg run that writes the main output: the video it
+decodes (or composes) is fanned out with `split` into one branch per rendition,
+so nothing is decoded a second time. Renditions never upscale, share the
+profile's x264 settings (`crf` per rendition overrides it) and copy the final
+audio track.
+The files are uploaded under `renditions_prefix` (default: output_key without
+its extension) as `{prefix}/{name}.mp4`, `{prefix}/poster.jpg` and
+`{prefix}/preview.gif`.
+"""
+import os
+import re
+from pathlib import Path
+
+from encoder_profiles import video_encode_args
+from r2 import public_url_for
+from tracing import file_size
+
+POSTER_DEFAULTS = {'time': 1.0}
+PREVIEW_DEFAULTS = {'start': 0.0, 'seconds': 3.0, 'fps': 10, 'width': 320}
+
+POSTER_NAME = 'poster'
+PREVIEW_NAME = 'preview'
+
+_NAME_RE = re.compile(r'[A-Za-z0-9_-]{1,32}')
+
+
+def _options(value, defaults, field):
+    """true -> defaults; an object -> defaults updated with its (known, numeric) fields"""
+    if value is True:
+        return dict(defaults)
+    if not isinstance(value, dict):
+        raise ValueError(f"{field} must be true or an object")
+    unknown = set(value) - set(defaults)
+    if unknown:
+        raise ValueError(f"Unknown {field} fields: {', '.join(sorted(unknown))}")
+    options = {**defaults, **value}
+    if any(not isinstance(v, (int, float)) or v < 0 for v in options.values()):
+        raise ValueError(f"{field} fields must be non-negative numbers")
+    return options
+
+
+def parse_renditions(input_data):
+    """The job's rendition spec from its input, or None when it asks for none"""
+    ladder = input_data.get('renditions') or []
+    poster = input_data.get('poster')
+    preview = input_data.get('preview')
+    if not ladder and not poster and not preview:
+        return None
+    if not isinstance(ladder, list):
+        raise ValueError("renditions must be a list of {name, height}")
+    renditions = []
+    for rendition in ladder:
+        if not isinstance(rendition, dict) or set(rendition) - {'name', 'height', 'crf'}:
+            raise ValueError("Each rendition needs a name and height (and optionally crf)")
+        name = rendition.get('name')
+        height = rendition.get('height')
+        if not isinstance(name, str) or not _NAME_RE.fullmatch(name) or name in (POSTER_NAME, PREVIEW_NAME):
+            raise ValueError(f"Invalid rendition name: {name!r}")
+        if not isinstance(height, int) or height < 16:
+            raise ValueError(f"Invalid height for rendition {name}: {height!r}")
+        renditions.append({'name': name, 'height': height - height % 2, 'crf': rendition.get('crf')})
+    if len({rendition['name'] for rendition in renditions}) != len(renditions):
+        raise ValueError("Rendition names must be unique")
+    return {
+        'renditions': renditions,
+        'poster': _options(poster, POSTER_DEFAULTS, 'poster') if poster else None,
+        'preview': _options(preview, PREVIEW_DEFAULTS, 'preview') if preview else None,
+        'prefix': input_data.get('renditions_prefix'),
+    }
+
+
+def rendition_files(spec, output_dir):
+    """(name, local path, content type) of every file the spec produces"""
+    output_dir = Path(output_dir)
+    files = [(r['name'], output_dir / f"{r['name']}.mp4", 'video/mp4') for r in spec['renditions']]
+    if spec['poster']:
+        files.append((POSTER_NAME, output_dir / f"{POSTER_NAME}.jpg", 'image/jpeg'))
+    if spec['preview']:
+        files.append((PREVIEW_NAME, output_dir / f"{PREVIEW_NAME}.gif", 'image/gif'))
+    return files
+
+
+def rendition_filters(spec, source, duration, main_label=None):
+    """filter_complex chains fanning the video `source` (e.g. '0:v' or 'v') out to every rendition.
+
+    With main_label, one more split output labelled main_label is left for the main output.
+    """
+    branches = [f"r{i}" for i in range(len(spec['renditions']))]
+    if spec['poster']:
+        branches.append('poster_in')
+    if spec['preview']:
+        branches.append('preview_in')
+    if main_label:
+        branches.append(main_label)
+    chains = [f"[{source}]split={len(branches)}{''.join(f'[{branch}]' for branch in branches)}"]
+    for i, rendition in enumerate(spec['renditions']):
+        # Never upscale: cap at the source height, width follows the aspect ratio
+        chains.append(f"[r{i}]scale=-2:min({rendition['height']}\\,ih)[r{i}out]")
+    if spec['poster']:
+        # Past the end of a short video, take the frame in the middle
+        time = min(spec['poster']['time'], duration / 2)
+        chains.append(f"[poster_in]trim=start={time:.3f}:duration=1,setpts=PTS-STARTPTS[poster_out]")
+    if spec['preview']:
+        preview = spec['preview']
+        start = min(preview['start'], max(0, duration - preview['seconds']))
+        # Never wider than the source; a palette from the preview's own frames keeps the GIF small and clean
+        chains.append(
+            f"[preview_in]trim=start={start:.3f}:duration={preview['seconds']:.3f},setpts=PTS-STARTPTS,"
+            f"fps={preview['fps']},scale=min({int(preview['width']) // 2 * 2}\\,iw):-2:flags=lanczos,split[preview_a][preview_b];"
+            f"[preview_a]palettegen=stats_mode=diff[preview_palette];"
+            f"[preview_b][preview_palette]paletteuse=dither=bayer[preview_out]"
+        )
+    return ';'.join(chains)
+
+
+def rendition_output_args(spec, output_dir, profile, audio_map=None, duration=None):
+    """ffmpeg output options and files for every rendition; they can go before the main output's options"""
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    args = []
+    paths = {name: path for name, path, _ in rendition_files(spec, output_dir)}
+    for i, rendition in enumerate(spec['renditions']):
+        encode_args = video_encode_args({**profile, 'crf': rendition['crf'] or profile['crf']})
+        args += ['-map', f'[r{i}out]']
+        if audio_map:
+            args += ['-map', audio_map, '-c:a', 'copy']
+        if duration is not None:
+            args += ['-t', f"{duration:.3f}"]
+        args += [*encode_args, '-pix_fmt', 'yuv420p', '-y', str(paths[rendition['name']])]
+    if spec['poster']:
+        args += ['-map', '[poster_out]', '-frames:v', '1', '-q:v', '2', '-y', str(paths[POSTER_NAME])]
+    if spec['preview']:
+        args += ['-map', '[preview_out]', '-loop', '0', '-y', str(paths[PREVIEW_NAME])]
+    return args
+
+
+def rendition_uploads(spec, output_dir, output_key):
+    """upload_many items for the files in output_dir"""
+    prefix = (spec['prefix'] or os.path.splitext(output_key)[0]).rstrip('/')
+    return [(str(path), f"{prefix}/{path.name}", content_type) for _, path, content_type in rendition_files(spec, output_dir)]
+
+
+def describe_renditions(spec, output_dir, output_key, r2_config):
+    """Job output for uploaded renditions: {name: {key, url, bytes}}"""
+    uploads = rendition_uploads(spec, output_dir, output_key)
+    return {
+        name: {'key': key, 'url': public_url_for(key, r2_config), 'bytes': file_size(path)}
+        for (name, _, _), (path, key, _) in zip(rendition_files(spec, output_dir), uploads)
+    }
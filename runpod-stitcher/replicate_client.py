@@ -0,0 +1,286 @@
+"""Async client for Replicate lip-sync predictions.
+
+One shared httpx.AsyncClient per event loop keeps connections to the Replicate
+API warm across jobs, the model's latest version is cached with a TTL instead
+of being looked up on every job, and predictions are created with
+`Prefer: wait` and then polled on an adaptive schedule driven by the
+prediction's reported progress.
+
+Synchronous callers use run_lipsync_sync(), which runs the coroutine on a
+long-lived background event loop so the shared client survives between jobs.
+submit_lipsync_many() starts one prediction per audio chunk on the same loop,
+at most max_concurrency at a time, and hands back a Future per chunk.
+"""
+import asyncio
+import os
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import httpx
+
+REPLICATE_API_BASE = os.environ.get('REPLICATE_API_BASE', 'https://api.replicate.com/v1')
+LIPSYNC_MODEL = 'kwaivgi/kling-lip-sync'
+# How long a resolved latest_version stays valid
+MODEL_VERSION_TTL = float(os.environ.get('REPLICATE_MODEL_VERSION_TTL', 3600))
+# Seconds the create call may block server-side for a result (Replicate allows 1-60)
+PREFER_WAIT_SECONDS = int(os.environ.get('REPLICATE_PREFER_WAIT', 60))
+MIN_POLL_INTERVAL = 1.0
+MAX_POLL_INTERVAL = float(os.environ.get('REPLICATE_MAX_POLL_INTERVAL', 15))
+# Same 25 minute budget the blocking poll loop had
+PREDICTION_TIMEOUT = float(os.environ.get('REPLICATE_PREDICTION_TIMEOUT', 1500))
+MAX_RATE_LIMIT_RETRIES = 5
+# Upper bound on one Retry-After wait
+MAX_RETRY_AFTER = float(os.environ.get('REPLICATE_MAX_RETRY_AFTER', 60))
+# Predictions one job keeps in flight when lip-syncing every chunk
+MAX_CONCURRENT_PREDICTIONS = int(os.environ.get('REPLICATE_MAX_CONCURRENCY', 8))
+
+_PROGRESS_RE = re.compile(r'(\d{1,3})%\|')
+
+_version_cache = {}
+_version_lock = threading.Lock()
+_clients = {}
+_clients_lock = threading.Lock()
+_background_loop = None
+
+
+class PredictionTimeout(ValueError):
+    """A prediction did not finish within its time budget"""
+
+
+def _api_base(api_base=None):
+    return (api_base or REPLICATE_API_BASE).rstrip('/')
+
+
+def get_http_client():
+    """Return the shared AsyncClient for the running event loop"""
+    loop = asyncio.get_running_loop()
+    with _clients_lock:
+        # Drop clients whose loop has gone away (e.g. after asyncio.run returned)
+        for stale in [l for l in _clients if l.is_closed()]:
+            del _clients[stale]
+        client = _clients.get(loop)
+        if client is None:
+            client = httpx.AsyncClient(
+                timeout=httpx.Timeout(30.0, read=PREFER_WAIT_SECONDS + 30.0),
+                limits=httpx.Limits(max_connections=32, max_keepalive_connections=16),
+            )
+            _clients[loop] = client
+        return client
+
+
+def _retry_after(response, attempt):
+    """Seconds to wait after a 429: Retry-After as seconds or an HTTP date, else exponential backoff"""
+    value = response.headers.get('Retry-After', '')
+    try:
+        delay = float(value)
+    except ValueError:
+        try:
+            retry_at = parsedate_to_datetime(value)
+            if retry_at.tzinfo is None:
+                retry_at = retry_at.replace(tzinfo=timezone.utc)
+            delay = (retry_at - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            delay = 2 ** attempt
+    return min(MAX_RETRY_AFTER, max(0.0, delay))
+
+
+async def _request(method, url, token, stats, **kwargs):
+    """Send an API request, honouring 429 Retry-After; counts calls in stats"""
+    client = get_http_client()
+    headers = {'Authorization': f'Token {token}', **kwargs.pop('headers', {})}
+    for attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+        stats['api_calls'] += 1
+        response = await client.request(method, url, headers=headers, **kwargs)
+        if response.status_code != 429 or attempt == MAX_RATE_LIMIT_RETRIES:
+            break
+        delay = _retry_after(response, attempt)
+        stats['rate_limited'] += 1
+        print(f"Replicate rate limited, retrying in {delay:.1f}s")
+        await asyncio.sleep(delay)
+    response.raise_for_status()
+    return response.json()
+
+
+async def get_model_version(token, stats, model=LIPSYNC_MODEL, api_base=None):
+    """Return the model's latest version id, cached for MODEL_VERSION_TTL seconds"""
+    cache_key = (_api_base(api_base), model)
+    with _version_lock:
+        cached = _version_cache.get(cache_key)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+    data = await _request('GET', f"{_api_base(api_base)}/models/{model}", token, stats)
+    version_id = data['latest_version']['id']
+    with _version_lock:
+        _version_cache[cache_key] = (version_id, time.monotonic() + MODEL_VERSION_TTL)
+    print(f"Resolved {model} version: {version_id}")
+    return version_id
+
+
+async def create_prediction(token, version_id, model_input, stats, webhook=None, api_base=None):
+    """Create a prediction, letting Replicate hold the request open for up to PREFER_WAIT_SECONDS"""
+    body = {'version': version_id, 'input': model_input}
+    if webhook:
+        # Lets the app hear about completion directly; the worker still polls for the output
+        body['webhook'] = webhook
+        body['webhook_events_filter'] = ['completed']
+    headers = {'Content-Type': 'application/json'}
+    if PREFER_WAIT_SECONDS > 0:
+        headers['Prefer'] = f'wait={PREFER_WAIT_SECONDS}'
+    return await _request('POST', f"{_api_base(api_base)}/predictions", token, stats, json=body, headers=headers)
+
+
+def _next_poll_interval(prediction, interval, started_at):
+    """Pick the next poll delay from the prediction's progress, falling back to backoff"""
+    matches = _PROGRESS_RE.findall(prediction.get('logs') or '')
+    progress = int(matches[-1]) / 100 if matches else 0
+    if 0 < progress < 1:
+        # Poll at roughly half the estimated time left, so we check again close to the end
+        elapsed = time.monotonic() - started_at
+        remaining = elapsed * (1 - progress) / progress
+        return min(MAX_POLL_INTERVAL, max(MIN_POLL_INTERVAL, remaining / 2))
+    return min(MAX_POLL_INTERVAL, interval * 1.5)
+
+
+def _output_url(prediction):
+    output = prediction.get('output')
+    if isinstance(output, str):
+        return output
+    if isinstance(output, list) and len(output) > 0:
+        return output[0]
+    raise ValueError(f"Unexpected output format from Replicate: {output}")
+
+
+async def wait_for_prediction(token, prediction, stats, api_base=None, timeout=PREDICTION_TIMEOUT, started_at=None):
+    """Poll a prediction until it finishes and return its output URL.
+
+    started_at (time.monotonic()) is when the create call was sent; the timeout and
+    the progress estimate count from there, including a `Prefer: wait` create.
+    """
+    started_at = time.monotonic() if started_at is None else started_at
+    interval = MIN_POLL_INTERVAL
+    url = prediction.get('urls', {}).get('get') or f"{_api_base(api_base)}/predictions/{prediction['id']}"
+    last_log = started_at
+    while True:
+        status = prediction['status']
+        if status == 'succeeded':
+            return _output_url(prediction)
+        if status == 'failed':
+            raise ValueError(f"Replicate prediction failed: {prediction.get('error') or 'Unknown error'}")
+        if status == 'canceled':
+            raise ValueError("Replicate prediction was canceled")
+        if time.monotonic() - started_at > timeout:
+            raise PredictionTimeout(f"Replicate prediction timed out after {timeout:.0f} seconds")
+
+        interval = _next_poll_interval(prediction, interval, started_at)
+        if time.monotonic() - last_log >= 60:
+            print(f"Replicate prediction still processing (status: {status})")
+            last_log = time.monotonic()
+        await asyncio.sleep(interval)
+        prediction = await _request('GET', url, token, stats)
+
+
+async def cancel_prediction(token, prediction, stats, api_base=None):
+    """Ask Replicate to stop a prediction we no longer wait for; failures are only logged"""
+    url = prediction.get('urls', {}).get('cancel') or f"{_api_base(api_base)}/predictions/{prediction['id']}/cancel"
+    try:
+        await _request('POST', url, token, stats)
+    except httpx.HTTPError as e:
+        print(f"Warning: Could not cancel prediction {prediction['id']}: {e}")
+
+
+async def run_lipsync(token, video_url, audio_url, webhook=None, api_base=None, timeout=PREDICTION_TIMEOUT, stats=None):
+    """Run one kling-lip-sync prediction and return (output_url, stats)"""
+    stats = stats if stats is not None else {'api_calls': 0, 'rate_limited': 0}
+    started_at = time.monotonic()
+    version_id = await get_model_version(token, stats, api_base=api_base)
+    created_at = time.monotonic()
+    create = asyncio.ensure_future(create_prediction(
+        token, version_id,
+        {'video_url': video_url, 'audio_file': audio_url},
+        stats, webhook=webhook, api_base=api_base
+    ))
+    try:
+        # Shielded: Prefer: wait holds the request open, and a prediction it started can only be canceled by id
+        prediction = await asyncio.shield(create)
+    except asyncio.CancelledError:
+        await cancel_prediction(token, await create, stats, api_base=api_base)
+        raise
+    stats['prediction_id'] = prediction['id']
+    print(f"Replicate prediction created: {prediction['id']} (status: {prediction['status']})")
+    try:
+        output_url = await wait_for_prediction(
+            token, prediction, stats, api_base=api_base, timeout=timeout, started_at=created_at
+        )
+    except (PredictionTimeout, asyncio.CancelledError):
+        # Don't keep paying for a result nobody will use
+        await cancel_prediction(token, prediction, stats, api_base=api_base)
+        raise
+    stats['wait_s'] = round(time.monotonic() - started_at, 3)
+    print(f"Replicate prediction completed: {prediction['id'][:8]}... in {stats['wait_s']}s, {stats['api_calls']} API calls")
+    return output_url, stats
+
+
+def _get_background_loop():
+    """Return a long-lived event loop running in a daemon thread"""
+    global _background_loop
+    with _clients_lock:
+        if _background_loop is None:
+            _background_loop = asyncio.new_event_loop()
+            threading.Thread(target=_background_loop.run_forever, name='replicate-loop', daemon=True).start()
+        return _background_loop
+
+
+def submit_lipsync(token, video_url, audio_url, webhook=None, api_base=None):
+    """Start run_lipsync on the background loop and return its concurrent.futures.Future.
+
+    Cancelling the future cancels the prediction on Replicate.
+    """
+    return asyncio.run_coroutine_threadsafe(
+        run_lipsync(token, video_url, audio_url, webhook=webhook, api_base=api_base),
+        _get_background_loop()
+    )
+
+
+def run_lipsync_sync(token, video_url, audio_url, webhook=None, api_base=None):
+    """Blocking wrapper around run_lipsync for synchronous handlers"""
+    return submit_lipsync(token, video_url, audio_url, webhook=webhook, api_base=api_base).result()
+
+
+async def _run_lipsync_bounded(semaphore, token, video_url, audio_url, stats, **kwargs):
+    async with semaphore:
+        return await run_lipsync(token, video_url, audio_url, stats=stats, **kwargs)
+
+
+def submit_lipsync_many(token, video_url, audio_urls, max_concurrency=MAX_CONCURRENT_PREDICTIONS,
+                        timeout=PREDICTION_TIMEOUT, webhook=None, api_base=None):
+    """Start a prediction for every audio URL, at most max_concurrency in flight.
+
+    Returns (futures, stats): one concurrent.futures.Future per URL, in order,
+    resolving to (output_url, stats) or raising the prediction's error, and the
+    per-chunk stats dicts, which are filled in as the predictions run.
+    """
+    loop = _get_background_loop()
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+    all_stats = [{'api_calls': 0, 'rate_limited': 0} for _ in audio_urls]
+    futures = [
+        asyncio.run_coroutine_threadsafe(
+            _run_lipsync_bounded(semaphore, token, video_url, audio_url, stats,
+                                 webhook=webhook, api_base=api_base, timeout=timeout),
+            loop
+        )
+        for audio_url, stats in zip(audio_urls, all_stats)
+    ]
+    return futures, all_stats
+
+
+def get_model_version_sync(token, api_base=None):
+    """Resolve (and cache) the lip-sync model version ahead of time, e.g. once per batch"""
+    stats = {'api_calls': 0, 'rate_limited': 0}
+    future = asyncio.run_coroutine_threadsafe(
+        get_model_version(token, stats, api_base=api_base),
+        _get_background_loop()
+    )
+    return future.result()
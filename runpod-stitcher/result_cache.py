@@ -0,0 +1,124 @@
+"""Job-level result cache and in-flight deduplication.
+
+A generate_and_stitch job is fully determined by its audio, hero version,
+chunk duration and encoder settings. job_cache_key() hashes those; a small
+manifest at cache/manifests/{key}.json in R2 records the output of the first
+job with that key. Retries and regenerations then reuse that output (copied
+server-side when they ask for a different output_key) instead of paying for a
+new Replicate prediction and encode. Identical jobs running at the same time in
+one worker share a single computation.
+
+Output keys are chosen by the caller, so the manifest also records the
+output's ETag: if a later job writes something else to that key, the entry is
+treated as a miss instead of serving the other video.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+from r2 import copy_object, get_json, object_etag, public_url_for, put_json
+
+RESULT_CACHE_PREFIX = os.environ.get('RESULT_CACHE_PREFIX', 'cache/manifests')
+# Bump when a pipeline change makes old outputs unfit for reuse
+RESULT_CACHE_VERSION = 2
+
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+
+def job_cache_key(parts):
+    """Hash a dict of everything that determines a job's output"""
+    payload = json.dumps({'version': RESULT_CACHE_VERSION, **parts}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def audio_fingerprint(audio_key, r2_config):
+    """ETag of the audio object; identical uploads get identical ETags"""
+    etag = object_etag(audio_key, r2_config)
+    if etag is None:
+        raise ValueError(f"Audio not found in R2: {audio_key}")
+    return etag
+
+
+def _manifest_key(cache_key):
+    return f"{RESULT_CACHE_PREFIX}/{cache_key}.json"
+
+
+def _reuse(manifest, output_key, r2_config, cache_info):
+    """Serve a job from a manifest, or return None if the cached output is gone or was overwritten"""
+    source_key = manifest['output_key']
+    etag = object_etag(source_key, r2_config)
+    if etag is None:
+        print(f"Cached output {source_key} is missing, recomputing")
+        return None
+    if etag != manifest.get('etag'):
+        print(f"Cached output {source_key} was overwritten since it was cached, recomputing")
+        return None
+    if source_key != output_key:
+        copy_object(source_key, output_key, r2_config)
+    print(f"Result cache hit: {cache_info['key'][:12]}... -> {source_key}")
+    return {
+        'status': 'COMPLETED',
+        'output': {
+            'video_url': public_url_for(output_key, r2_config),
+            'output_key': output_key,
+            'cache': {**cache_info, 'hit': True, 'source_key': source_key},
+        }
+    }
+
+
+def run_cached(cache_key, output_key, r2_config, compute):
+    """Return the cached result for cache_key, or run compute() once and record its output"""
+    cache_info = {'key': cache_key}
+    manifest = get_json(_manifest_key(cache_key), r2_config)
+    if manifest is not None:
+        result = _reuse(manifest, output_key, r2_config, cache_info)
+        if result is not None:
+            return result
+
+    with _in_flight_lock:
+        leader = cache_key not in _in_flight
+        if leader:
+            _in_flight[cache_key] = Future()
+        future = _in_flight[cache_key]
+
+    if not leader:
+        print(f"Identical job already running, waiting for it: {cache_key[:12]}...")
+        try:
+            manifest = future.result()
+        except Exception:
+            # The other job failed; try on our own
+            manifest = None
+        if manifest is not None:
+            result = _reuse(manifest, output_key, r2_config, {**cache_info, 'deduplicated': True})
+            if result is not None:
+                return result
+        result = compute()
+        if result.get('status') == 'COMPLETED':
+            result['output']['cache'] = {**cache_info, 'hit': False}
+        return result
+
+    try:
+        result = compute()
+        manifest = None
+        if result.get('status') == 'COMPLETED':
+            output_key = result['output']['output_key']
+            manifest = {
+                'output_key': output_key,
+                'etag': object_etag(output_key, r2_config),
+                'created_at': time.time(),
+                'replicate': result['output'].get('replicate'),
+            }
+            put_json(_manifest_key(cache_key), manifest, r2_config)
+            result['output']['cache'] = {**cache_info, 'hit': False}
+        future.set_result(manifest)
+        return result
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _in_flight_lock:
+            del _in_flight[cache_key]
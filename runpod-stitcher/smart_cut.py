@@ -0,0 +1,164 @@
+"""Frame- and sample-accurate cuts without re-encoding whole files.
+
+Video: smart_cut_video() stream-copies everything up to the last keyframe at or
+before the cut point and re-encodes only the final partial GOP, then joins the
+two with the concat demuxer. The tail is encoded with the same settings as the
+source (pass them in as encode_args) so both halves share codec parameters.
+
+Audio: MP3 frames hold 1152 samples, so `-t`/`-segment_time` with stream copy
+can only cut on frame boundaries and chunk lengths drift. The audio helpers
+decode the source once, cut with atrim on exact sample numbers and encode every
+piece in the same ffmpeg run, so the chunk durations add up to the source.
+"""
+import math
+from pathlib import Path
+
+from media_probe import keyframe_times, probe, probe_video
+from tracing import traced_run
+
+# Encoder used for the re-encoded final GOP when the caller does not pass the source's settings
+DEFAULT_VIDEO_ARGS = ['-c:v', 'libx264', '-preset', 'medium', '-crf', '23']
+DEFAULT_AUDIO_BITRATE = 128000
+
+
+def smart_cut_video(src, dst, duration, encode_args=None):
+    """Write the first `duration` seconds of src (video only) to dst, frame-accurately.
+
+    Cuts are counted in frames (-frames:v) rather than timestamps: with closed
+    GOPs the packets before a keyframe in decode order are exactly the frames
+    before it, which keeps B-frame reordering from leaking frames across the cut.
+    """
+    src, dst = Path(src), Path(dst)
+    info = probe_video(src)
+    total_frames = max(1, round(duration * info['fps']))
+    keyframe_frames = [
+        round((k - info['start_time']) * info['fps'])
+        for k in keyframe_times(src)
+    ]
+    head_frames = max([f for f in keyframe_frames if f <= total_frames] or [0])
+
+    if head_frames == total_frames:
+        # The cut is on a keyframe: plain stream copy
+        traced_run([
+            'ffmpeg', '-i', str(src),
+            '-frames:v', str(total_frames),
+            '-an', '-c', 'copy',
+            '-y', str(dst)
+        ], capture_output=True, text=True, check=True)
+        return dst
+
+    head = dst.with_name(f"{dst.stem}.head.mp4")
+    tail = dst.with_name(f"{dst.stem}.tail.mp4")
+    parts = []
+    if head_frames > 0:
+        traced_run([
+            'ffmpeg', '-i', str(src),
+            '-frames:v', str(head_frames),
+            '-an', '-c', 'copy',
+            '-y', str(head)
+        ], capture_output=True, text=True, check=True)
+        parts.append(head)
+    # Input seeking to a keyframe decodes from exactly that frame
+    traced_run([
+        'ffmpeg', '-ss', f"{head_frames / info['fps']:.6f}", '-i', str(src),
+        '-frames:v', str(total_frames - head_frames),
+        '-an',
+        *(encode_args or DEFAULT_VIDEO_ARGS),
+        '-pix_fmt', info['pix_fmt'],
+        '-r', info['r_frame_rate'],
+        '-video_track_timescale', str(info['timescale']),
+        '-y', str(tail)
+    ], capture_output=True, text=True, check=True)
+    parts.append(tail)
+
+    concat_file = dst.with_name(f"{dst.stem}.concat.txt")
+    with open(concat_file, 'w') as f:
+        for part in parts:
+            f.write(f"file '{part.resolve()}'\n")
+    try:
+        traced_run([
+            'ffmpeg', '-f', 'concat', '-safe', '0',
+            '-i', str(concat_file),
+            '-c', 'copy',
+            '-y', str(dst)
+        ], capture_output=True, text=True, check=True)
+    finally:
+        for path in (head, tail, concat_file):
+            path.unlink(missing_ok=True)
+    print(f"Smart cut {total_frames} frames: copied {head_frames}, re-encoded {total_frames - head_frames}")
+    return dst
+
+
+def _audio_info(src):
+    audio = probe(src)['audio']
+    if audio is None:
+        raise ValueError(f"No audio stream in {src}")
+    return audio
+
+
+def cut_audio_samples(src, ranges, encode_args=None):
+    """Decode src once and write [(start_sample, end_sample or None, dst), ...] in one ffmpeg run"""
+    if not ranges:
+        return []
+    if encode_args is None:
+        bit_rate = _audio_info(src)['bit_rate'] or DEFAULT_AUDIO_BITRATE
+        encode_args = ['-c:a', 'libmp3lame', '-b:a', str(bit_rate)]
+
+    labels = [f"s{i}" for i in range(len(ranges))]
+    if len(ranges) == 1:
+        graph = ['[0:a]anull[s0]']
+    else:
+        graph = [f"[0:a]asplit={len(ranges)}{''.join(f'[{label}]' for label in labels)}"]
+    outputs = []
+    for i, (start_sample, end_sample, dst) in enumerate(ranges):
+        trim = f"atrim=start_sample={start_sample}"
+        if end_sample is not None:
+            trim += f":end_sample={end_sample}"
+        graph.append(f"[{labels[i]}]{trim},asetpts=PTS-STARTPTS[o{i}]")
+        outputs += ['-map', f'[o{i}]', *encode_args, '-y', str(dst)]
+
+    traced_run([
+        'ffmpeg', '-i', str(src),
+        '-filter_complex', ';'.join(graph),
+        *outputs
+    ], capture_output=True, text=True, check=True)
+    return [dst for _, _, dst in ranges]
+
+
+def cut_audio(src, dst, duration, encode_args=None):
+    """Write the first `duration` seconds of src to dst, cut on an exact sample"""
+    sample_rate = _audio_info(src)['sample_rate']
+    return cut_audio_samples(src, [(0, round(duration * sample_rate), dst)], encode_args)[0]
+
+
+def _split_ranges(src, chunk_duration):
+    """(start_sample, end_sample or None) of every chunk, and the source sample rate and duration"""
+    info = _audio_info(src)
+    duration = probe(src)['duration'] or info['duration']
+    chunk_samples = round(chunk_duration * info['sample_rate'])
+    # Ignore a final sliver shorter than a millisecond of rounding noise
+    count = max(1, math.ceil(duration / chunk_duration - 0.001))
+    ranges = []
+    for i in range(count):
+        end_sample = (i + 1) * chunk_samples if i < count - 1 else None
+        ranges.append((i * chunk_samples, end_sample))
+    return ranges, info['sample_rate'], duration
+
+
+def split_audio(src, chunk_duration, dst_for_index, encode_args=None):
+    """Split src into chunk_duration pieces on exact sample boundaries; dst_for_index(i) names chunk i.
+
+    Every chunk except the last has exactly round(chunk_duration * sample_rate)
+    samples and the last one takes the rest, so the pieces add up to the source.
+    """
+    ranges, _, _ = _split_ranges(src, chunk_duration)
+    return cut_audio_samples(src, [(start, end, dst_for_index(i)) for i, (start, end) in enumerate(ranges)], encode_args)
+
+
+def split_durations(src, chunk_duration):
+    """Seconds of audio in each chunk split_audio() writes for src"""
+    ranges, sample_rate, duration = _split_ranges(src, chunk_duration)
+    return [
+        (end / sample_rate if end is not None else duration) - start / sample_rate
+        for start, end in ranges
+    ]
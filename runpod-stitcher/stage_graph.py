@@ -0,0 +1,111 @@
+"""Tiny dependency-graph scheduler for pipeline stages.
+
+Stages are plain functions that receive a dict of the results of the stages
+they depend on. Every stage whose dependencies are done starts right away on a
+thread pool, so independent work (e.g. hero preparation) overlaps with long
+waits (e.g. the Replicate prediction). Start/end offsets of every stage are
+recorded so the job output can show where the time went.
+
+When a stage fails, the cancel hooks of the stages still running are called
+(e.g. to cancel a Replicate prediction) and run() waits for those stages to
+return before re-raising, so none of them outlives the caller's temp directory.
+"""
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from tracing import in_context
+
+
+class StageGraph:
+    """A set of named stages with dependencies, run concurrently where possible"""
+
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self.stages = {}
+        self.cancels = {}
+        # Set when a stage failed; long stages can check it after starting work the hooks should cancel
+        self.aborted = False
+        self.results = {}
+        self.timings = {}
+        self.started_at = None
+
+    def add(self, name, fn, deps=(), cancel=None):
+        """Register fn(results) as stage `name`, to run after all of `deps`.
+
+        cancel() is called if another stage fails while this one is running.
+        """
+        for dep in deps:
+            if dep not in self.stages:
+                raise ValueError(f"Stage {name} depends on unknown stage {dep}")
+        self.stages[name] = (fn, tuple(deps))
+        if cancel is not None:
+            self.cancels[name] = cancel
+        return self
+
+    def _abort(self, running):
+        """Cancel the running stages that have a cancel hook"""
+        self.aborted = True
+        for name in running.values():
+            if name in self.cancels:
+                try:
+                    self.cancels[name]()
+                except Exception as e:
+                    print(f"Warning: cancelling stage {name} failed: {e}")
+
+    def _run_stage(self, name):
+        fn, deps = self.stages[name]
+        start = time.monotonic()
+        try:
+            return fn({dep: self.results[dep] for dep in deps})
+        finally:
+            end = time.monotonic()
+            self.timings[name] = {
+                'start_s': round(start - self.started_at, 3),
+                'end_s': round(end - self.started_at, 3),
+                'duration_s': round(end - start, 3),
+            }
+
+    def run(self):
+        """Run every stage and return {name: result}; the first failure is re-raised"""
+        self.started_at = time.monotonic()
+        pending = dict(self.stages)
+        running = {}
+        pool = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            while pending or running:
+                for name in [n for n, (_, deps) in pending.items() if all(d in self.results for d in deps)]:
+                    del pending[name]
+                    running[pool.submit(in_context(self._run_stage), name)] = name
+                if not running:
+                    raise ValueError(f"Stages can never run (dependency cycle?): {sorted(pending)}")
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    # Re-raises the stage's exception
+                    self.results[name] = future.result()
+        except BaseException:
+            self._abort(running)
+            raise
+        finally:
+            # Cancelled stages return quickly; the rest finish before the caller cleans up after them
+            pool.shutdown(wait=True, cancel_futures=True)
+        return self.results
+
+    def critical_path(self):
+        """Return the chain of stages that determined the total run time"""
+        if not self.timings:
+            return []
+        path = [max(self.timings, key=lambda n: self.timings[n]['end_s'])]
+        while True:
+            deps = self.stages[path[-1]][1]
+            if not deps:
+                break
+            path.append(max(deps, key=lambda n: self.timings[n]['end_s']))
+        return list(reversed(path))
+
+    def report(self):
+        """Per-stage timings plus the critical path, for the job output"""
+        return {
+            'stages': self.timings,
+            'critical_path': self.critical_path(),
+        }
@@ -0,0 +1,130 @@
+"""Codec compatibility analysis for copy-concatenating video chunks.
+
+The concat demuxer with `-c copy` only produces a playable file when every
+chunk shares codec parameters; otherwise ffmpeg silently writes broken output.
+plan_stitch() compares the parameters of every chunk against the most common
+set and lists the chunks that must be re-encoded to match before concat.
+"""
+from collections import Counter
+from fractions import Fraction
+
+from encoder_profiles import get_profile
+from media_probe import probe_video
+from tracing import traced_run
+
+# Parameters that must be identical across chunks for a stream-copy concat
+COMPAT_FIELDS = ('codec_name', 'profile', 'width', 'height', 'time_base', 'sample_aspect_ratio', 'pix_fmt')
+
+# Encoders able to reproduce a reference codec when a chunk has to be re-encoded
+ENCODERS = {
+    'h264': 'libx264',
+    'hevc': 'libx265',
+}
+
+# ffprobe's H.264 profile names -> libx264 -profile:v values; profiles x264 cannot write are left to its default
+X264_PROFILES = {
+    'Constrained Baseline': 'baseline',
+    'Baseline': 'baseline',
+    'Main': 'main',
+    'High': 'high',
+    'High 10': 'high10',
+    'High 4:2:2': 'high422',
+    'High 4:4:4 Predictive': 'high444',
+}
+
+
+def probe_video_params(path):
+    """Return the compatibility-relevant parameters of the first video stream (path or URL)"""
+    video = probe_video(path)
+    return {field: video[field] for field in COMPAT_FIELDS + ('r_frame_rate', 'duration')}
+
+
+def _compat_key(params):
+    return tuple(params.get(field) for field in COMPAT_FIELDS)
+
+
+def plan_stitch(chunk_params, durations=None):
+    """Decide how to concat chunks with the given parameters.
+
+    Returns a dict with 'strategy' ('stream_copy', 'partial_reencode' or
+    'full_reencode'), the 'reference' parameters every chunk must match and
+    the indexes of 'reencode_chunks'. When target durations are given, chunks
+    more than half a frame off are re-encoded to length as well and listed in
+    'mistimed_chunks'.
+    """
+    keys = [_compat_key(params) for params in chunk_params]
+    counts = Counter(keys)
+    # Most common parameter set wins; ties go to the earliest chunk
+    reference_key = max(keys, key=lambda k: (counts[k], -keys.index(k)))
+    reference = dict(chunk_params[keys.index(reference_key)])
+    mismatched = [i for i, key in enumerate(keys) if key != reference_key]
+
+    if not mismatched:
+        strategy = 'stream_copy'
+    elif reference['codec_name'] in ENCODERS:
+        strategy = 'partial_reencode'
+    else:
+        # We cannot produce the reference codec, so normalise everything to H.264
+        reference['codec_name'] = 'h264'
+        reference['profile'] = 'High'
+        strategy = 'full_reencode'
+        mismatched = list(range(len(chunk_params)))
+
+    plan = {
+        'strategy': strategy,
+        'reference': {field: reference.get(field) for field in COMPAT_FIELDS + ('r_frame_rate',)},
+        'reencode_chunks': mismatched,
+    }
+    if durations is not None:
+        # A chunk that runs long or short shifts every later chunk against the audio
+        tolerance = 0.5 / float(Fraction(reference['r_frame_rate']))
+        mistimed = [
+            i for i, (params, duration) in enumerate(zip(chunk_params, durations))
+            if abs(params['duration'] - duration) > tolerance
+        ]
+        plan['mistimed_chunks'] = mistimed
+        plan['reencode_chunks'] = sorted(set(mismatched) | set(mistimed))
+        if mistimed and strategy == 'stream_copy':
+            plan['strategy'] = 'partial_reencode'
+    return plan
+
+
+def normalize_chunk(src, dst, reference, profile=None, duration=None):
+    """Re-encode a chunk (video only) to the reference parameters so it can be copy-concatenated.
+
+    Quality settings come from the encoder profile; geometry always follows the reference.
+    With a duration the chunk is cut to that many seconds of frames, holding the last
+    frame when it is too short.
+    """
+    profile = profile or get_profile()
+    width, height = reference['width'], reference['height']
+    sar = reference['sample_aspect_ratio'].replace(':', '/')
+    video_filter = (
+        f"scale={width}:{height}:force_original_aspect_ratio=decrease,"
+        f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar={sar},"
+        f"fps={reference['r_frame_rate']},format={reference['pix_fmt']}"
+    )
+    frame_args = []
+    if duration is not None:
+        video_filter += f",tpad=stop_mode=clone:stop_duration={duration:.6f}"
+        frame_args = ['-frames:v', str(max(1, round(duration * Fraction(reference['r_frame_rate']))))]
+    command = [
+        'ffmpeg', '-i', str(src),
+        '-an',
+        '-vf', video_filter,
+        *frame_args,
+        '-c:v', ENCODERS[reference['codec_name']],
+        '-preset', profile['preset'],
+        '-crf', str(profile['crf']),
+    ]
+    if profile['threads']:
+        command += ['-threads', str(profile['threads'])]
+    x264_profile = X264_PROFILES.get(reference.get('profile')) if reference['codec_name'] == 'h264' else None
+    if x264_profile:
+        command += ['-profile:v', x264_profile]
+    command += [
+        '-video_track_timescale', reference['time_base'].split('/')[1],
+        '-y', str(dst)
+    ]
+    traced_run(command, capture_output=True, text=True, check=True)
+    return dst
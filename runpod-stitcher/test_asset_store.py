@@ -0,0 +1,98 @@
+"""Asset store eviction under the byte budget, files linked into job directories and stats().
+
+    python -m pytest -q test_asset_store.py
+"""
+import hashlib
+import os
+import threading
+
+from asset_store import AssetStore
+
+KB = 1024
+
+
+def write(path, data):
+    path.write_bytes(data)
+    return path
+
+
+def assert_consistent(store):
+    """stats() matches the index and the blobs on disk, and every key's blob exists"""
+    stats = store.stats()
+    with store._locked_index() as index:
+        digests = {entry['sha256'] for entry in index.values()}
+    on_disk = {path.name: path.stat().st_size for path in (store.root / 'objects').glob('*/*')}
+    assert stats['keys'] == len(index)
+    assert digests == set(on_disk)
+    assert stats['bytes'] == sum(on_disk.values())
+    return stats
+
+
+def test_eviction_keeps_files_linked_into_jobs(tmp_path):
+    store = AssetStore(tmp_path / 'store', max_bytes=250 * KB)
+    job_dir = tmp_path / 'job'
+    job_dir.mkdir()
+    hero = os.urandom(100 * KB)
+    store.put('hero', write(tmp_path / 'hero.bin', hero))
+    # A running job holds the hero in its directory while others fill the store
+    assert store.get('hero', job_dir / 'hero.mp4') == job_dir / 'hero.mp4'
+
+    store.put('tail', write(tmp_path / 'tail.bin', os.urandom(100 * KB)))
+    store.put('master', write(tmp_path / 'master.bin', os.urandom(100 * KB)))
+    # Over budget: the least recently used key went, and its blob left the store
+    assert store.meta('hero') is None
+    assert store.get('hero', tmp_path / 'again.mp4') is None
+    # The job's link still has the hero's bytes
+    assert (job_dir / 'hero.mp4').read_bytes() == hero
+    stats = assert_consistent(store)
+    assert stats == {'keys': 2, 'bytes': 200 * KB, 'max_bytes': 250 * KB}
+
+
+def test_shared_blob_is_kept_while_a_key_uses_it(tmp_path):
+    store = AssetStore(tmp_path / 'store', max_bytes=250 * KB)
+    same = os.urandom(100 * KB)
+    store.put('chunk-a', write(tmp_path / 'a.bin', same))
+    store.put('chunk-b', write(tmp_path / 'b.bin', same))
+    # Two keys, one blob
+    assert assert_consistent(store) == {'keys': 2, 'bytes': 100 * KB, 'max_bytes': 250 * KB}
+    store.put('other', write(tmp_path / 'other.bin', os.urandom(100 * KB)))
+    store.put('more', write(tmp_path / 'more.bin', os.urandom(100 * KB)))
+    # Dropping chunk-a alone frees nothing, so chunk-b went too and the blob with it
+    assert store.meta('chunk-a') is None and store.meta('chunk-b') is None
+    assert assert_consistent(store)['bytes'] == 200 * KB
+
+
+def test_concurrent_jobs_read_what_they_stored(tmp_path):
+    # Room for three blobs, with eight jobs putting and reading back constantly
+    store = AssetStore(tmp_path / 'store', max_bytes=3 * 64 * KB)
+    errors = []
+
+    def job(worker):
+        job_dir = tmp_path / f"job-{worker}"
+        job_dir.mkdir()
+        try:
+            for i in range(15):
+                data = os.urandom(64 * KB)
+                key = f"asset-{worker}-{i}"
+                sha256 = store.put(key, write(job_dir / f"src-{i}", data))
+                assert sha256 == hashlib.sha256(data).hexdigest()
+                # Another job may have evicted it already; a hit must have the stored bytes
+                linked = store.get(key, job_dir / f"linked-{i}")
+                if linked is not None:
+                    assert linked.read_bytes() == data
+                # The previous file stays intact however many evictions ran since
+                if i > 0 and (job_dir / f"linked-{i - 1}").exists():
+                    assert hashlib.sha256((job_dir / f"linked-{i - 1}").read_bytes()).hexdigest() == previous
+                previous = sha256
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=job, args=(worker,)) for worker in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    stats = assert_consistent(store)
+    assert stats['bytes'] <= store.max_bytes
+    assert not list((store.root / 'objects').glob('incoming-*'))
@@ -0,0 +1,71 @@
+"""single_pass and multi_step compose must produce the same timeline.
+
+Runs both generate_and_stitch compose paths on synthetic media (benchmark.py's
+generators, no R2 or Replicate) and compares the streams of the outputs.
+
+    python -m pytest -q test_compose.py
+"""
+import json
+import subprocess
+
+import pytest
+
+from asset_store import configure_store
+from audio_track import prepare_audio
+from benchmark import count_frames, make_audio, make_video
+from encoder_profiles import get_profile
+from handler import compose_multi_step, compose_single_pass
+
+SIZE = '240x426'
+FPS = 25
+CHUNK_DURATION = 6
+# Half a frame for video; an AAC frame (1024 samples at 44.1 kHz) for audio
+VIDEO_TOLERANCE = 0.5 / FPS
+AUDIO_TOLERANCE = 1024 / 44100
+
+
+def stream_timing(path):
+    """{codec_type: {'start', 'duration'}} of the first video and audio stream"""
+    result = subprocess.run([
+        'ffprobe', '-v', 'error',
+        '-show_entries', 'stream=codec_type,start_time,duration',
+        '-of', 'json', str(path)
+    ], capture_output=True, text=True, check=True)
+    timing = {}
+    for stream in json.loads(result.stdout)['streams']:
+        timing.setdefault(stream['codec_type'], {
+            'start': float(stream['start_time']),
+            'duration': float(stream['duration']),
+        })
+    return timing
+
+
+@pytest.mark.parametrize('duration', [10, 4], ids=['hero_loop', 'replicate_only'])
+def test_single_pass_matches_multi_step(tmp_path, duration):
+    configure_store(tmp_path / 'assets')
+    profile = get_profile('fast')
+    remaining = max(0, duration - CHUNK_DURATION)
+    audio = make_audio(tmp_path / 'audio.mp3', duration)
+    replicate = make_video(tmp_path / 'replicate.mp4', min(duration, CHUNK_DURATION), SIZE, FPS)
+    hero = make_video(tmp_path / 'hero.mp4', 3, SIZE, FPS, pattern='testsrc')
+    hero_tail = make_video(tmp_path / 'hero_tail.mp4', remaining, SIZE, FPS, pattern='testsrc') if remaining else None
+    audio_track, _ = prepare_audio(audio, tmp_path / 'audio.m4a', profile)
+
+    single = tmp_path / 'single.mp4'
+    compose_single_pass(replicate, hero, audio_track, duration, remaining, single, profile)
+    multi_dir = tmp_path / 'multi'
+    multi_dir.mkdir()
+    multi = tmp_path / 'multi.mp4'
+    compose_multi_step(replicate, hero_tail, audio_track, duration, multi, multi_dir, profile)
+
+    single_timing, multi_timing = stream_timing(single), stream_timing(multi)
+    assert count_frames(single) == count_frames(multi)
+    for kind, tolerance in (('video', VIDEO_TOLERANCE), ('audio', AUDIO_TOLERANCE)):
+        assert single_timing[kind]['start'] == pytest.approx(multi_timing[kind]['start'], abs=tolerance)
+        assert single_timing[kind]['duration'] == pytest.approx(multi_timing[kind]['duration'], abs=tolerance)
+        # Both paths cut to the audio length (AAC may add a frame of padding)
+        assert single_timing[kind]['duration'] == pytest.approx(duration, abs=2 * tolerance)
+    # A/V sync: start times include encoder delay (B-frames, AAC priming), so compare the offset between paths
+    single_offset = single_timing['audio']['start'] - single_timing['video']['start']
+    multi_offset = multi_timing['audio']['start'] - multi_timing['video']['start']
+    assert single_offset == pytest.approx(multi_offset, abs=AUDIO_TOLERANCE)
@@ -0,0 +1,90 @@
+"""Handler jobs against moto and the fake Replicate API: concurrent async jobs and the objects they write.
+
+    python -m pytest -q test_handler.py
+"""
+import asyncio
+import threading
+import time
+from functools import partial
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+from benchmark import make_video
+from loadtest import _QuietFileHandler, prepare_inputs
+from r2 import get_r2_client
+
+REPLICATE_DELAY = 2.0
+
+
+def r2_input(r2_config):
+    """The job input's R2 fields for the moto bucket"""
+    return {
+        'r2_account_id': r2_config['account_id'],
+        'r2_access_key_id': r2_config['access_key_id'],
+        'r2_secret_access_key': r2_config['secret_access_key'],
+        'r2_bucket_name': r2_config['bucket_name'],
+        'r2_endpoint_url': r2_config['endpoint_url'],
+        'r2_public_url': f"{r2_config['endpoint_url']}/{r2_config['bucket_name']}",
+    }
+
+
+@pytest.fixture
+def hero_url(tmp_path):
+    make_video(tmp_path / 'hero.mp4', 4, '128x228', 15, pattern='testsrc')
+    files = ThreadingHTTPServer(('127.0.0.1', 0), partial(_QuietFileHandler, directory=str(tmp_path)))
+    threading.Thread(target=files.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{files.server_address[1]}/hero.mp4"
+    files.shutdown()
+
+
+def test_jobs_overlap_on_the_async_handler(tmp_path, r2_config, fake_replicate, hero_url):
+    import handler
+    from asset_store import configure_store
+    # As many jobs as the worker takes at once (its job pool), but no more than three
+    jobs = min(handler.WORKER_CONCURRENCY, 3)
+    configure_store(tmp_path / 'assets')
+    replicate = fake_replicate(delay=REPLICATE_DELAY)
+    keys = prepare_inputs(tmp_path, [8], '128x228', 15, r2_config)[8]
+    base = {
+        **r2_input(r2_config),
+        'video_url': hero_url,
+        'replicate_api_token': 'local',
+        'replicate_api_base': replicate.api_base,
+        'mode': 'generate_and_stitch',
+        'audio_key': keys['audio_key'],
+        'result_cache': False,
+    }
+
+    async def run_all():
+        return await asyncio.gather(*(
+            handler.async_runpod_handler({'id': f"job-{i}", 'input': {**base, 'output_key': f"concurrent/{i}.mp4"}})
+            for i in range(jobs)
+        ))
+
+    start = time.monotonic()
+    outputs = asyncio.run(run_all())
+    wall_s = time.monotonic() - start
+
+    assert [output.get('error') for output in outputs] == [None] * jobs
+    assert sorted(output['output_key'] for output in outputs) == [f"concurrent/{i}.mp4" for i in range(jobs)]
+    client = get_r2_client(r2_config)
+    for i in range(jobs):
+        assert client.head_object(Bucket=r2_config['bucket_name'], Key=f"concurrent/{i}.mp4")['ContentLength'] > 0
+    # Each job waits on at least one prediction; run one after another they would take that many times as long
+    assert replicate.calls['create'] >= jobs
+    assert wall_s < jobs * REPLICATE_DELAY
+
+
+def test_split_audio_chunks_are_stored_as_mp3(tmp_path, r2_config):
+    import handler
+    keys = prepare_inputs(tmp_path, [8], '128x228', 15, r2_config)[8]
+    result = handler.handler({'input': {
+        **r2_input(r2_config), 'mode': 'split_audio', 'audio_key': keys['audio_key'], 'chunk_duration': 3,
+    }})
+    assert result['status'] == 'COMPLETED'
+    client = get_r2_client(r2_config)
+    content_types = [
+        client.head_object(Bucket=r2_config['bucket_name'], Key=key)['ContentType'] for key in result['output']['chunk_keys']
+    ]
+    assert content_types == ['audio/mpeg'] * 3
@@ -0,0 +1,199 @@
+"""fetch() and open_pipe() against a local server that drops connections, stalls and misreports sizes.
+
+    python -m pytest -q test_http_fetch.py
+"""
+import os
+import re
+import struct
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import http_fetch
+from http_fetch import IncompleteDownload, fetch, moov_first, open_pipe
+
+BODY = os.urandom(3 * 1024 * 1024 + 123)
+
+
+class FaultyServer:
+    """Serves body at /file; the first `drops` GETs are cut off after `drop_after` bytes.
+
+    With `hold_after`, a GET stops after that many bytes until `resume` is set.
+    """
+
+    def __init__(self, ranges=True, drops=0, drop_after=1024 * 1024, announced_size=None, hold_after=None, body=BODY):
+        self.body = body
+        self.hold_after = hold_after
+        self.resume = threading.Event()
+        self.ranges = ranges
+        self.drops = drops
+        self.drop_after = drop_after
+        self.announced_size = announced_size
+        self.requests = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}/file"
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def _headers(self, status, length, content_range=None):
+                self.send_response(status)
+                self.send_header('Content-Length', str(length))
+                if server.ranges:
+                    self.send_header('Accept-Ranges', 'bytes')
+                if content_range:
+                    self.send_header('Content-Range', content_range)
+                self.end_headers()
+
+            def do_HEAD(self):
+                self._headers(200, server.announced_size or len(server.body))
+
+            def do_GET(self):
+                match = re.fullmatch(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+                with server._lock:
+                    server.requests.append(self.headers.get('Range'))
+                    drop = server.drops > 0
+                    server.drops -= drop
+                if match and server.ranges:
+                    start = int(match.group(1))
+                    end = min(int(match.group(2)) if match.group(2) else len(server.body) - 1, len(server.body) - 1)
+                    body = server.body[start:end + 1]
+                    self._headers(206, len(body), f"bytes {start}-{end}/{len(server.body)}")
+                else:
+                    body = server.body
+                    self._headers(200, len(body))
+                if drop:
+                    # Announce the full length, send part of it and hang up
+                    self.wfile.write(body[:server.drop_after])
+                    self.wfile.flush()
+                    self.close_connection = True
+                    self.connection.shutdown(2)
+                    return
+                if server.hold_after is not None:
+                    self.wfile.write(body[:server.hold_after])
+                    self.wfile.flush()
+                    assert server.resume.wait(timeout=10)
+                    body = body[server.hold_after:]
+                try:
+                    self.wfile.write(body)
+                except ConnectionError:
+                    # The client gave up on the response, e.g. a pipe that cannot restart
+                    self.close_connection = True
+
+        return Handler
+
+    def stop(self):
+        self._server.shutdown()
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(http_fetch, 'HTTP_RETRY_BASE_DELAY', 0)
+
+
+@pytest.fixture
+def server_factory():
+    servers = []
+
+    def start(**kwargs):
+        servers.append(FaultyServer(**kwargs))
+        return servers[-1]
+
+    yield start
+    for server in servers:
+        server.stop()
+
+
+def test_resumes_from_last_byte(tmp_path, server_factory):
+    server = server_factory(drops=2)
+    path = fetch(server.url, tmp_path / 'file.bin')
+    assert path.read_bytes() == BODY
+    # Two resumes continue from where each drop stopped
+    assert server.requests == [None, 'bytes=1048576-', 'bytes=2097152-']
+
+
+def test_restarts_without_range_support(tmp_path, server_factory):
+    server = server_factory(ranges=False, drops=1)
+    path = fetch(server.url, tmp_path / 'file.bin')
+    assert path.read_bytes() == BODY
+    assert len(server.requests) == 2
+
+
+def test_parallel_segments(tmp_path, server_factory, monkeypatch):
+    monkeypatch.setattr(http_fetch, 'HTTP_PARALLEL_THRESHOLD', 1024 * 1024)
+    monkeypatch.setattr(http_fetch, 'HTTP_SEGMENT_SIZE', 1024 * 1024)
+    # One segment drops and resumes inside its own range
+    server = server_factory(drops=1, drop_after=1000)
+    path = fetch(server.url, tmp_path / 'file.bin', max_workers=4)
+    assert path.read_bytes() == BODY
+    # Four segments plus the resume of the dropped one
+    assert len(server.requests) == 5
+    assert {'bytes=0-1048575', 'bytes=1048576-2097151', 'bytes=2097152-3145727', 'bytes=3145728-3145850'} <= set(server.requests)
+
+
+def test_content_length_mismatch(tmp_path, server_factory):
+    server = server_factory(announced_size=len(BODY) + 1)
+    with pytest.raises(IncompleteDownload):
+        fetch(server.url, tmp_path / 'file.bin')
+    # Nothing is left under the final or the temporary name
+    assert os.listdir(tmp_path) == []
+
+
+def read_from(fd, size=None):
+    """Read size bytes (None: up to EOF) from a pipe"""
+    data = b''
+    while size is None or len(data) < size:
+        block = os.read(fd, 1024 * 1024 if size is None else size - len(data))
+        if not block:
+            break
+        data += block
+    return data
+
+
+def test_pipe_hands_over_bytes_before_eof(server_factory):
+    server = server_factory(hold_after=1024 * 1024)
+    pipe = open_pipe(server.url)
+    # The first megabyte is readable while the server still holds back the rest
+    assert read_from(pipe.fd, 1024 * 1024) == BODY[:1024 * 1024]
+    assert not server.resume.is_set()
+    server.resume.set()
+    assert read_from(pipe.fd) == BODY[1024 * 1024:]
+    pipe.close()
+    assert pipe.bytes == len(BODY)
+
+
+def test_pipe_resumes_after_a_drop(server_factory):
+    server = server_factory(drops=1)
+    pipe = open_pipe(server.url)
+    assert read_from(pipe.fd) == BODY
+    pipe.close()
+    assert server.requests == [None, 'bytes=1048576-']
+
+
+def test_pipe_cannot_restart_without_range_support(server_factory):
+    server = server_factory(ranges=False, drops=1)
+    pipe = open_pipe(server.url)
+    assert read_from(pipe.fd) == BODY[:1024 * 1024]
+    with pytest.raises(ValueError, match='Cannot restart'):
+        pipe.close()
+
+
+def box(kind, payload=b''):
+    return struct.pack('>I4s', 8 + len(payload), kind) + payload
+
+
+def test_moov_first(server_factory):
+    ftyp = box(b'ftyp', b'isom' * 4)
+    faststart = server_factory(body=ftyp + box(b'moov', b'x' * 100) + box(b'mdat', b'y' * 1000))
+    assert moov_first(faststart.url)
+    tail_index = server_factory(body=ftyp + box(b'mdat', b'y' * 1000) + box(b'moov', b'x' * 100))
+    assert not moov_first(tail_index.url)
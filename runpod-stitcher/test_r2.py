@@ -0,0 +1,69 @@
+"""Bulk R2 transfers against moto's S3 server.
+
+    python -m pytest -q test_r2.py
+"""
+import os
+
+import pytest
+from botocore.exceptions import ClientError, EndpointConnectionError
+
+import r2
+from r2 import MB, download_many, get_r2_client, upload_many, with_retry
+
+
+def test_bulk_round_trip(tmp_path, r2_config):
+    client = get_r2_client(r2_config)
+    clients = len(r2._clients)
+    sources = []
+    for i in range(11):
+        path = tmp_path / f"up_{i}.bin"
+        path.write_bytes(os.urandom(64 * 1024 + i))
+        sources.append(path)
+    # Past the multipart threshold, so this one goes up in parts
+    big = tmp_path / 'up_big.bin'
+    big.write_bytes(os.urandom(r2.TRANSFER_CONFIG.multipart_threshold + MB))
+    sources.append(big)
+
+    keys = upload_many(
+        [(str(path), f"round-trip/{path.name}", 'application/octet-stream') for path in sources],
+        r2_config, max_workers=4
+    )
+    assert keys == [f"round-trip/{path.name}" for path in sources]
+    assert '-' in get_r2_client(r2_config).head_object(Bucket=r2_config['bucket_name'], Key=keys[-1])['ETag']
+
+    targets = download_many([(key, tmp_path / f"down_{i}.bin") for i, key in enumerate(keys)], r2_config, max_workers=4)
+    assert [target.read_bytes() for target in targets] == [source.read_bytes() for source in sources]
+    # Every transfer went through the one pooled client
+    assert get_r2_client(r2_config) is client
+    assert len(r2._clients) == clients
+
+
+def test_missing_key_raises_without_retry(tmp_path, r2_config, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(r2.time, 'sleep', sleeps.append)
+    with pytest.raises(ClientError):
+        download_many([('round-trip/missing.bin', tmp_path / 'missing.bin')], r2_config)
+    assert sleeps == []
+
+
+def test_local_error_raises_without_retry(tmp_path, r2_config, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(r2.time, 'sleep', sleeps.append)
+    with pytest.raises(OSError):
+        upload_many([(str(tmp_path / 'missing.bin'), 'round-trip/missing.bin', 'application/octet-stream')], r2_config)
+    assert sleeps == []
+
+
+def test_connection_error_is_retried(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(r2.time, 'sleep', sleeps.append)
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) == 1:
+            raise EndpointConnectionError(endpoint_url='http://r2.invalid')
+        return 'done'
+
+    assert with_retry(flaky) == 'done'
+    assert len(sleeps) == 1
@@ -0,0 +1,101 @@
+"""Replicate client against the fake Replicate API: version cache, Prefer: wait, 429 retries and cancellation.
+
+    python -m pytest -q test_replicate_client.py
+"""
+import asyncio
+import time
+from email.utils import formatdate
+
+import httpx
+import pytest
+
+import replicate_client
+from replicate_client import PredictionTimeout, _retry_after, run_lipsync, run_lipsync_sync, submit_lipsync
+
+VIDEO = 'https://example.com/hero.mp4'
+AUDIO = 'https://example.com/chunk.mp3'
+
+
+@pytest.fixture(autouse=True)
+def empty_version_cache(monkeypatch):
+    monkeypatch.setattr(replicate_client, '_version_cache', {})
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.02)
+
+
+def test_model_version_is_looked_up_once_across_jobs(fake_replicate):
+    server = fake_replicate(delay=0)
+    for _ in range(3):
+        output_url, _ = run_lipsync_sync('token', VIDEO, AUDIO, api_base=server.api_base)
+        assert output_url.startswith(server.base_url)
+    assert server.calls['model'] == 1
+    assert server.calls['create'] == 3
+
+
+def test_model_version_expires_after_its_ttl(fake_replicate, monkeypatch):
+    monkeypatch.setattr(replicate_client, 'MODEL_VERSION_TTL', 0)
+    server = fake_replicate(delay=0)
+    run_lipsync_sync('token', VIDEO, AUDIO, api_base=server.api_base)
+    run_lipsync_sync('token', VIDEO, AUDIO, api_base=server.api_base)
+    assert server.calls['model'] == 2
+
+
+def test_create_waits_for_the_result(fake_replicate):
+    server = fake_replicate(delay=0.3)
+    _, stats = run_lipsync_sync('token', VIDEO, AUDIO, api_base=server.api_base)
+    assert server.prefer == [f"wait={replicate_client.PREFER_WAIT_SECONDS}"]
+    # The prediction finished while the create request was held open: no polling
+    assert server.calls['get'] == 0
+    assert stats['api_calls'] == 2
+
+
+@pytest.mark.parametrize('retry_after', ['0', formatdate(time.time() - 30, usegmt=True)])
+def test_rate_limited_create_is_retried(fake_replicate, retry_after):
+    server = fake_replicate(delay=0, rate_limits=2, retry_after=retry_after)
+    _, stats = run_lipsync_sync('token', VIDEO, AUDIO, api_base=server.api_base)
+    assert stats['rate_limited'] == 2
+    assert server.calls['create'] == 3
+
+
+def test_retry_after_forms(monkeypatch):
+    monkeypatch.setattr(replicate_client, 'MAX_RETRY_AFTER', 60)
+
+    def delay(value, attempt=0):
+        return _retry_after(httpx.Response(429, headers={'Retry-After': value} if value is not None else {}), attempt)
+
+    assert delay('2.5') == 2.5
+    assert 9 <= delay(formatdate(time.time() + 10, usegmt=True)) <= 10
+    assert delay(formatdate(time.time() - 10, usegmt=True)) == 0
+    # Unparseable or missing: exponential backoff
+    assert delay('soon', attempt=2) == 4
+    assert delay(None, attempt=3) == 8
+    # Clamped
+    assert delay('86400') == 60
+    assert delay('-5') == 0
+
+
+def test_timeout_counts_the_create_wait_and_cancels(fake_replicate, monkeypatch):
+    # The create is held open for a second, past the whole timeout
+    monkeypatch.setattr(replicate_client, 'PREFER_WAIT_SECONDS', 1)
+    server = fake_replicate(delay=10)
+    with pytest.raises(PredictionTimeout):
+        asyncio.run(run_lipsync('token', VIDEO, AUDIO, api_base=server.api_base, timeout=0.5))
+    # Timed out right after the create, without a poll in between
+    assert server.calls['get'] == 0
+    assert server.calls['cancel'] == 1
+    assert all(prediction.get('canceled') for prediction in server.predictions.values())
+
+
+def test_cancelled_job_cancels_its_prediction(fake_replicate, monkeypatch):
+    monkeypatch.setattr(replicate_client, 'PREFER_WAIT_SECONDS', 0)
+    server = fake_replicate(delay=10)
+    future = submit_lipsync('token', VIDEO, AUDIO, api_base=server.api_base)
+    wait_until(lambda: server.calls['create'] == 1)
+    future.cancel()
+    wait_until(lambda: server.calls['cancel'] == 1)
+    assert all(prediction.get('canceled') for prediction in server.predictions.values())
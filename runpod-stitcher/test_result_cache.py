@@ -0,0 +1,123 @@
+"""Result cache hits, misses and in-flight deduplication against moto's S3 server.
+
+    python -m pytest -q test_result_cache.py
+"""
+import threading
+import time
+import uuid
+
+import result_cache
+from r2 import get_r2_client
+from result_cache import job_cache_key, run_cached
+
+
+class FakeJob:
+    """compute() for run_cached: writes a new video to output_key and counts its runs"""
+
+    def __init__(self, r2_config, output_key, started=None, release=None):
+        self.r2_config = r2_config
+        self.output_key = output_key
+        self.started = started
+        self.release = release
+        self.runs = 0
+
+    def __call__(self):
+        self.runs += 1
+        if self.started is not None:
+            self.started.set()
+            assert self.release.wait(timeout=10)
+        put(self.r2_config, self.output_key, f"video {uuid.uuid4()}".encode())
+        return {'status': 'COMPLETED', 'output': {'output_key': self.output_key, 'video_url': 'unused'}}
+
+
+def put(r2_config, key, body):
+    get_r2_client(r2_config).put_object(Bucket=r2_config['bucket_name'], Key=key, Body=body)
+
+
+def body(r2_config, key):
+    return get_r2_client(r2_config).get_object(Bucket=r2_config['bucket_name'], Key=key)['Body'].read()
+
+
+def new_key():
+    return job_cache_key({'audio': str(uuid.uuid4())})
+
+
+def test_hit_copies_the_cached_output(r2_config):
+    key = new_key()
+    job = FakeJob(r2_config, 'cache-test/first.mp4')
+    first = run_cached(key, 'cache-test/first.mp4', r2_config, job)
+    assert first['output']['cache'] == {'key': key, 'hit': False}
+
+    second = run_cached(key, 'cache-test/second.mp4', r2_config, job)
+    assert job.runs == 1
+    assert second['output']['cache']['hit'] is True
+    assert second['output']['cache']['source_key'] == 'cache-test/first.mp4'
+    assert body(r2_config, 'cache-test/second.mp4') == body(r2_config, 'cache-test/first.mp4')
+
+
+def test_other_key_misses(r2_config):
+    job = FakeJob(r2_config, 'cache-test/other.mp4')
+    run_cached(new_key(), 'cache-test/other.mp4', r2_config, job)
+    run_cached(new_key(), 'cache-test/other.mp4', r2_config, job)
+    assert job.runs == 2
+
+
+def test_deleted_output_misses(r2_config):
+    key = new_key()
+    job = FakeJob(r2_config, 'cache-test/deleted.mp4')
+    run_cached(key, 'cache-test/deleted.mp4', r2_config, job)
+    get_r2_client(r2_config).delete_object(Bucket=r2_config['bucket_name'], Key='cache-test/deleted.mp4')
+    result = run_cached(key, 'cache-test/deleted.mp4', r2_config, job)
+    assert job.runs == 2
+    assert result['output']['cache']['hit'] is False
+
+
+def test_overwritten_output_misses(r2_config):
+    key = new_key()
+    job = FakeJob(r2_config, 'cache-test/shared.mp4')
+    run_cached(key, 'cache-test/shared.mp4', r2_config, job)
+    # A later job with other audio writes its video to the same output_key
+    put(r2_config, 'cache-test/shared.mp4', b'someone else\'s video')
+    result = run_cached(key, 'cache-test/shared.mp4', r2_config, job)
+    assert job.runs == 2
+    assert result['output']['cache']['hit'] is False
+    assert body(r2_config, 'cache-test/shared.mp4') != b'someone else\'s video'
+
+
+def test_identical_jobs_in_flight_share_one_computation(r2_config, monkeypatch):
+    key = new_key()
+    started, release = threading.Event(), threading.Event()
+    looked_up = threading.Event()
+    get_json = result_cache.get_json
+
+    def tracked_get_json(*args):
+        manifest = get_json(*args)
+        if threading.current_thread().name == 'follower':
+            looked_up.set()
+        return manifest
+
+    monkeypatch.setattr(result_cache, 'get_json', tracked_get_json)
+    job = FakeJob(r2_config, 'cache-test/leader.mp4', started, release)
+    results = {}
+
+    def run(name, output_key):
+        results[name] = run_cached(key, output_key, r2_config, job)
+
+    leader = threading.Thread(target=run, args=('leader', 'cache-test/leader.mp4'))
+    leader.start()
+    assert started.wait(timeout=10)
+    follower = threading.Thread(target=run, args=('follower', 'cache-test/follower.mp4'), name='follower')
+    follower.start()
+    # Finish the leader only once the follower found no manifest and is about to join the running job
+    assert looked_up.wait(timeout=10)
+    time.sleep(0.2)
+    release.set()
+    leader.join(timeout=10)
+    follower.join(timeout=10)
+
+    assert job.runs == 1
+    assert results['leader']['output']['cache']['hit'] is False
+    assert results['follower']['output']['cache'] == {
+        'key': key, 'hit': True, 'source_key': 'cache-test/leader.mp4', 'deduplicated': True,
+    }
+    assert body(r2_config, 'cache-test/follower.mp4') == body(r2_config, 'cache-test/leader.mp4')
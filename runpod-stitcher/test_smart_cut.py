@@ -0,0 +1,42 @@
+"""split_audio() cuts on exact samples: the chunks add up to the source.
+
+    python -m pytest -q test_smart_cut.py
+"""
+import subprocess
+
+import pytest
+
+from benchmark import make_audio
+from smart_cut import split_audio, split_durations
+
+
+def samples(path):
+    """Number of samples ffmpeg decodes from path (mono)"""
+    pcm = subprocess.run(
+        ['ffmpeg', '-v', 'error', '-i', str(path), '-f', 's16le', '-ac', '1', '-'],
+        capture_output=True, check=True
+    ).stdout
+    return len(pcm) // 2
+
+
+def test_wav_chunks_have_exact_sample_counts(tmp_path):
+    src = tmp_path / 'source.wav'
+    subprocess.run([
+        'ffmpeg', '-v', 'error', '-f', 'lavfi', '-i', 'sine=frequency=440:duration=10.5',
+        '-ar', '22050', '-c:a', 'pcm_s16le', '-y', str(src)
+    ], check=True)
+    chunks = split_audio(src, 2.5, lambda i: tmp_path / f"chunk_{i}.wav", ['-c:a', 'pcm_s16le'])
+    counts = [samples(chunk) for chunk in chunks]
+    # Four full chunks of 2.5 s and the half second left over
+    assert counts == [55125] * 4 + [11025]
+    assert sum(counts) == samples(src)
+    assert split_durations(src, 2.5) == pytest.approx([2.5] * 4 + [0.5])
+
+
+def test_mp3_chunks_add_up_to_the_source(tmp_path):
+    src = make_audio(tmp_path / 'source.mp3', 10.5)
+    chunks = split_audio(src, 3, lambda i: tmp_path / f"chunk_{i}.mp3")
+    counts = [samples(chunk) for chunk in chunks]
+    assert len(counts) == 4
+    assert sum(counts) == samples(src)
+    assert counts[0] == counts[1] == counts[2]
@@ -0,0 +1,49 @@
+"""StageGraph scheduling and failure handling.
+
+    python -m pytest -q test_stage_graph.py
+"""
+import threading
+import time
+
+import pytest
+
+from stage_graph import StageGraph
+
+
+def test_stages_get_their_dependencies():
+    graph = StageGraph()
+    graph.add('a', lambda deps: 1)
+    graph.add('b', lambda deps: deps['a'] + 1, deps=['a'])
+    graph.add('c', lambda deps: deps['a'] + deps['b'], deps=['a', 'b'])
+    assert graph.run() == {'a': 1, 'b': 2, 'c': 3}
+
+
+def test_failure_cancels_and_waits_for_running_stages():
+    finished = []
+    cancelled = threading.Event()
+
+    def fail(deps):
+        time.sleep(0.1)
+        raise RuntimeError('stage failed')
+
+    def slow(deps):
+        time.sleep(0.3)
+        finished.append('slow')
+
+    def waiting(deps):
+        # Stands in for a Replicate prediction: only returns early when cancelled
+        assert cancelled.wait(timeout=5)
+        finished.append('waiting')
+
+    graph = StageGraph()
+    graph.add('fail', fail)
+    graph.add('slow', slow)
+    graph.add('waiting', waiting, cancel=cancelled.set)
+    graph.add('after', lambda deps: finished.append('after'), deps=['slow'])
+    start = time.monotonic()
+    with pytest.raises(RuntimeError, match='stage failed'):
+        graph.run()
+    # Running stages finished before run() returned; no new stage was started
+    assert sorted(finished) == ['slow', 'waiting']
+    assert graph.aborted
+    assert time.monotonic() - start < 2
@@ -0,0 +1,275 @@
+"""Lightweight per-job tracing of downloads, uploads, HTTP calls and ffmpeg/ffprobe runs.
+
+handler() opens a Trace for every job; code anywhere below it wraps work in
+span('kind.what') to record wall time, bytes moved, CPU time of finished child
+processes (resource.getrusage) and peak RSS. Each span is written to stderr as
+one JSON line when it ends, and the job output gets a `metrics` block with all
+spans plus per-kind totals.
+
+The current trace lives in a contextvar, so work handed to a thread pool must
+be submitted through in_context() to be recorded. Child CPU time comes from
+RUSAGE_CHILDREN, which is process-wide: spans that overlap share each other's
+CPU time, so treat per-span CPU as approximate while the totals stay exact.
+
+Set FFMPEG_PROGRESS=1 (or `ffmpeg_progress: true` in the job input) to have
+ffmpeg report `-progress` to the worker, which logs fps and speed of long
+encodes as they run.
+"""
+import contextvars
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+FFMPEG_PROGRESS = os.environ.get('FFMPEG_PROGRESS', '') not in ('', '0', 'false')
+# Seconds between live progress lines for one ffmpeg process
+PROGRESS_LOG_INTERVAL = float(os.environ.get('FFMPEG_PROGRESS_INTERVAL', 5))
+
+_current = contextvars.ContextVar('trace', default=None)
+
+
+def _cpu_children_s():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in KiB on Linux; children is the largest single finished child
+    self_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_kb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(max(self_kb, children_kb) / 1024, 1)
+
+
+class Trace:
+    """The spans recorded for one job"""
+
+    def __init__(self, progress=False):
+        self.progress = progress or FFMPEG_PROGRESS
+        self.started_at = time.monotonic()
+        self.cpu_start = _cpu_children_s()
+        self.spans = []
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def record(self, record):
+        with self.lock:
+            self.spans.append(record)
+        print(json.dumps({'span': record}), file=sys.stderr, flush=True)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def metrics(self):
+        """Spans plus per-kind totals and counters, for the job output"""
+        totals = {}
+        with self.lock:
+            spans = list(self.spans)
+            counters = dict(self.counters)
+        for record in spans:
+            kind = totals.setdefault(record['name'].split('.')[0], {'count': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'bytes': 0})
+            kind['count'] += 1
+            kind['wall_s'] = round(kind['wall_s'] + record['wall_s'], 3)
+            kind['cpu_s'] = round(kind['cpu_s'] + record['cpu_s'], 3)
+            kind['bytes'] += record.get('bytes') or 0
+        return {
+            'spans': spans,
+            'totals': totals,
+            'counters': counters,
+            'wall_s': round(time.monotonic() - self.started_at, 3),
+            'child_cpu_s': round(_cpu_children_s() - self.cpu_start, 3),
+            'peak_rss_mb': _peak_rss_mb(),
+        }
+
+
+@contextmanager
+def start_trace(progress=False):
+    """Make a new Trace current for the duration of the block"""
+    trace = Trace(progress=progress)
+    token = _current.set(trace)
+    try:
+        yield trace
+    finally:
+        _current.reset(token)
+
+
+def current_trace():
+    return _current.get()
+
+
+def in_context(fn):
+    """Wrap fn so it runs with the caller's trace when executed on another thread"""
+    context = contextvars.copy_context()
+    # A context can only be entered by one thread at a time, so every call gets its own copy
+    return lambda *args, **kwargs: context.copy().run(fn, *args, **kwargs)
+
+
+@contextmanager
+def span(name, **attrs):
+    """Time a block of work; set record['bytes'] (or other fields) on the yielded dict"""
+    trace = current_trace()
+    record = {'name': name, **attrs}
+    start = time.monotonic()
+    cpu_start = _cpu_children_s()
+    try:
+        yield record
+    except BaseException as e:
+        record['error'] = type(e).__name__
+        raise
+    finally:
+        if trace is not None:
+            record['start_s'] = round(start - trace.started_at, 3)
+            record['wall_s'] = round(time.monotonic() - start, 3)
+            record['cpu_s'] = round(_cpu_children_s() - cpu_start, 3)
+            record['peak_rss_mb'] = _peak_rss_mb()
+            trace.record(record)
+
+
+def count(name, n=1):
+    """Add n to a named counter of the current job (e.g. cache hits)"""
+    trace = current_trace()
+    if trace is not None:
+        trace.count(name, n)
+
+
+def file_size(path):
+    """Size of a local file, or None when path is not one (e.g. a URL or pipe)"""
+    try:
+        return Path(path).stat().st_size
+    except (OSError, ValueError):
+        return None
+
+
+class FfmpegProgress:
+    """Reads ffmpeg `-progress` key=value blocks from a pipe and logs fps/speed as they arrive"""
+
+    def __init__(self, record):
+        self.record = record
+        self.read_fd, self.write_fd = os.pipe()
+        self.args = ['-progress', f'pipe:{self.write_fd}', '-nostats']
+        self.thread = None
+
+    def started(self):
+        """Call once ffmpeg has been spawned (with pass_fds=(write_fd,))"""
+        os.close(self.write_fd)
+        self.thread = threading.Thread(target=self._read, daemon=True)
+        self.thread.start()
+
+    def _read(self):
+        values = {}
+        # The first blocks arrive before any output is written, so start counting from spawn
+        last_log = time.monotonic()
+        with os.fdopen(self.read_fd, 'r', errors='replace') as stream:
+            for line in stream:
+                key, _, value = line.strip().partition('=')
+                values[key] = value
+                if key != 'progress':
+                    continue
+                # Audio-only runs report no fps
+                for field in ('fps', 'speed'):
+                    if field in values:
+                        self.record[field] = values[field]
+                if value == 'end' or time.monotonic() - last_log >= PROGRESS_LOG_INTERVAL:
+                    last_log = time.monotonic()
+                    print(f"ffmpeg progress: time={values.get('out_time')} fps={values.get('fps', '-')} speed={values.get('speed')}")
+
+    def finish(self):
+        if self.thread is not None:
+            self.thread.join()
+        else:
+            os.close(self.write_fd)
+            os.close(self.read_fd)
+
+
+class FfmpegProcess:
+    """ffmpeg running in the background, with -progress logging when the trace asks for it.
+
+    Use as a context manager: leaving the block waits for ffmpeg (killing it first
+    if the block raised) and raises CalledProcessError with its stderr if it failed.
+    """
+
+    def __init__(self, command, record, stdout=subprocess.DEVNULL):
+        trace = current_trace()
+        self.progress = FfmpegProgress(record) if trace is not None and trace.progress else None
+        pass_fds = ()
+        if self.progress is not None:
+            command = [command[0], *self.progress.args, *command[1:]]
+            pass_fds = (self.progress.write_fd,)
+        self.command = command
+        try:
+            self.process = subprocess.Popen(command, stdout=stdout, stderr=subprocess.PIPE, pass_fds=pass_fds)
+        except BaseException:
+            if self.progress is not None:
+                self.progress.finish()
+            raise
+        if self.progress is not None:
+            self.progress.started()
+        # Drain stderr in the background so ffmpeg never blocks on a full pipe
+        self._stderr = []
+        self._stderr_thread = threading.Thread(target=lambda: self._stderr.append(self.process.stderr.read()), daemon=True)
+        self._stderr_thread.start()
+        self._reaped = False
+
+    def wait(self):
+        """Wait for ffmpeg to exit; raises CalledProcessError if it failed"""
+        returncode = self.process.wait()
+        if not self._reaped:
+            self._reaped = True
+            self._stderr_thread.join()
+            if self.progress is not None:
+                self.progress.finish()
+        if returncode != 0:
+            stderr = b''.join(self._stderr).decode(errors='replace')
+            raise subprocess.CalledProcessError(returncode, self.command, stderr=stderr)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.wait()
+            return False
+        if self.process.poll() is None:
+            self.process.kill()
+        try:
+            self.wait()
+        except subprocess.CalledProcessError:
+            # The block's own error is the one to report
+            pass
+        return False
+
+
+def traced_run(command, **kwargs):
+    """subprocess.run for ffmpeg/ffprobe, recorded as a span; ffmpeg's output file size counts as bytes"""
+    tool = Path(command[0]).name
+    with span(tool, file=Path(str(command[-1])).name) as record:
+        trace = current_trace()
+        if tool != 'ffmpeg' or trace is None or not trace.progress:
+            result = subprocess.run(command, **kwargs)
+        else:
+            result = _run_with_progress(command, record, **kwargs)
+        if tool == 'ffmpeg':
+            record['bytes'] = file_size(command[-1])
+        return result
+
+
+def _run_with_progress(command, record, capture_output=False, text=False, check=False, pass_fds=()):
+    progress = FfmpegProgress(record)
+    command = [command[0], *progress.args, *command[1:]]
+    pipe = subprocess.PIPE if capture_output else None
+    try:
+        process = subprocess.Popen(command, stdout=pipe, stderr=pipe, text=text, pass_fds=(progress.write_fd, *pass_fds))
+    except BaseException:
+        progress.finish()
+        raise
+    progress.started()
+    stdout, stderr = process.communicate()
+    progress.finish()
+    if check and process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command, output=stdout, stderr=stderr)
+    return subprocess.CompletedProcess(command, process.returncode, stdout, stderr)